@@ -0,0 +1,75 @@
+"""هزینه تبدیل فرمان به Blueprint: مسیر prompt متنی در برابر AIRequest ساخت‌یافته.
+
+اجرا: python benchmarks/bench_ai_command.py
+"""
+from __future__ import annotations
+
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from logic.ai_client import RuleBasedAIClient  # noqa: E402
+from logic.blueprint_cache import BlueprintCache  # noqa: E402
+from logic.intent_parser import IntentParser  # noqa: E402
+
+COLUMN_COUNTS = [10, 100, 500]
+COMMANDS = [
+    "ستون price رو ۱۰ درصد افزایش بده",
+    "ستون price رو ۵ درصد کاهش بده",
+    "ستون price رو حذف کن",
+]
+ROUNDS = 200
+
+
+class PromptOnlyClient(RuleBasedAIClient):
+    """همان موتور محلی ولی مثل یک LLM راه‌دور فقط prompt متنی می‌گیرد."""
+
+    structured = False
+
+
+def excel_context(columns: int) -> dict:
+    analysis = {
+        f"col_{i}": {"index": i, "type": "numeric", "sample": [i * 10 + j for j in range(5)]}
+        for i in range(1, columns)
+    }
+    analysis["price"] = {"index": columns, "type": "numeric", "sample": [100, 200, 300, 400, 500]}
+    return {"sheets": ["Sheet"], "columns": analysis}
+
+
+def per_command_us(parser: IntentParser, context: dict) -> float:
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        for command in COMMANDS:
+            parser.parse(command, context)
+    return (time.perf_counter() - started) / (ROUNDS * len(COMMANDS)) * 1e6
+
+
+def main():
+    prompt_parser = IntentParser(PromptOnlyClient())
+    fast_parser = IntentParser(RuleBasedAIClient())
+    print(f"{'columns':>8} {'prompt µs/cmd':>14} {'structured µs/cmd':>18} {'speedup':>8}")
+    for count in COLUMN_COUNTS:
+        context = excel_context(count)
+        for command in COMMANDS:
+            assert prompt_parser.parse(command, context) == fast_parser.parse(command, context), command
+        prompt = per_command_us(prompt_parser, context)
+        fast = per_command_us(fast_parser, context)
+        print(f"{count:>8} {prompt:>14.1f} {fast:>18.1f} {prompt / fast:>7.1f}x")
+
+    cached_parser = IntentParser(PromptOnlyClient(), cache=BlueprintCache(":memory:"))
+    context = excel_context(COLUMN_COUNTS[-1])
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        for command in COMMANDS[:2]:
+            cached_parser.compile(command, context)
+    cached = (time.perf_counter() - started) / (ROUNDS * 2) * 1e6
+    cache = cached_parser.cache
+    print(f"\ncached compile() for a prompt-only client at {COLUMN_COUNTS[-1]} columns: {cached:.1f} µs/cmd, hits {cache.hits}, misses {cache.misses}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""هزینه هر پیام در تشخیص intent: حلقه regexهای جدا در برابر الگوی ترکیبی.
+
+اجرا: python benchmarks/bench_intent_detection.py
+"""
+from __future__ import annotations
+
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from bot.intent_detection import (  # noqa: E402
+    GROUP_MODE_KEYWORDS,
+    INTENT_KEYWORDS,
+    TARGET_KEYWORDS,
+    IntentDetectionEngine,
+    _rx,
+    compile_matcher,
+)
+
+MESSAGES = [
+    "📊 آنالیز",
+    "analyze",
+    "لطفا فایل را تحلیل کن",
+    "فیلتر ستون شهر",
+    "دریافت فایل نهایی",
+    "export",
+    "حذف گروهی سطر",
+    "افزودن ستون جدید به جدول",
+    "ویرایش چند سطر",
+    "یک متن معمولی بدون کلیدواژه که فقط طولانی است " * 3,
+    "column",
+    "راهنما",
+]
+VOCAB_SIZES = [9, 50, 200, 1000]
+ROUNDS = 2_000
+
+
+def _alternation(words) -> str:
+    return "(" + "|".join(_rx.escape(w) for w in words) + ")"
+
+
+def legacy_patterns(intents: dict[str, tuple[str, ...]]):
+    return {name: _rx.compile(_alternation(words), _rx.IGNORECASE) for name, words in intents.items()}
+
+
+def legacy_scan(text: str, patterns) -> tuple[str | None, str | None, str]:
+    """پیاده‌سازی قبلی: یک regex برای هر intent و جست‌وجوهای جدا برای target و mode."""
+
+    def target():
+        return next((t for t, w in TARGET_KEYWORDS.items() if _rx.search(_alternation(w), text, _rx.IGNORECASE)), None)
+
+    for name, pat in patterns.items():
+        if pat.search(text):
+            mode = "group" if _rx.search(_alternation(GROUP_MODE_KEYWORDS), text, _rx.IGNORECASE) else "single"
+            return name, target(), mode
+    return None, target(), "single"
+
+
+def grown_vocab(size: int) -> dict[str, tuple[str, ...]]:
+    vocab = dict(INTENT_KEYWORDS)
+    for i in range(size - len(vocab)):
+        vocab[f"custom{i}"] = (f"کلید{i}x", f"keyword{i}x")
+    return vocab
+
+
+def per_message_us(fn) -> float:
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        for msg in MESSAGES:
+            fn(msg)
+    return (time.perf_counter() - started) / (ROUNDS * len(MESSAGES)) * 1e6
+
+
+def main():
+    engine = IntentDetectionEngine()
+    engine.nlp = None  # فقط هزینه regex اندازه‌گیری شود
+    for msg in MESSAGES:
+        assert engine._scan(msg) == legacy_scan(msg, legacy_patterns(INTENT_KEYWORDS)), msg
+
+    print(f"{'intents':>8} {'legacy µs/msg':>14} {'combined µs/msg':>16} {'speedup':>8}")
+    for size in VOCAB_SIZES:
+        vocab = grown_vocab(size)
+        matcher = compile_matcher(vocab)
+        engine._matcher, engine._intent_order = matcher, list(vocab)
+        patterns = legacy_patterns(vocab)
+        legacy = per_message_us(lambda m: legacy_scan(m, patterns))
+        combined = per_message_us(engine._scan)
+        print(f"{size:>8} {legacy:>14.2f} {combined:>16.2f} {legacy / combined:>7.1f}x")
+
+    memo = IntentDetectionEngine(nlp_mode="off")
+    cached = per_message_us(memo.detect)
+    stats = memo.memo_stats()
+    print(f"\nmemoized detect(): {cached:.2f} µs/msg, hit rate {stats['hit_rate']:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""مقایسه حذف سطر به سطر openpyxl با حذف یک‌گذره (delete_rows_bulk).
+
+اجرا: python benchmarks/bench_row_compaction.py
+"""
+from __future__ import annotations
+
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from openpyxl import Workbook  # noqa: E402
+
+from core.excel_editor import delete_rows_bulk  # noqa: E402
+
+SIZES = [2_500, 5_000, 10_000, 20_000, 40_000, 80_000, 160_000]
+NAIVE_LIMIT = 5_000
+
+
+def build_sheet(rows: int):
+    ws = Workbook().active
+    ws.append(["name", "city", "price"])
+    for i in range(rows):
+        ws.append([f"item{i}", "Tehran" if i % 2 else "Shiraz", i])
+    return ws
+
+
+def odd_rows(rows: int) -> list[int]:
+    return list(range(3, rows + 2, 2))
+
+
+def bench(rows: int, naive: bool) -> float:
+    ws = build_sheet(rows)
+    drop = odd_rows(rows)
+    started = time.perf_counter()
+    if naive:
+        for r in reversed(drop):
+            ws.delete_rows(r, 1)
+    else:
+        delete_rows_bulk(ws, drop)
+    return time.perf_counter() - started
+
+
+def main():
+    print(f"{'rows':>8} {'bulk (s)':>10} {'µs/row':>8} {'naive (s)':>10}")
+    for rows in SIZES:
+        bulk = bench(rows, naive=False)
+        naive = f"{bench(rows, naive=True):10.3f}" if rows <= NAIVE_LIMIT else f"{'-':>10}"
+        print(f"{rows:>8} {bulk:10.3f} {bulk / rows * 1e6:8.2f} {naive}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""زمان راه‌اندازی سرد: import هندلرها و اولین تشخیص intent در یک پروسه تازه.
+
+اجرا: python benchmarks/bench_startup.py
+"""
+from __future__ import annotations
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+RUNS = 5
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import bot.handlers as h
+imported = time.perf_counter() - started
+started = time.perf_counter()
+h.intent_engine.detect("analyze column")
+first = time.perf_counter() - started
+started = time.perf_counter()
+h.intent_engine.detect(sys.argv[1])
+fallback = time.perf_counter() - started
+heavy = [m for m in ("spacy", "pandas", "numpy", "openpyxl") if m in sys.modules]
+print(json.dumps({"import": imported, "first_detect": first, "fallback": fallback, "heavy": heavy}))
+"""
+
+
+def probe(nlp_mode: str) -> list[dict]:
+    env = dict(os.environ, PYTHONPATH=str(ROOT), INTENT_NLP=nlp_mode)
+    results = []
+    with tempfile.TemporaryDirectory() as cwd:
+        for _ in range(RUNS):
+            out = subprocess.run(
+                [sys.executable, "-c", PROBE, "analyze"], cwd=cwd, env=env, capture_output=True, text=True, check=True
+            ).stdout
+            results.append(json.loads(out))
+    return results
+
+
+def main():
+    print(f"{'INTENT_NLP':>11} {'import ms':>10} {'1st detect ms':>14} {'spaCy fallback ms':>18}  loaded after fallback")
+    for mode in ["off", "lazy", "background"]:
+        runs = probe(mode)
+        med = {k: statistics.median(r[k] for r in runs) * 1000 for k in ("import", "first_detect", "fallback")}
+        print(f"{mode:>11} {med['import']:>10.0f} {med['first_detect']:>14.1f} {med['fallback']:>18.1f}  {','.join(runs[-1]['heavy']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
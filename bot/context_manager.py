@@ -2,10 +2,16 @@ from __future__ import annotations
 
 import json
 import sqlite3
-from collections import Counter, defaultdict
-from dataclasses import dataclass
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, replace
 from enum import Enum
 from pathlib import Path
+from typing import Callable
+
+from bot.state_store import KeyValueStore, StaleStateError, prefix_bounds
 
 
 class FSMState(str, Enum):
@@ -18,6 +24,144 @@ class FSMState(str, Enum):
     DONE = "DONE"
 
 
+# هر مهاجرت یک‌بار و به ترتیب اجرا می‌شود؛ نسخه در PRAGMA user_version ذخیره می‌شود
+MIGRATIONS: list[tuple[int, list[str]]] = [
+    (
+        1,
+        [
+            "CREATE INDEX IF NOT EXISTS idx_history_user_phase ON operation_history (user_id, phase, id)",
+            "CREATE INDEX IF NOT EXISTS idx_registry_user ON file_registry (user_id)",
+        ],
+    ),
+    (
+        2,
+        [
+            """
+            CREATE TABLE IF NOT EXISTS operation_rollup (
+                user_id INTEGER NOT NULL,
+                operation TEXT NOT NULL,
+                phase TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (user_id, operation, phase)
+            )
+            """,
+        ],
+    ),
+    (
+        3,
+        [
+            """
+            CREATE TABLE IF NOT EXISTS op_transitions (
+                user_id INTEGER NOT NULL,
+                from_op TEXT NOT NULL,
+                to_op TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (user_id, from_op, to_op)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS op_last (
+                user_id INTEGER PRIMARY KEY,
+                operation TEXT NOT NULL
+            )
+            """,
+            # تاریخچه موجود را یک‌بار به شمارش گذارها تبدیل می‌کنیم
+            """
+            INSERT INTO op_transitions (user_id, from_op, to_op, count)
+            SELECT user_id, prev, operation, COUNT(*) FROM (
+                SELECT user_id, operation,
+                       LAG(operation) OVER (PARTITION BY user_id ORDER BY id) AS prev
+                FROM operation_history WHERE phase = 'exit'
+            ) WHERE prev IS NOT NULL GROUP BY user_id, prev, operation
+            """,
+            """
+            INSERT INTO op_last (user_id, operation)
+            SELECT user_id, operation FROM operation_history h
+            WHERE phase = 'exit'
+              AND id = (SELECT MAX(id) FROM operation_history WHERE user_id = h.user_id AND phase = 'exit')
+            """,
+        ],
+    ),
+    (
+        4,
+        [
+            # تحلیل مشترک بین کاربران؛ کلید فقط hash محتوا و نسخه تحلیل‌گر است
+            """
+            CREATE TABLE IF NOT EXISTS analysis_cache (
+                content_hash TEXT NOT NULL,
+                analyzer_version INTEGER NOT NULL,
+                analysis_json TEXT NOT NULL,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (content_hash, analyzer_version)
+            )
+            """,
+        ],
+    ),
+    (
+        5,
+        [
+            "ALTER TABLE file_registry ADD COLUMN last_used_at REAL",
+            "UPDATE file_registry SET last_used_at = CAST(strftime('%s', created_at) AS REAL)",
+            "CREATE INDEX IF NOT EXISTS idx_registry_last_used ON file_registry (last_used_at)",
+        ],
+    ),
+    (
+        6,
+        [
+            # امتیاز میرای الگوی analyze -> filter که همراه op_last به‌روز می‌شود
+            "ALTER TABLE op_last ADD COLUMN export_score REAL NOT NULL DEFAULT 0",
+        ],
+    ),
+    (
+        7,
+        [
+            # state مشترک (context، فایل‌ها، تحلیل‌ها، مدل عملیات بعدی) سند JSON در KeyValueStore
+            # می‌شود؛ بدون store بیرونی همین جدول kv پشتیبان آن است
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, version INTEGER NOT NULL, value BLOB NOT NULL)",
+            """
+            INSERT OR IGNORE INTO kv (key, version, value)
+            SELECT 'context:' || user_id, 1, CAST(json_object(
+                'state', state, 'active_file_id', active_file_id, 'active_operation', active_operation
+            ) AS BLOB) FROM user_context
+            """,
+            """
+            INSERT OR IGNORE INTO kv (key, version, value)
+            SELECT 'file:' || file_id, 1, CAST(json_object(
+                'file_id', file_id, 'user_id', user_id, 'original_name', original_name,
+                'original_path', original_path, 'working_path', working_path, 'analyzed', analyzed,
+                'analysis_json', analysis_json, 'last_used_at', last_used_at
+            ) AS BLOB) FROM file_registry
+            """,
+            """
+            INSERT OR IGNORE INTO kv (key, version, value)
+            SELECT 'analysis:' || content_hash || ':' || analyzer_version, 1, CAST(analysis_json AS BLOB)
+            FROM analysis_cache
+            """,
+            """
+            INSERT OR IGNORE INTO kv (key, version, value)
+            SELECT 'next:' || u.user_id, 1, CAST(json_object(
+                'last', l.operation,
+                'score', COALESCE(l.export_score, 0),
+                'transitions', json(COALESCE((
+                    SELECT json_group_object(f.from_op, json(f.targets)) FROM (
+                        SELECT from_op, json_group_object(to_op, count) AS targets
+                        FROM op_transitions t WHERE t.user_id = u.user_id GROUP BY from_op
+                    ) f
+                ), '{}'))
+            ) AS BLOB)
+            FROM (SELECT user_id FROM op_last UNION SELECT user_id FROM op_transitions) u
+            LEFT JOIN op_last l ON l.user_id = u.user_id
+            """,
+            "DROP TABLE user_context",
+            "DROP TABLE file_registry",
+            "DROP TABLE analysis_cache",
+            "DROP TABLE op_transitions",
+            "DROP TABLE op_last",
+        ],
+    ),
+]
+
+
 @dataclass
 class UserContext:
     user_id: int
@@ -26,41 +170,212 @@ class UserContext:
     active_operation: str | None = None
 
 
+class _GroupCommit:
+    """یک اتصال SQLite که نوشتن‌هایش گروهی commit می‌شوند."""
+
+    def __init__(self, conn: sqlite3.Connection, durability: str, batch_size: int):
+        self.conn = conn
+        self.lock = threading.RLock()
+        self.durability = durability
+        self.batch_size = batch_size
+        self.pending = 0
+
+    def write(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        with self.lock:
+            # ردیف‌های RETURNING قبل از commit خوانده می‌شوند
+            rows = self.conn.execute(sql, params).fetchall()
+            self.pending += 1
+            if self.durability == "full" or self.pending >= self.batch_size:
+                self.commit()
+            return rows
+
+    def read(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def commit(self):
+        with self.lock:
+            if self.pending:
+                self.conn.commit()
+                self.pending = 0
+
+
+class _TableStore(KeyValueStore):
+    """KeyValueStore روی جدول kv همان context.db با commit گروهی؛ وقتی store بیرونی داده نشده."""
+
+    def __init__(self, db: _GroupCommit):
+        self._db = db
+
+    def get(self, key: str) -> tuple[int, bytes] | None:
+        rows = self._db.read("SELECT version, value FROM kv WHERE key = ?", (key,))
+        return (rows[0][0], bytes(rows[0][1])) if rows else None
+
+    def version(self, key: str) -> int:
+        rows = self._db.read("SELECT version FROM kv WHERE key = ?", (key,))
+        return rows[0][0] if rows else 0
+
+    def put(self, key: str, value: bytes, expected_version: int | None = None) -> int:
+        with self._db.lock:
+            if expected_version is None:
+                return self._db.write(
+                    "INSERT INTO kv (key, version, value) VALUES (?, 1, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET version = version + 1, value = excluded.value RETURNING version",
+                    (key, value),
+                )[0][0]
+            if self.version(key) != expected_version:
+                raise StaleStateError(key)
+            self._db.write(
+                "INSERT INTO kv (key, version, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET version = excluded.version, value = excluded.value",
+                (key, expected_version + 1, value),
+            )
+            return expected_version + 1
+
+    def delete(self, key: str):
+        self._db.write("DELETE FROM kv WHERE key = ?", (key,))
+
+    def keys(self, prefix: str) -> list[str]:
+        return [row[0] for row in self._db.read("SELECT key FROM kv WHERE key >= ? AND key < ? ORDER BY key", prefix_bounds(prefix))]
+
+
+def _flush_loop(ref, stop: threading.Event, interval: float):
+    while not stop.wait(interval):
+        manager = ref()
+        if manager is None:
+            return
+        manager.flush()
+        del manager
+
+
+def _close_connection(db: _GroupCommit, stop: threading.Event):
+    stop.set()
+    with db.lock:
+        db.conn.commit()
+        db.conn.close()
+
+
+def _dumps(doc) -> bytes:
+    return json.dumps(doc, ensure_ascii=False).encode("utf-8")
+
+
 class ContextManager:
-    def __init__(self, db_path: str = "storage/context.db"):
+    """FSM و حافظه کاربر؛ state مشترک روی KeyValueStore و تاریخچه روی SQLite محلی.
+
+    context کاربر، رکورد فایل‌ها، تحلیل‌های مشترک، مدل عملیات بعدی و فیلتر در انتظار
+    سند JSON در `store` هستند (کلیدهای ``context:<user>``، ``file:<file_id>``،
+    ``analysis:<hash>:<version>``، ``next:<user>`` و ``filter:<user>``). با store مشترک
+    (`create_store`: SQLite شاردشده یا سرویس HTTP) چند پروسه ربات state یکسان می‌بینند؛
+    بدون آن جدول kv همین دیتابیس پشتیبان است.
+
+    operation_history در SQLite در حالت WAL با group commit نوشته می‌شود: نوشتن‌ها
+    بلافاصله روی همان اتصال اجرا می‌شوند ولی commit هر `flush_interval_ms` یا بعد از
+    `batch_size` دستور توسط نخ پس‌زمینه انجام می‌شود. با `durability="full"` هر نوشتن
+    بلافاصله commit می‌شود.
+
+    UserContextها در یک کش LRU با TTL بیکاری نگه داشته می‌شوند (write-through)؛ فقط
+    context تغییرکرده نوشته می‌شود. با store مشترک هر برداشت از کش با نسخه سند در store
+    مقایسه می‌شود تا تغییر پروسه‌های دیگر دیده شود.
+    """
+
+    # دو بار analyze -> filter با فاصله حدود ۱۳ عملیات به آستانه می‌رسد و بعد از
+    # حدود ۶ عملیات دیگر بدون این الگو زیر آستانه می‌رود
+    EXPORT_HINT_PATTERN = ("analyze", "filter")
+    EXPORT_HINT_DECAY = 0.95
+    EXPORT_HINT_THRESHOLD = 1.5
+
+    def __init__(
+        self,
+        db_path: str = "storage/context.db",
+        durability: str = "group",
+        flush_interval_ms: int = 50,
+        batch_size: int = 64,
+        context_cache_size: int = 1024,
+        context_ttl: float = 1800.0,
+        history_keep: int = 500,
+        compact_every: int = 10_000,
+        store: KeyValueStore | None = None,
+    ):
+        if durability not in {"group", "full"}:
+            raise ValueError(f"durability نامعتبر: {durability}")
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
-        self.conn = sqlite3.connect(self.db_path)
-        self.conn.row_factory = sqlite3.Row
-        self._init_db()
-        self.pattern_counter: defaultdict[int, Counter] = defaultdict(Counter)
+        self.durability = durability
+        self.batch_size = batch_size
+        self.conn = self._connect(self.db_path)
+        self._db = _GroupCommit(self.conn, durability, batch_size)
+        self._lock = self._db.lock
+        self._stop = threading.Event()
+        self.context_cache_size = context_cache_size
+        self.context_ttl = context_ttl
+        # user_id -> (context، نسخه سند در store، آخرین دسترسی)
+        self._contexts: OrderedDict[int, tuple[UserContext, int, float]] = OrderedDict()
+        self.history_keep = history_keep
+        self.compact_every = compact_every
+        self._logged_since_compact = 0
+        self._compact_guard = threading.Lock()
+        self._compact_thread: threading.Thread | None = None
+        self._init_db(self.conn)
+        self.shared = store is not None
+        self.store = store if store is not None else _TableStore(self._db)
+        self._finalizer = weakref.finalize(self, _close_connection, self._db, self._stop)
+        if durability == "group":
+            threading.Thread(
+                target=_flush_loop,
+                args=(weakref.ref(self), self._stop, flush_interval_ms / 1000),
+                name="context-db-flush",
+                daemon=True,
+            ).start()
 
-    def _init_db(self):
-        cur = self.conn.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_context (
-                user_id INTEGER PRIMARY KEY,
-                state TEXT NOT NULL,
-                active_file_id TEXT,
-                active_operation TEXT
+    def _connect(self, path: Path) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={'FULL' if self.durability == 'full' else 'NORMAL'}")
+        return conn
+
+    def _write(self, sql: str, params: tuple = ()):
+        self._db.write(sql, params)
+
+    def _read(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        return self._db.read(sql, params)
+
+    def flush(self):
+        self._db.commit()
+
+    def close(self):
+        thread = self._compact_thread
+        if thread is not None:
+            thread.join()
+        self._finalizer()
+
+    def _init_db(self, conn: sqlite3.Connection):
+        cur = conn.cursor()
+        if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            # جدول‌های نسخه اول؛ مهاجرت‌ها آن‌ها را تغییر می‌دهند و در نسخه ۷ به kv منتقل می‌کنند
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS user_context (
+                    user_id INTEGER PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    active_file_id TEXT,
+                    active_operation TEXT
+                )
+                """
             )
-            """
-        )
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS file_registry (
-                file_id TEXT PRIMARY KEY,
-                user_id INTEGER NOT NULL,
-                original_name TEXT NOT NULL,
-                original_path TEXT NOT NULL,
-                working_path TEXT NOT NULL,
-                analyzed INTEGER NOT NULL DEFAULT 0,
-                analysis_json TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS file_registry (
+                    file_id TEXT PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    original_name TEXT NOT NULL,
+                    original_path TEXT NOT NULL,
+                    working_path TEXT NOT NULL,
+                    analyzed INTEGER NOT NULL DEFAULT 0,
+                    analysis_json TEXT,
+                    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+                """
             )
-            """
-        )
         cur.execute(
             """
             CREATE TABLE IF NOT EXISTS operation_history (
@@ -73,83 +388,299 @@ class ContextManager:
             )
             """
         )
-        self.conn.commit()
+        conn.commit()
+        self._migrate(conn)
+
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, statements in MIGRATIONS:
+            if target <= version:
+                continue
+            with conn:
+                for sql in statements:
+                    conn.execute(sql)
+                conn.execute(f"PRAGMA user_version = {target}")
+            version = target
+
+    @property
+    def schema_version(self) -> int:
+        return self._read("PRAGMA user_version")[0][0]
+
+    def _load(self, key: str) -> dict | None:
+        found = self.store.get(key)
+        return json.loads(found[1]) if found else None
+
+    def _update(self, key: str, change: Callable[[dict], None], create: bool = False) -> dict | None:
+        """خواندن، تغییر و نوشتن سند با کنترل نسخه؛ اگر پروسه دیگری زودتر نوشت دوباره تلاش می‌کند."""
+        while True:
+            found = self.store.get(key)
+            if found is None and not create:
+                return None
+            version, doc = (found[0], json.loads(found[1])) if found else (0, {})
+            change(doc)
+            try:
+                self.store.put(key, _dumps(doc), version)
+            except StaleStateError:
+                continue
+            return doc
+
+    @staticmethod
+    def _context_key(user_id: int) -> str:
+        return f"context:{user_id}"
+
+    def _cached_context(self, user_id: int) -> UserContext | None:
+        entry = self._contexts.get(user_id)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if now - entry[2] > self.context_ttl or (self.shared and self.store.version(self._context_key(user_id)) != entry[1]):
+            del self._contexts[user_id]
+            return None
+        self._contexts[user_id] = (entry[0], entry[1], now)
+        self._contexts.move_to_end(user_id)
+        return entry[0]
+
+    def _remember_context(self, ctx: UserContext, version: int):
+        now = time.monotonic()
+        self._contexts[ctx.user_id] = (replace(ctx), version, now)
+        self._contexts.move_to_end(ctx.user_id)
+        # ترتیب OrderedDict همان ترتیب آخرین دسترسی است؛ قدیمی‌ترها اول‌اند
+        while self._contexts:
+            oldest, (_, _, seen) = next(iter(self._contexts.items()))
+            if len(self._contexts) <= self.context_cache_size and now - seen <= self.context_ttl:
+                break
+            del self._contexts[oldest]
 
     def get_user_context(self, user_id: int) -> UserContext:
-        cur = self.conn.cursor()
-        row = cur.execute("SELECT * FROM user_context WHERE user_id = ?", (user_id,)).fetchone()
-        if not row:
-            ctx = UserContext(user_id=user_id)
-            self.upsert_user_context(ctx)
-            return ctx
-        return UserContext(
-            user_id=user_id,
-            state=FSMState(row["state"]),
-            active_file_id=row["active_file_id"],
-            active_operation=row["active_operation"],
-        )
+        with self._lock:
+            ctx = self._cached_context(user_id)
+            if ctx is None:
+                found = self.store.get(self._context_key(user_id))
+                version, ctx = 0, UserContext(user_id=user_id)
+                if found:
+                    version, doc = found[0], json.loads(found[1])
+                    ctx = UserContext(
+                        user_id=user_id,
+                        state=FSMState(doc["state"]),
+                        active_file_id=doc["active_file_id"],
+                        active_operation=doc["active_operation"],
+                    )
+                self._remember_context(ctx, version)
+            return replace(ctx)
 
     def upsert_user_context(self, ctx: UserContext):
-        self.conn.execute(
-            """
-            INSERT INTO user_context (user_id, state, active_file_id, active_operation)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-              state=excluded.state,
-              active_file_id=excluded.active_file_id,
-              active_operation=excluded.active_operation
-            """,
-            (ctx.user_id, ctx.state.value, ctx.active_file_id, ctx.active_operation),
-        )
-        self.conn.commit()
+        with self._lock:
+            if self._cached_context(ctx.user_id) == ctx:
+                return
+            doc = {"state": ctx.state.value, "active_file_id": ctx.active_file_id, "active_operation": ctx.active_operation}
+            self._remember_context(ctx, self.store.put(self._context_key(ctx.user_id), _dumps(doc)))
 
     def register_file(self, user_id: int, file_id: str, original_name: str, original_path: str, working_path: str):
-        self.conn.execute(
-            """
-            INSERT OR REPLACE INTO file_registry
-            (file_id, user_id, original_name, original_path, working_path, analyzed)
-            VALUES (?, ?, ?, ?, ?, 0)
-            """,
-            (file_id, user_id, original_name, original_path, working_path),
-        )
-        self.conn.commit()
+        record = {
+            "file_id": file_id,
+            "user_id": user_id,
+            "original_name": original_name,
+            "original_path": original_path,
+            "working_path": working_path,
+            "analyzed": 0,
+            "analysis_json": None,
+            "last_used_at": time.time(),
+        }
+        self.store.put(f"file:{file_id}", _dumps(record))
+
+    def touch_file(self, file_id: str, now: float | None = None):
+        used_at = time.time() if now is None else now
+        self._update(f"file:{file_id}", lambda record: record.update(last_used_at=used_at))
+
+    def list_files(self) -> list[dict]:
+        files = []
+        for key in self.store.keys("file:"):
+            record = self._load(key)
+            if record is not None:
+                files.append(record)
+        return files
+
+    def _user_contexts(self):
+        for key in self.store.keys("context:"):
+            doc = self._load(key)
+            if doc is not None:
+                yield key, doc
+
+    def active_file_ids(self) -> set[str]:
+        return {doc["active_file_id"] for _, doc in self._user_contexts() if doc["active_file_id"]}
+
+    def delete_files(self, file_ids: list[str]):
+        """رکورد فایل‌ها را حذف و کاربرانی را که روی آن فایل بودند به IDLE برمی‌گرداند."""
+        if not file_ids:
+            return
+        dropped = set(file_ids)
+        for file_id in file_ids:
+            self.store.delete(f"file:{file_id}")
+
+        def release(doc: dict):
+            if doc["active_file_id"] in dropped:
+                doc.update(state=FSMState.IDLE.value, active_file_id=None, active_operation=None)
+
+        with self._lock:
+            for key, doc in self._user_contexts():
+                if doc["active_file_id"] in dropped:
+                    self._update(key, release)
+            for user_id in [uid for uid, (ctx, _, _) in self._contexts.items() if ctx.active_file_id in dropped]:
+                del self._contexts[user_id]
+            self.flush()
 
     def mark_analyzed(self, file_id: str, analysis: dict):
-        self.conn.execute(
-            "UPDATE file_registry SET analyzed = 1, analysis_json = ? WHERE file_id = ?",
-            (json.dumps(analysis, ensure_ascii=False), file_id),
-        )
-        self.conn.commit()
+        payload = json.dumps(analysis, ensure_ascii=False)
+        self._update(f"file:{file_id}", lambda record: record.update(analyzed=1, analysis_json=payload))
+
+    def invalidate_analysis(self, file_id: str):
+        """بعد از تغییر نسخه کاری، تحلیل ذخیره‌شده آن فایل دیگر معتبر نیست."""
+        self._update(f"file:{file_id}", lambda record: record.update(analyzed=0, analysis_json=None))
+
+    def get_cached_analysis(self, content_hash: str, analyzer_version: int) -> dict | None:
+        return self._load(f"analysis:{content_hash}:{analyzer_version}")
+
+    def store_analysis(self, content_hash: str, analyzer_version: int, analysis: dict):
+        self.store.put(f"analysis:{content_hash}:{analyzer_version}", _dumps(analysis))
 
-    def get_file_record(self, file_id: str) -> sqlite3.Row | None:
-        return self.conn.execute("SELECT * FROM file_registry WHERE file_id = ?", (file_id,)).fetchone()
+    def get_file_record(self, file_id: str) -> dict | None:
+        return self._load(f"file:{file_id}")
+
+    def set_pending_filter(self, user_id: int, pending: dict):
+        """فیلتر نیمه‌کاره کاربر؛ در store است تا پیام بعدی در هر پروسه‌ای ادامه یابد."""
+        self.store.put(f"filter:{user_id}", _dumps(pending))
+
+    def get_pending_filter(self, user_id: int) -> dict | None:
+        return self._load(f"filter:{user_id}")
+
+    def clear_pending_filter(self, user_id: int):
+        self.store.delete(f"filter:{user_id}")
 
     def log_operation(self, user_id: int, file_id: str | None, operation: str, phase: str):
-        self.conn.execute(
+        self._write(
             "INSERT INTO operation_history (user_id, file_id, operation, phase) VALUES (?, ?, ?, ?)",
             (user_id, file_id, operation, phase),
         )
-        self.conn.commit()
         if phase == "exit":
-            self.pattern_counter[user_id][operation] += 1
+            self._record_transition(user_id, operation)
+        self._logged_since_compact += 1
+        if self.compact_every and self._logged_since_compact >= self.compact_every:
+            self._logged_since_compact = 0
+            self.compact_in_background()
+
+    def compact_in_background(self) -> threading.Thread:
+        """`compact_history` در یک نخ جدا تا مسیر نوشتن (و event loop ربات) منتظر اسکن کل جدول نماند."""
+        with self._lock:
+            if self._compact_thread is None or not self._compact_thread.is_alive():
+                self._compact_thread = threading.Thread(target=self.compact_history, name="context-db-compact", daemon=True)
+                self._compact_thread.start()
+            return self._compact_thread
+
+    def _record_transition(self, user_id: int, operation: str):
+        def change(doc: dict):
+            prev = doc.get("last")
+            score = 0.0
+            if prev is not None:
+                targets = doc.setdefault("transitions", {}).setdefault(prev, {})
+                targets[operation] = targets.get(operation, 0) + 1
+                score = doc.get("score", 0.0) * self.EXPORT_HINT_DECAY
+                if (prev, operation) == self.EXPORT_HINT_PATTERN:
+                    score += 1
+            doc.update(last=operation, score=score)
+
+        self._update(f"next:{user_id}", change, create=True)
+
+    def transition_count(self, user_id: int, from_op: str, to_op: str) -> int:
+        doc = self._load(f"next:{user_id}") or {}
+        return doc.get("transitions", {}).get(from_op, {}).get(to_op, 0)
+
+    def next_action_hints(self, user_id: int, min_count: int = 2) -> tuple[bool, str | None]:
+        """پیشنهاد Export و محتمل‌ترین عملیات بعدی با یک خواندن سند ``next:<user>``.
+
+        عملیات بعدی از زنجیره مارکوف مرتبه اول می‌آید؛ پیشنهاد Export از امتیاز میرای
+        الگوی analyze -> filter که `_record_transition` نگه می‌دارد (هر عملیات امتیاز را
+        در `EXPORT_HINT_DECAY` ضرب می‌کند، پس الگوی قدیمی خودبه‌خود کنار می‌رود).
+        """
+        doc = self._load(f"next:{user_id}")
+        if not doc:
+            return False, None
+        suggest = doc.get("score", 0.0) >= self.EXPORT_HINT_THRESHOLD
+        targets = doc.get("transitions", {}).get(doc.get("last"), {})
+        ranked = sorted(targets.items(), key=lambda item: (-item[1], item[0]))
+        return suggest, ranked[0][0] if ranked and ranked[0][1] >= min_count else None
+
+    def predict_next_action(self, user_id: int, min_count: int = 2) -> str | None:
+        return self.next_action_hints(user_id, min_count)[1]
+
+    def compact_history(self, keep_last: int | None = None, batch_size: int = 2000) -> int:
+        """ردیف‌های قدیمی‌تر از `keep_last` عملیات آخر هر کاربر را در operation_rollup جمع می‌کند.
+
+        اسکن پنجره‌ای روی یک اتصال خواندنی جدا و بدون قفل انجام می‌شود (در WAL خواننده
+        نویسنده‌ها را معطل نمی‌کند) و فقط یک id مرز برای هر کاربر برمی‌گرداند؛ حذف با
+        `DELETE ... WHERE rowid IN (SELECT ... LIMIT batch_size)` در دسته‌های کوچک و هر
+        دسته با یک commit کوتاه است، پس حافظه با حجم جدول بزرگ نمی‌شود.
+        """
+        keep = self.history_keep if keep_last is None else keep_last
+        with self._compact_guard:
+            self.flush()
+            removed = 0
+            reader = sqlite3.connect(self.db_path)
+            try:
+                # برای هر کاربر فقط id مرز (جدیدترین ردیف حذفی) از روی cursor خوانده می‌شود
+                cutoffs = reader.execute(
+                    """
+                    SELECT user_id, id FROM (
+                        SELECT user_id, id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY id DESC) AS rn
+                        FROM operation_history
+                    ) WHERE rn = ?
+                    """,
+                    (keep + 1,),
+                )
+                batch = "SELECT id FROM operation_history WHERE user_id = ? AND id <= ? ORDER BY id LIMIT ?"
+                for user_id, cutoff in cutoffs:
+                    while True:
+                        params = (user_id, cutoff, batch_size)
+                        with self._lock:
+                            self.conn.execute(
+                                f"""
+                                INSERT INTO operation_rollup (user_id, operation, phase, count)
+                                SELECT user_id, operation, phase, COUNT(*) FROM operation_history
+                                WHERE rowid IN ({batch}) GROUP BY user_id, operation, phase
+                                ON CONFLICT(user_id, operation, phase) DO UPDATE SET count = count + excluded.count
+                                """,
+                                params,
+                            )
+                            deleted = self.conn.execute(f"DELETE FROM operation_history WHERE rowid IN ({batch})", params).rowcount
+                            self.conn.commit()
+                            self._db.pending = 0
+                        removed += deleted
+                        if deleted < batch_size:
+                            break
+            finally:
+                reader.close()
+            return removed
+
+    def operation_counts(self, user_id: int, phase: str = "exit") -> Counter:
+        counts = Counter()
+        for row in self._read("SELECT operation, count FROM operation_rollup WHERE user_id = ? AND phase = ?", (user_id, phase)):
+            counts[row["operation"]] += row["count"]
+        for row in self._read(
+            "SELECT operation, COUNT(*) AS count FROM operation_history WHERE user_id = ? AND phase = ? GROUP BY operation",
+            (user_id, phase),
+        ):
+            counts[row["operation"]] += row["count"]
+        return counts
 
     def last_operations(self, user_id: int, limit: int = 10) -> list[str]:
-        rows = self.conn.execute(
+        rows = self._read(
             "SELECT operation FROM operation_history WHERE user_id = ? AND phase = 'exit' ORDER BY id DESC LIMIT ?",
             (user_id, limit),
-        ).fetchall()
+        )
         return [r["operation"] for r in rows]
 
     def should_suggest_export(self, user_id: int) -> bool:
-        ops = list(reversed(self.last_operations(user_id, 12)))
-        if len(ops) < 2:
-            return False
-        # deterministic pattern learning: analyze -> filter frequently
-        transitions = 0
-        for i in range(len(ops) - 1):
-            if ops[i] == "analyze" and ops[i + 1] == "filter":
-                transitions += 1
-        return transitions >= 2
+        return self.next_action_hints(user_id)[0]
 
     def reset_user(self, user_id: int):
         ctx = self.get_user_context(user_id)
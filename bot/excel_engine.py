@@ -2,63 +2,86 @@ from __future__ import annotations
 
 import hashlib
 import json
-import shutil
 from pathlib import Path
 
-from openpyxl import load_workbook
+from core.blob_store import BlobStore, atomic_write, clone_file
+from core.filter_engine import FilterQuery, load_columns
+from core.workbook_cache import DEFAULT_EXPANSION, WorkbookCache, analysis_cost, workbook_cache
 
 
 class ExcelEngine:
-    def __init__(self, base_dir: str = "storage/uploads"):
+    # با هر تغییر در خروجی analyze افزایش یابد تا analysis_cache قدیمی استفاده نشود
+    ANALYZER_VERSION = 1
+
+    def __init__(self, base_dir: str = "storage/uploads", cache: WorkbookCache | None = None, blob_store: BlobStore | None = None):
         self.base_dir = Path(base_dir)
         self.base_dir.mkdir(parents=True, exist_ok=True)
+        self.cache = cache or workbook_cache
+        self.blobs = blob_store or BlobStore(str(self.base_dir.parent / "blobs"))
+
+    def __getstate__(self):
+        # در worker process از کش سراسری همان process استفاده می‌شود
+        return {"base_dir": self.base_dir, "blobs": self.blobs}
+
+    def __setstate__(self, state):
+        self.base_dir = state["base_dir"]
+        self.blobs = state["blobs"]
+        self.cache = workbook_cache
 
     def store_original_and_working(self, user_id: int, filename: str, content: bytes) -> tuple[str, str, str]:
-        file_hash = hashlib.sha256(content).hexdigest()[:16]
-        file_id = f"u{user_id}_{file_hash}"
+        digest = hashlib.sha256(content).hexdigest()
+        file_id = f"u{user_id}_{digest[:16]}"
         original_path = self.base_dir / f"{file_id}_original_{filename}"
         working_path = self.base_dir / f"{file_id}_working_{filename}"
-        original_path.write_bytes(content)
-        working_path.write_bytes(content)
+        self.blobs.put_bytes(content, original_path, working_path, digest=digest)
         return file_id, str(original_path), str(working_path)
 
-    def analyze(self, file_path: str) -> dict:
-        wb = load_workbook(file_path)
-        sheets = []
-        for ws in wb.worksheets:
-            headers = [ws.cell(1, i).value for i in range(1, ws.max_column + 1)]
-            sheets.append(
-                {
-                    "name": ws.title,
-                    "rows": ws.max_row,
-                    "cols": ws.max_column,
-                    "headers": headers,
-                }
-            )
-        return {"sheets": sheets}
-
-    def filter_contains(self, working_path: str, sheet_name: str, column_name: str, keyword: str):
-        wb = load_workbook(working_path)
+    def content_hash(self, file_path: str) -> str:
+        return self.cache.digest_path(file_path)
+
+    def analyze(self, file_path: str, file_id: str | None = None) -> dict:
+        from core.excel_reader import scan_workbook
+
+        key = ("analysis", file_id, self.cache.digest_path(file_path))
+        return self.cache.get_or_load(key, lambda: scan_workbook(file_path), analysis_cost)
+
+    def filter_contains(self, working_path: str, sheet_name: str, column_name: str, keyword: str, file_id: str | None = None):
+        return self.filter_rows(working_path, sheet_name, FilterQuery.contains(column_name, keyword), file_id)
+
+    def filter_rows(self, working_path: str, sheet_name: str, query: FilterQuery | str, file_id: str | None = None) -> int:
+        import numpy as np
+
+        from core.excel_editor import delete_rows_bulk
+
+        if isinstance(query, str):
+            query = FilterQuery.parse(query)
+        wb = self._take_workbook(working_path, file_id)
         ws = wb[sheet_name]
         headers = [str(ws.cell(1, i).value or "") for i in range(1, ws.max_column + 1)]
-        if column_name not in headers:
-            raise ValueError(f"ستون {column_name} یافت نشد")
-        col_idx = headers.index(column_name) + 1
+        frame = load_columns(ws, headers, query.columns())
+        keep = query.mask(frame)
+        delete_rows_bulk(ws, (np.flatnonzero(~keep) + 2).tolist())
+        self._save_workbook(wb, working_path, file_id)
+        return int(keep.sum())
 
-        delete_rows = []
-        for r in range(2, ws.max_row + 1):
-            val = str(ws.cell(r, col_idx).value or "")
-            if keyword not in val:
-                delete_rows.append(r)
+    def _take_workbook(self, path: str, file_id: str | None):
+        # workbook از کش برداشته می‌شود چون قرار است تغییر کند
+        from openpyxl import load_workbook
 
-        for r in reversed(delete_rows):
-            ws.delete_rows(r, 1)
+        wb = self.cache.take(("workbook", file_id, self.cache.digest_path(path)))
+        return wb if wb is not None else load_workbook(path)
 
-        wb.save(working_path)
+    def _save_workbook(self, wb, path: str, file_id: str | None):
+        # جایگزینی اتمیک، لینک مشترک با blob/original را می‌شکند (copy-on-write)
+        atomic_write(path, wb.save)
+        digest = self.cache.digest_path(path, refresh=True)
+        self.cache.put(("workbook", file_id, digest), wb, Path(path).stat().st_size * DEFAULT_EXPANSION)
 
     def export(self, working_path: str, output_name: str) -> str:
-        out_path = self.base_dir / output_name
-        shutil.copy2(working_path, out_path)
+        # پیشوند file_id باعث می‌شود خروجی کاربران هم‌نام روی هم ننویسند و قابل پاک‌سازی باشند
+        prefix, sep, _ = Path(working_path).name.partition("_working_")
+        out_path = self.base_dir / (f"{prefix}_export_{output_name}" if sep else output_name)
+        clone_file(working_path, out_path)
         return str(out_path)
 
     @staticmethod
@@ -1,6 +1,10 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import asyncio
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass
 
 from telegram import Update
 from telegram.ext import ContextTypes
@@ -9,22 +13,88 @@ from bot.context_manager import ContextManager, FSMState
 from bot.decision_engine import DecisionEngine
 from bot.excel_engine import ExcelEngine
 from bot.intent_detection import Intent, IntentDetectionEngine
+from bot.state_store import create_store
+from bot.storage_manager import StorageManager
 from bot.ui_renderer import UIRenderer
+from bot.worker_pool import ExcelWorkerPool, WorkerPoolBusy
+from core.filter_engine import FilterQuery
 
-ctx_manager = ContextManager()
-intent_engine = IntentDetectionEngine()
-decision_engine = DecisionEngine(ctx_manager)
-excel_engine = ExcelEngine()
+
+class _Lazy:
+    """کامپوننت در اولین استفاده ساخته می‌شود تا import این ماژول دیتابیس و پوشه‌ها را نسازد."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+ctx_manager = _Lazy(
+    lambda: ContextManager(
+        durability=os.getenv("CONTEXT_DB_DURABILITY", "group"),
+        flush_interval_ms=int(os.getenv("CONTEXT_DB_FLUSH_MS", "50")),
+        history_keep=int(os.getenv("CONTEXT_HISTORY_KEEP", "500")),
+        context_cache_size=int(os.getenv("CONTEXT_CACHE_SIZE", "1024")),
+        # state مشترک بین پروسه‌ها؛ خالی یعنی جدول kv همان context.db
+        store=create_store(os.getenv("STATE_STORE_URL")),
+    )
+)
+intent_engine = _Lazy(lambda: IntentDetectionEngine(nlp_mode=os.getenv("INTENT_NLP", "background")))
+decision_engine = _Lazy(lambda: DecisionEngine(ctx_manager.get()))
+excel_engine = _Lazy(ExcelEngine)
 ui = UIRenderer()
+storage_manager = _Lazy(
+    lambda: StorageManager(
+        ctx_manager.get(),
+        uploads_dir=str(excel_engine.base_dir),
+        blob_store=excel_engine.blobs,
+        user_quota_bytes=int(os.getenv("STORAGE_USER_QUOTA_MB", "200")) * 1024 * 1024,
+        global_quota_bytes=int(os.getenv("STORAGE_GLOBAL_QUOTA_MB", "2048")) * 1024 * 1024,
+        max_age_seconds=float(os.getenv("STORAGE_MAX_AGE_HOURS", "168")) * 3600,
+        interval_seconds=float(os.getenv("STORAGE_GC_INTERVAL", "600")),
+    )
+)
+worker_pool = ExcelWorkerPool(
+    max_workers=int(os.getenv("EXCEL_WORKERS", "0")) or None,
+    use_processes=os.getenv("EXCEL_WORKER_MODE", "thread") == "process",
+    max_pending=int(os.getenv("EXCEL_WORKER_QUEUE", "32")),
+    timeout=float(os.getenv("EXCEL_JOB_TIMEOUT", "120")),
+)
 
 
 @dataclass
 class PendingFilter:
     column: str | None = None
     keyword: str | None = None
+    query: str | None = None
 
+    def to_query(self) -> FilterQuery:
+        if self.query:
+            return FilterQuery.parse(self.query)
+        return FilterQuery.contains(self.column, self.keyword or "")
 
-pending_filters: dict[int, PendingFilter] = {}
+
+def _pending_filter(user_id: int) -> PendingFilter:
+    pending = ctx_manager.get_pending_filter(user_id)
+    return PendingFilter(**pending) if pending else PendingFilter()
+
+
+def _looks_like_query(text: str) -> bool:
+    try:
+        FilterQuery.parse(text)
+    except ValueError:
+        return False
+    return True
 
 
 def _context(user_id: int):
@@ -34,14 +104,14 @@ def _context(user_id: int):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     ctx = _context(user_id)
-    suggest_export = ctx_manager.should_suggest_export(user_id)
+    suggest_export, suggested_action = ctx_manager.next_action_hints(user_id)
     await update.effective_message.reply_text(
         "به excel_ai_bot خوش آمدی.\nاین نسخه کاملاً آفلاین و rule-based/NLP سبک است.",
         reply_markup=ui.reply_menu(ctx),
     )
     await update.effective_message.reply_text(
         "منوی شناور:",
-        reply_markup=ui.inline_menu(ctx, suggest_export=suggest_export),
+        reply_markup=ui.inline_menu(ctx, suggest_export=suggest_export, suggested_action=suggested_action),
     )
 
 
@@ -101,7 +171,7 @@ async def _execute_decision(update: Update, context: ContextTypes.DEFAULT_TYPE,
             await update.effective_message.reply_text("اول باید فایل را analyze کنی.")
         elif decision.action == "reset":
             ctx_manager.reset_user(user_id)
-            pending_filters.pop(user_id, None)
+            ctx_manager.clear_pending_filter(user_id)
             await update.effective_message.reply_text("سشن ریست شد.")
         elif decision.action == "back":
             ctx.state = FSMState.ANALYZED if ctx.active_file_id else FSMState.IDLE
@@ -114,50 +184,85 @@ async def _execute_decision(update: Update, context: ContextTypes.DEFAULT_TYPE,
         if not record:
             await update.effective_message.reply_text("فایل فعالی ندارید.")
             return
+        try:
+            await _execute_excel(update, context, decision, ctx, record)
+        except WorkerPoolBusy as exc:
+            await update.effective_message.reply_text(f"⏳ {exc}")
+        except asyncio.TimeoutError:
+            await update.effective_message.reply_text("⏳ پردازش فایل بیش از حد طول کشید؛ دوباره تلاش کنید.")
+        return
 
-        if decision.action == "analyze":
-            if record["analyzed"] == 1 and record["analysis_json"]:
-                import json
+    await update.effective_message.reply_text("دستور قابل اجرا نیست.")
 
-                analysis = json.loads(record["analysis_json"])
-            else:
-                analysis = excel_engine.analyze(record["working_path"])
-                ctx_manager.mark_analyzed(ctx.active_file_id, analysis)
-            ctx.state = FSMState.ANALYZED
-            ctx_manager.upsert_user_context(ctx)
-            ctx_manager.log_operation(user_id, ctx.active_file_id, "analyze", "exit")
-            await update.effective_message.reply_text(ui.analysis_text(analysis), reply_markup=ui.inline_menu(ctx, ctx_manager.should_suggest_export(user_id)))
-            return
 
-        if decision.action == "filter":
-            pf = pending_filters.setdefault(user_id, PendingFilter())
-            if not pf.column:
-                ctx.state = FSMState.FILTERING
-                ctx_manager.upsert_user_context(ctx)
-                await update.effective_message.reply_text(
-                    "فیلتر: نام ستون و کلیدواژه را با فرمت زیر بفرست:\ncolumn=<name>;keyword=<text>"
-                )
-                return
-            excel_engine.filter_contains(record["working_path"], excel_engine.analyze(record["working_path"])["sheets"][0]["name"], pf.column, pf.keyword or "")
-            pending_filters.pop(user_id, None)
-            ctx.state = FSMState.READY_EXPORT
-            ctx_manager.upsert_user_context(ctx)
-            ctx_manager.log_operation(user_id, ctx.active_file_id, "filter", "exit")
-            suggest = ctx_manager.should_suggest_export(user_id)
-            msg = "✅ فیلتر اعمال شد."
-            if suggest:
-                msg += "\n💡 با توجه به روند قبلی‌ات، الان Export پیشنهاد می‌شود."
-            await update.effective_message.reply_text(msg, reply_markup=ui.inline_menu(ctx, suggest_export=suggest))
-            return
+async def _load_analysis(file_id: str, record) -> dict:
+    if record["analyzed"] == 1 and record["analysis_json"]:
+        return json.loads(record["analysis_json"])
+    # همان فایل که کاربران دیگر فرستاده‌اند بدون parse دوباره تحلیل می‌شود
+    digest = await asyncio.to_thread(excel_engine.content_hash, record["working_path"])
+    analysis = ctx_manager.get_cached_analysis(digest, ExcelEngine.ANALYZER_VERSION)
+    if analysis is None:
+        analysis = await worker_pool.run(excel_engine.analyze, record["working_path"], file_id)
+        ctx_manager.store_analysis(digest, ExcelEngine.ANALYZER_VERSION, analysis)
+    ctx_manager.mark_analyzed(file_id, analysis)
+    return analysis
 
-        if decision.action == "export":
-            out_path = excel_engine.export(record["working_path"], record["original_name"])
-            with open(out_path, "rb") as fh:
-                await context.bot.send_document(chat_id=user_id, document=fh, filename=record["original_name"], caption="فایل خروجی")
-            ctx.state = FSMState.DONE
+
+async def _execute_excel(update: Update, context: ContextTypes.DEFAULT_TYPE, decision, ctx, record):
+    user_id = update.effective_user.id
+    ctx_manager.touch_file(ctx.active_file_id)
+    if decision.action == "analyze":
+        analysis = await _load_analysis(ctx.active_file_id, record)
+        ctx.state = FSMState.ANALYZED
+        ctx_manager.upsert_user_context(ctx)
+        ctx_manager.log_operation(user_id, ctx.active_file_id, "analyze", "exit")
+        suggest, suggested_action = ctx_manager.next_action_hints(user_id)
+        await update.effective_message.reply_text(
+            ui.analysis_text(analysis),
+            reply_markup=ui.inline_menu(ctx, suggest, suggested_action),
+        )
+        return
+
+    if decision.action == "filter":
+        pf = _pending_filter(user_id)
+        if not pf.column and not pf.query:
+            ctx.state = FSMState.FILTERING
             ctx_manager.upsert_user_context(ctx)
-            ctx_manager.log_operation(user_id, ctx.active_file_id, "export", "exit")
+            await update.effective_message.reply_text(
+                "فیلتر: نام ستون و کلیدواژه را با فرمت زیر بفرست:\ncolumn=<name>;keyword=<text>\n"
+                "یا شرط ترکیبی (& برای و، | برای یا):\n"
+                "city = Tehran & price in 10..20 | name ~ \"^A\" | note is empty\n"
+                "عملگرها: = != > >= < <= ~ (regex) in a..b، is empty، not empty"
+            )
+            return
+        ctx_manager.clear_pending_filter(user_id)
+        try:
+            analysis = await _load_analysis(ctx.active_file_id, record)
+            await worker_pool.run(excel_engine.filter_rows, record["working_path"], analysis["sheets"][0]["name"], pf.to_query(), ctx.active_file_id)
+        except ValueError as exc:
+            await update.effective_message.reply_text(f"❌ {exc}")
             return
+        ctx_manager.invalidate_analysis(ctx.active_file_id)
+        ctx.state = FSMState.READY_EXPORT
+        ctx_manager.upsert_user_context(ctx)
+        ctx_manager.log_operation(user_id, ctx.active_file_id, "filter", "exit")
+        suggest, suggested_action = ctx_manager.next_action_hints(user_id)
+        msg = "✅ فیلتر اعمال شد."
+        if suggest:
+            msg += "\n💡 با توجه به روند قبلی‌ات، الان Export پیشنهاد می‌شود."
+        await update.effective_message.reply_text(
+            msg, reply_markup=ui.inline_menu(ctx, suggest_export=suggest, suggested_action=suggested_action)
+        )
+        return
+
+    if decision.action == "export":
+        out_path = await worker_pool.run(excel_engine.export, record["working_path"], record["original_name"])
+        with open(out_path, "rb") as fh:
+            await context.bot.send_document(chat_id=user_id, document=fh, filename=record["original_name"], caption="فایل خروجی")
+        ctx.state = FSMState.DONE
+        ctx_manager.upsert_user_context(ctx)
+        ctx_manager.log_operation(user_id, ctx.active_file_id, "export", "exit")
+        return
 
     await update.effective_message.reply_text("دستور قابل اجرا نیست.")
 
@@ -176,7 +281,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ctx = _context(user_id)
     if ctx.state == FSMState.FILTERING and "column=" in text and "keyword=" in text:
         parts = dict(chunk.split("=", 1) for chunk in text.split(";") if "=" in chunk)
-        pending_filters[user_id] = PendingFilter(column=parts.get("column"), keyword=parts.get("keyword"))
+        ctx_manager.set_pending_filter(user_id, asdict(PendingFilter(column=parts.get("column"), keyword=parts.get("keyword"))))
+        intent = Intent(name="filter", raw_text=text, target="column")
+        decision = decision_engine.decide(user_id, intent)
+        await _execute_decision(update, context, decision)
+        return
+    if ctx.state == FSMState.FILTERING and _looks_like_query(text):
+        ctx_manager.set_pending_filter(user_id, asdict(PendingFilter(query=text)))
         intent = Intent(name="filter", raw_text=text, target="column")
         decision = decision_engine.decide(user_id, intent)
         await _execute_decision(update, context, decision)
@@ -1,17 +1,14 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, replace
 
 try:
     import regex as _rx
 except Exception:  # pragma: no cover
     import re as _rx
 
-try:
-    import spacy
-except Exception:  # pragma: no cover
-    spacy = None
-
 
 @dataclass
 class Intent:
@@ -22,55 +19,254 @@ class Intent:
     raw_text: str = ""
 
 
+# ترتیب کلیدها همان اولویت است: اگر چند intent در متن باشد اولی برنده است
+INTENT_KEYWORDS = {
+    "analyze": ("آنالیز", "تحلیل", "analyse", "analyze"),
+    "filter": ("فیلتر", "filter"),
+    "export": ("خروجی", "اکسپورت", "export", "دریافت فایل"),
+    "back": ("بازگشت", "back"),
+    "reset": ("ریست", "لغو", "reset", "exit"),
+    "help": ("راهنما", "help"),
+    "add": ("افزودن", "اضافه"),
+    "delete": ("حذف", "پاک"),
+    "edit": ("ویرایش", "ادیت", "تغییر"),
+}
+TARGET_KEYWORDS = {
+    "column": ("ستون", "column"),
+    "row": ("سطر", "row"),
+    "file": ("فایل", "file"),
+}
+GROUP_MODE_KEYWORDS = ("گروهی", "چند", "لیست")
+
+
+def _trie_pattern(words) -> str:
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        branches = [_rx.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+
+@dataclass
+class KeywordMatcher:
+    """همه کلیدواژه‌ها در یک عبارت منظم درخت‌مانند (trie)، شبیه Aho–Corasick.
+
+    در هر موقعیت متن فقط یک مسیر از trie پیموده می‌شود، پس هزینه اسکن با بزرگ شدن
+    واژگان تقریباً ثابت می‌ماند. الگو داخل lookahead است تا کلیدواژه‌های
+    هم‌پوشان (مثل «دریافت فایل» و «فایل») هر دو دیده شوند. کلیدواژه‌ها و متن هر دو
+    casefold می‌شوند تا کلید پیدا شده همیشه در `kinds` باشد.
+    """
+
+    pattern: object
+    kinds: dict[str, set[str]]
+
+    def scan(self, text: str) -> set[str]:
+        found: set[str] = set()
+        for match in self.pattern.finditer(text.casefold()):
+            found |= self.kinds[match.group(1)]
+        return found
+
+
+def compile_matcher(
+    intents: dict[str, tuple[str, ...]] = INTENT_KEYWORDS,
+    targets: dict[str, tuple[str, ...]] = TARGET_KEYWORDS,
+    group_mode: tuple[str, ...] = GROUP_MODE_KEYWORDS,
+) -> KeywordMatcher:
+    kinds: dict[str, set[str]] = {}
+    groups = [(f"intent_{n}", words) for n, words in intents.items()]
+    groups += [(f"target_{n}", words) for n, words in targets.items()]
+    groups.append(("mode_group", group_mode))
+    for kind, words in groups:
+        for word in words:
+            kinds.setdefault(word.casefold(), set()).add(kind)
+    pattern = _rx.compile("(?=(" + _trie_pattern(kinds) + "))")
+    return KeywordMatcher(pattern, kinds)
+
+
+def _load_spacy():
+    try:
+        import spacy
+    except Exception:  # pragma: no cover
+        return None
+    try:
+        return spacy.load("en_core_web_sm")
+    except Exception:
+        return spacy.blank("en")
+
+
 class IntentDetectionEngine:
-    def __init__(self):
-        self._patterns = {
-            "analyze": _rx.compile(r"(آنالیز|تحلیل|analy[sz]e)", _rx.IGNORECASE),
-            "filter": _rx.compile(r"(فیلتر|filter)", _rx.IGNORECASE),
-            "export": _rx.compile(r"(خروجی|اکسپورت|export|دریافت فایل)", _rx.IGNORECASE),
-            "back": _rx.compile(r"(بازگشت|back)", _rx.IGNORECASE),
-            "reset": _rx.compile(r"(ریست|لغو|reset|exit)", _rx.IGNORECASE),
-            "help": _rx.compile(r"(راهنما|help)", _rx.IGNORECASE),
-            "add": _rx.compile(r"(افزودن|اضافه)", _rx.IGNORECASE),
-            "delete": _rx.compile(r"(حذف|پاک)", _rx.IGNORECASE),
-            "edit": _rx.compile(r"(ویرایش|ادیت|تغییر)", _rx.IGNORECASE),
-        }
-        if spacy:
-            try:
-                self.nlp = spacy.load("en_core_web_sm")
-            except Exception:
-                self.nlp = spacy.blank("en")
-        else:
-            self.nlp = None
+    """تشخیص intent با یک اسکن کلیدواژه و spaCy فقط به عنوان fallback برای target.
+
+    spaCy (import و مدل، حدود یک ثانیه) در ساخت موتور بارگذاری نمی‌شود:
+    `nlp_mode="lazy"` در اولین fallback، `"background"` در یک نخ پس‌زمینه (تا پایان
+    بارگذاری fallback رد می‌شود) و `"off"` هرگز.
+    """
+
+    def __init__(self, nlp_mode: str = "lazy", memo_size: int = 4096):
+        if nlp_mode not in {"lazy", "background", "off"}:
+            raise ValueError(f"nlp_mode نامعتبر: {nlp_mode}")
+        self._matcher = compile_matcher()
+        self._intent_order = list(INTENT_KEYWORDS)
+        self._target_order = list(TARGET_KEYWORDS)
+        self._nlp = None
+        self._nlp_state = "off" if nlp_mode == "off" else "pending"
+        self._nlp_lock = threading.Lock()
+        # متن نرمال‌شده → Intent؛ دکمه‌ها و callbackها بیشتر ترافیک را تشکیل می‌دهند
+        self.memo_size = memo_size
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self._memo: OrderedDict[str, Intent] = OrderedDict()
+        self._memo_lock = threading.Lock()
+        if nlp_mode == "background":
+            self.warm_up()
+
+    @property
+    def nlp(self):
+        if self._nlp_state == "pending":
+            self._load_nlp()
+        return self._nlp
+
+    @nlp.setter
+    def nlp(self, value):
+        self._nlp = value
+        self._nlp_state = "ready"
+        with self._memo_lock:
+            self._memo.clear()
+
+    def _load_nlp(self):
+        with self._nlp_lock:
+            if self._nlp_state in {"pending", "loading"}:
+                self._nlp = _load_spacy()
+                self._nlp_state = "ready"
+                with self._memo_lock:
+                    self._memo.clear()
+
+    def warm_up(self):
+        """بارگذاری spaCy را در پس‌زمینه شروع می‌کند."""
+        if self._nlp_state == "pending":
+            self._nlp_state = "loading"
+            threading.Thread(target=self._load_nlp, name="spacy-load", daemon=True).start()
+
+    def _scan(self, text: str) -> tuple[str | None, str | None, str]:
+        found = self._matcher.scan(text)
+        intent = next((name for name in self._intent_order if f"intent_{name}" in found), None)
+        target = next((name for name in self._target_order if f"target_{name}" in found), None)
+        return intent, target, "group" if "mode_group" in found else "single"
+
+    def _memo_get(self, key: str) -> Intent | None:
+        with self._memo_lock:
+            intent = self._memo.get(key)
+            if intent is None:
+                self.memo_misses += 1
+                return None
+            self._memo.move_to_end(key)
+            self.memo_hits += 1
+            return intent
+
+    def _memo_put(self, key: str, intent: Intent, target_final: bool):
+        # تا وقتی spaCy در پس‌زمینه بارگذاری می‌شود نتیجه بدون fallback کش نمی‌شود
+        if not target_final and self._nlp_state not in {"ready", "off"}:
+            return
+        with self._memo_lock:
+            self._memo[key] = intent
+            self._memo.move_to_end(key)
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+
+    def memo_stats(self) -> dict:
+        with self._memo_lock:
+            total = self.memo_hits + self.memo_misses
+            return {
+                "hits": self.memo_hits,
+                "misses": self.memo_misses,
+                "hit_rate": self.memo_hits / total if total else 0.0,
+                "entries": len(self._memo),
+            }
+
+    @staticmethod
+    def _build(text: str, name: str | None, target: str | None, mode: str) -> Intent:
+        if name:
+            return Intent(name=name, target=target, mode=mode, confidence=0.8, raw_text=text)
+        if target:
+            return Intent(name="operation", target=target, confidence=0.4, raw_text=text)
+        return Intent(name="unknown", confidence=0.1, raw_text=text)
 
     def detect(self, text: str) -> Intent:
         text = (text or "").strip()
         if not text:
             return Intent(name="unknown", confidence=0.0, raw_text=text)
 
-        for name, pat in self._patterns.items():
-            if pat.search(text):
-                target = self._target_detection(text)
-                mode = "group" if _rx.search(r"(گروهی|چند|لیست)", text, _rx.IGNORECASE) else "single"
-                return Intent(name=name, target=target, mode=mode, confidence=0.8, raw_text=text)
+        key = normalize_text(text)
+        cached = self._memo_get(key)
+        if cached is not None:
+            return replace(cached, raw_text=text)
+        name, target, mode = self._scan(key)
+        target_final = target is not None
+        target = target or self._nlp_target(key)
+        intent = self._build(text, name, target, mode)
+        self._memo_put(key, intent, target_final)
+        return replace(intent)
 
-        target = self._target_detection(text)
-        if target:
-            return Intent(name="operation", target=target, confidence=0.4, raw_text=text)
-        return Intent(name="unknown", confidence=0.1, raw_text=text)
+    def detect_many(self, texts: list[str]) -> list[Intent]:
+        """تشخیص دسته‌ای؛ fallback همه متن‌های بدون target با یک `nlp.pipe` انجام می‌شود."""
+        results: list[Intent | None] = [None] * len(texts)
+        fallback: dict[str, list[int]] = {}
+        scans: dict[str, tuple[str | None, str | None, str]] = {}
+        for i, raw in enumerate(texts):
+            text = (raw or "").strip()
+            if not text:
+                results[i] = Intent(name="unknown", confidence=0.0, raw_text=text)
+                continue
+            key = normalize_text(text)
+            cached = self._memo_get(key)
+            if cached is not None:
+                results[i] = replace(cached, raw_text=text)
+                continue
+            if key not in scans:
+                scans[key] = self._scan(key)
+            name, target, mode = scans[key]
+            if target is None:
+                fallback.setdefault(key, []).append(i)
+                continue
+            results[i] = self._build(text, name, target, mode)
+            self._memo_put(key, results[i], True)
+
+        nlp = self.nlp if fallback else None
+        keys = list(fallback)
+        docs = nlp.pipe(keys) if nlp else [None] * len(keys)
+        for key, doc in zip(keys, docs):
+            name, _, mode = scans[key]
+            target = _doc_target(doc) if doc is not None else None
+            for i in fallback[key]:
+                results[i] = self._build(texts[i].strip(), name, target, mode)
+            self._memo_put(key, results[fallback[key][0]], False)
+        return [replace(intent) for intent in results]
 
     def _target_detection(self, text: str) -> str | None:
-        if _rx.search(r"(ستون|column)", text, _rx.IGNORECASE):
-            return "column"
-        if _rx.search(r"(سطر|row)", text, _rx.IGNORECASE):
-            return "row"
-        if _rx.search(r"(فایل|file)", text, _rx.IGNORECASE):
-            return "file"
-
-        if self.nlp:
-            doc = self.nlp(text)
-            for token in doc:
-                val = token.text.lower()
-                if val in {"column", "row", "file", "filter", "export"}:
-                    return val
-        return None
+        return self._scan(text)[1] or self._nlp_target(text)
+
+    def _nlp_target(self, text: str) -> str | None:
+        nlp = self.nlp
+        return _doc_target(nlp(text)) if nlp else None
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+def _doc_target(doc) -> str | None:
+    for token in doc:
+        val = token.text.lower()
+        if val in {"column", "row", "file", "filter", "export"}:
+            return val
+    return None
@@ -16,10 +16,20 @@ def main():
             "پکیج python-telegram-bot نصب نیست. ابتدا نصب‌کننده را اجرا کنید یا در venv دستور `pip install -r requirements.txt` بزنید."
         ) from exc
 
-    from bot.handlers import handle_callback, handle_document, handle_message, start
+    from bot.handlers import ctx_manager, handle_callback, handle_document, handle_message, intent_engine, start, storage_manager, worker_pool
     from config import BOT_TOKEN
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    async def _init(_app):
+        # ساخت کامپوننت‌ها بعد از import؛ در INTENT_NLP=background بارگذاری spaCy همین‌جا در پس‌زمینه شروع می‌شود
+        intent_engine.get()
+        storage_manager.start()
+
+    async def _shutdown(_app):
+        await storage_manager.stop()
+        worker_pool.shutdown(wait=False)
+        ctx_manager.close()
+
+    app = ApplicationBuilder().token(BOT_TOKEN).post_init(_init).post_shutdown(_shutdown).build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     app.add_handler(CallbackQueryHandler(handle_callback))
@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+
+class StaleStateError(RuntimeError):
+    """نسخه مورد انتظار با نسخه ذخیره‌شده یکی نیست (پروسه دیگری زودتر نوشته است)."""
+
+
+def shard_index(key, shards: int) -> int:
+    """شماره shard پایدار برای یک کلید (در همه پروسه‌ها یکسان است)."""
+    if shards == 1:
+        return 0
+    return zlib.crc32(str(key).encode("utf-8")) % shards
+
+
+class KeyValueStore(ABC):
+    """ذخیره‌ساز کلید/مقدار نسخه‌دار برای state مشترک بین پروسه‌های ربات.
+
+    هر مقدار یک شماره نسخه دارد (۰ یعنی وجود ندارد). `put` با `expected_version`
+    فقط وقتی می‌نویسد که نسخه فعلی همان باشد و در غیر این صورت StaleStateError می‌دهد.
+    کلیدها به شکل ``namespace:owner[:...]`` هستند و shard بر اساس owner انتخاب می‌شود.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> tuple[int, bytes] | None:
+        ...
+
+    def version(self, key: str) -> int:
+        found = self.get(key)
+        return found[0] if found else 0
+
+    @abstractmethod
+    def put(self, key: str, value: bytes, expected_version: int | None = None) -> int:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def keys(self, prefix: str) -> list[str]:
+        """همه کلیدهایی که با `prefix` شروع می‌شوند (برای پیمایش‌های دوره‌ای مثل GC)."""
+
+    def close(self):
+        pass
+
+
+def route_key(key: str) -> str:
+    parts = key.split(":", 2)
+    return parts[1] if len(parts) > 1 else key
+
+
+def prefix_bounds(prefix: str) -> tuple[str, str]:
+    # بازه کلیدهای هم‌پیشوند برای جست‌وجوی ایندکس‌دار روی کلید اصلی
+    return prefix, prefix + "\U0010ffff"
+
+
+class MemoryStore(KeyValueStore):
+    def __init__(self):
+        self._data: dict[str, tuple[int, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[int, bytes] | None:
+        with self._lock:
+            return self._data.get(key)
+
+    def put(self, key: str, value: bytes, expected_version: int | None = None) -> int:
+        with self._lock:
+            current = self._data.get(key, (0, b""))[0]
+            if expected_version is not None and expected_version != current:
+                raise StaleStateError(key)
+            self._data[key] = (current + 1, bytes(value))
+            return current + 1
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def keys(self, prefix: str) -> list[str]:
+        with self._lock:
+            return sorted(key for key in self._data if key.startswith(prefix))
+
+
+class ShardedSQLiteStore(KeyValueStore):
+    """کلیدها بر اساس owner (مثلاً chat_id) بین `shards` فایل SQLite پخش می‌شوند."""
+
+    def __init__(self, base_dir: str = "storage/state", shards: int = 4):
+        if shards < 1:
+            raise ValueError("تعداد shard باید حداقل ۱ باشد")
+        self.base_dir = Path(base_dir)
+        self.base_dir.mkdir(parents=True, exist_ok=True)
+        self.shards = shards
+        self._conns = []
+        for i in range(shards):
+            conn = sqlite3.connect(self.base_dir / f"kv.{i}.db", check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, version INTEGER NOT NULL, value BLOB NOT NULL)")
+            self._conns.append(conn)
+        self._lock = threading.Lock()
+
+    def _conn(self, key: str) -> sqlite3.Connection:
+        return self._conns[shard_index(route_key(key), self.shards)]
+
+    def get(self, key: str) -> tuple[int, bytes] | None:
+        with self._lock:
+            row = self._conn(key).execute("SELECT version, value FROM kv WHERE key = ?", (key,)).fetchone()
+        return (row[0], bytes(row[1])) if row else None
+
+    def version(self, key: str) -> int:
+        with self._lock:
+            row = self._conn(key).execute("SELECT version FROM kv WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def put(self, key: str, value: bytes, expected_version: int | None = None) -> int:
+        conn = self._conn(key)
+        with self._lock:
+            # BEGIN IMMEDIATE قفل نوشتن را همان اول می‌گیرد تا مقایسه نسخه بین پروسه‌ها اتمیک باشد
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT version FROM kv WHERE key = ?", (key,)).fetchone()
+                current = row[0] if row else 0
+                if expected_version is not None and expected_version != current:
+                    raise StaleStateError(key)
+                conn.execute(
+                    "INSERT INTO kv (key, version, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET version = excluded.version, value = excluded.value",
+                    (key, current + 1, value),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return current + 1
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn(key).execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def keys(self, prefix: str) -> list[str]:
+        found = []
+        with self._lock:
+            for conn in self._conns:
+                found.extend(row[0] for row in conn.execute("SELECT key FROM kv WHERE key >= ? AND key < ?", prefix_bounds(prefix)))
+        return sorted(found)
+
+    def close(self):
+        with self._lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+
+
+class HttpStore(KeyValueStore):
+    """کلاینت سرویس key-value شبکه‌ای (پروتکل `serve_store`) با httpx."""
+
+    def __init__(self, base_url: str, timeout: float = 5.0, client=None):
+        import httpx
+
+        self.base_url = base_url.rstrip("/")
+        self._client = client or httpx.Client(timeout=timeout)
+
+    def _url(self, key: str) -> str:
+        return f"{self.base_url}/kv/{quote(key, safe='')}"
+
+    def get(self, key: str) -> tuple[int, bytes] | None:
+        resp = self._client.get(self._url(key))
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return int(resp.headers["X-Version"]), resp.content
+
+    def version(self, key: str) -> int:
+        resp = self._client.head(self._url(key))
+        if resp.status_code == 404:
+            return 0
+        resp.raise_for_status()
+        return int(resp.headers["X-Version"])
+
+    def put(self, key: str, value: bytes, expected_version: int | None = None) -> int:
+        headers = {} if expected_version is None else {"If-Match": str(expected_version)}
+        resp = self._client.put(self._url(key), content=value, headers=headers)
+        if resp.status_code == 409:
+            raise StaleStateError(key)
+        resp.raise_for_status()
+        return int(resp.headers["X-Version"])
+
+    def delete(self, key: str):
+        self._client.delete(self._url(key)).raise_for_status()
+
+    def keys(self, prefix: str) -> list[str]:
+        resp = self._client.get(f"{self.base_url}/keys", params={"prefix": prefix})
+        resp.raise_for_status()
+        return resp.json()
+
+    def close(self):
+        self._client.close()
+
+
+def create_store(url: str | None) -> KeyValueStore | None:
+    """`memory://`، `sqlite:///path?shards=N` یا `http://host:port`؛ مقدار خالی یعنی بدون store."""
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return MemoryStore()
+    if parsed.scheme == "sqlite":
+        shards = int(parse_qs(parsed.query).get("shards", ["4"])[0])
+        return ShardedSQLiteStore(parsed.path or "storage/state", shards=shards)
+    if parsed.scheme in {"http", "https"}:
+        return HttpStore(url)
+    raise ValueError(f"آدرس state store پشتیبانی نمی‌شود: {url}")
+
+
+def serve_store(store: KeyValueStore, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """سرور HTTP ساده روی یک store محلی؛ برای اجرا از `serve_forever()` استفاده کنید."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def _key(self) -> str | None:
+            if not self.path.startswith("/kv/"):
+                self.send_error(404)
+                return None
+            return unquote(self.path[4:])
+
+        def _reply(self, status: int, version: int | None = None, body: bytes = b""):
+            self.send_response(status)
+            if version is not None:
+                self.send_header("X-Version", str(version))
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if body and self.command != "HEAD":
+                self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.startswith("/keys"):
+                prefix = parse_qs(urlparse(self.path).query).get("prefix", [""])[0]
+                self._reply(200, body=json.dumps(store.keys(prefix)).encode("utf-8"))
+                return
+            key = self._key()
+            if key is None:
+                return
+            found = store.get(key)
+            if found is None:
+                self._reply(404)
+            else:
+                self._reply(200, found[0], found[1])
+
+        def do_HEAD(self):
+            key = self._key()
+            if key is None:
+                return
+            version = store.version(key)
+            self._reply(200 if version else 404, version or None)
+
+        def do_PUT(self):
+            key = self._key()
+            if key is None:
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            expected = self.headers.get("If-Match")
+            try:
+                version = store.put(key, body, int(expected) if expected is not None else None)
+            except StaleStateError:
+                self._reply(409)
+                return
+            self._reply(200, version)
+
+        def do_DELETE(self):
+            key = self._key()
+            if key is None:
+                return
+            store.delete(key)
+            self._reply(204)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="سرویس state مشترک برای چند پروسه ربات")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--dir", default="storage/state")
+    parser.add_argument("--shards", type=int, default=4)
+    args = parser.parse_args()
+    serve_store(ShardedSQLiteStore(args.dir, args.shards), args.host, args.port).serve_forever()
@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import asyncio
+import re
+import shutil
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from bot.context_manager import ContextManager
+from core.blob_store import BlobStore
+
+# نام فایل‌های uploads: u{user_id}_{digest16}_{original|working|export}_{name}
+_UPLOAD_NAME = re.compile(r"^(u(\d+)_[0-9a-f]{16})_")
+
+
+@dataclass
+class StoredFile:
+    file_id: str
+    user_id: int | None
+    last_used_at: float
+    registered: bool = True
+    paths: list[Path] = field(default_factory=list)
+    size: int = 0
+
+
+@dataclass
+class StorageStats:
+    runs: int = 0
+    used_bytes: int = 0
+    evicted_files: int = 0
+    removed_records: int = 0
+    reclaimed_bytes: int = 0
+    errors: int = 0
+    last_run_at: float | None = None
+
+
+class StorageManager:
+    """سقف حجم هر کاربر و کل storage با حذف بر اساس سن و LRU.
+
+    واحد حذف یک file_id است: نسخه اصلی/کاری/خروجی در uploads، پوشه نسخه‌ها در
+    versions و ردیف file_registry با هم حذف می‌شوند و blobهای بی‌ارجاع جمع‌آوری
+    می‌شوند. فایل فعال کاربران فقط با انقضای سن حذف می‌شود، نه برای سقف حجم.
+    """
+
+    def __init__(
+        self,
+        ctx_manager: ContextManager,
+        uploads_dir: str = "storage/uploads",
+        versions_dir: str = "storage/versions",
+        blob_store: BlobStore | None = None,
+        user_quota_bytes: int = 200 * 1024 * 1024,
+        global_quota_bytes: int = 2 * 1024 * 1024 * 1024,
+        max_age_seconds: float = 7 * 24 * 3600,
+        interval_seconds: float = 600,
+        blob_grace_seconds: float = 300,
+    ):
+        self.ctx = ctx_manager
+        self.uploads_dir = Path(uploads_dir)
+        self.versions_dir = Path(versions_dir)
+        self.blobs = blob_store or BlobStore(str(self.uploads_dir.parent / "blobs"))
+        self.user_quota_bytes = user_quota_bytes
+        self.global_quota_bytes = global_quota_bytes
+        self.max_age_seconds = max_age_seconds
+        self.interval_seconds = interval_seconds
+        self.blob_grace_seconds = blob_grace_seconds
+        self.stats = StorageStats()
+        self._task: asyncio.Task | None = None
+
+    def _collect(self) -> dict[str, StoredFile]:
+        files = {
+            row["file_id"]: StoredFile(row["file_id"], row["user_id"], row["last_used_at"] or 0.0)
+            for row in self.ctx.list_files()
+        }
+        seen_inodes: set[tuple[int, int]] = set()
+
+        def add(file_id: str, user_id: int | None, path: Path):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # همزمان با این دور حذف شده است (درخواست دیگر یا دور قبلی)
+                return
+            entry = files.get(file_id)
+            if entry is None:
+                # فایل بدون ردیف registry (یتیم)؛ سن آن از mtime حساب می‌شود
+                entry = files[file_id] = StoredFile(file_id, user_id, 0.0, registered=False)
+            if not entry.registered:
+                entry.last_used_at = max(entry.last_used_at, stat.st_mtime)
+            entry.paths.append(path)
+            # نسخه‌های hardlink شده فقط یک‌بار حساب می‌شوند
+            inode = (stat.st_dev, stat.st_ino)
+            if inode not in seen_inodes:
+                seen_inodes.add(inode)
+                entry.size += stat.st_size
+
+        if self.uploads_dir.exists():
+            for path in self.uploads_dir.iterdir():
+                match = _UPLOAD_NAME.match(path.name)
+                if match and path.is_file():
+                    add(match.group(1), int(match.group(2)), path)
+        if self.versions_dir.exists():
+            for folder in self.versions_dir.iterdir():
+                if folder.is_dir():
+                    match = _UPLOAD_NAME.match(folder.name + "_")
+                    try:
+                        paths = list(folder.iterdir())
+                    except FileNotFoundError:
+                        continue
+                    for path in paths:
+                        add(folder.name, int(match.group(2)) if match else None, path)
+        return files
+
+    def run_once(self, now: float | None = None) -> dict:
+        """یک دور پاک‌سازی؛ خلاصه همین دور را برمی‌گرداند."""
+        now = time.time() if now is None else now
+        files = self._collect()
+        active = self.ctx.active_file_ids()
+        evict: dict[str, StoredFile] = {}
+
+        for entry in files.values():
+            if now - entry.last_used_at > self.max_age_seconds:
+                evict[entry.file_id] = entry
+
+        lru = sorted((e for e in files.values() if e.file_id not in evict and e.file_id not in active), key=lambda e: e.last_used_at)
+        per_user: dict[int | None, int] = {}
+        for entry in files.values():
+            if entry.file_id not in evict:
+                per_user[entry.user_id] = per_user.get(entry.user_id, 0) + entry.size
+        for entry in lru:
+            if per_user.get(entry.user_id, 0) > self.user_quota_bytes:
+                evict[entry.file_id] = entry
+                per_user[entry.user_id] -= entry.size
+        total = sum(per_user.values())
+        for entry in lru:
+            if total <= self.global_quota_bytes:
+                break
+            if entry.file_id not in evict:
+                evict[entry.file_id] = entry
+                total -= entry.size
+
+        reclaimed = 0
+        for entry in evict.values():
+            for path in entry.paths:
+                try:
+                    stat = path.stat()
+                    path.unlink()
+                except FileNotFoundError:
+                    continue
+                # فقط فایلی که لینک دیگری نداشت واقعاً فضا آزاد می‌کند؛ بقیه با GC blobها
+                if stat.st_nlink <= 1:
+                    reclaimed += stat.st_size
+            shutil.rmtree(self.versions_dir / entry.file_id, ignore_errors=True)
+        records = [file_id for file_id, entry in evict.items() if entry.registered]
+        self.ctx.delete_files(records)
+        _, blob_bytes = self.blobs.collect_garbage(self.blob_grace_seconds)
+        reclaimed += blob_bytes
+
+        self.stats.runs += 1
+        self.stats.used_bytes = total
+        self.stats.evicted_files += len(evict)
+        self.stats.removed_records += len(records)
+        self.stats.reclaimed_bytes += reclaimed
+        self.stats.last_run_at = now
+        return {"evicted_files": len(evict), "removed_records": len(records), "reclaimed_bytes": reclaimed, "used_bytes": total}
+
+    async def run_forever(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception:  # noqa: BLE001 - یک دور ناموفق نباید حلقه را متوقف کند
+                self.stats.errors += 1
+            await asyncio.sleep(self.interval_seconds)
+
+    def start(self) -> asyncio.Task:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run_forever(), name="storage-gc")
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -5,6 +5,9 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton,
 from bot.context_manager import FSMState, UserContext
 
 
+SUGGESTION_LABELS = {"analyze": "Analyze", "filter": "Filter", "export": "Export"}
+
+
 class UIRenderer:
     def reply_menu(self, ctx: UserContext) -> ReplyKeyboardMarkup:
         rows = [[KeyboardButton("📊 آنالیز"), KeyboardButton("🧪 فیلتر")], [KeyboardButton("📤 خروجی"), KeyboardButton("📚 راهنما")]]
@@ -13,15 +16,16 @@ class UIRenderer:
             rows.insert(0, [KeyboardButton("📤 ارسال فایل")])
         return ReplyKeyboardMarkup(rows, resize_keyboard=True)
 
-    def inline_menu(self, ctx: UserContext, suggest_export: bool = False) -> InlineKeyboardMarkup:
+    def inline_menu(self, ctx: UserContext, suggest_export: bool = False, suggested_action: str | None = None) -> InlineKeyboardMarkup:
         rows = [
             [InlineKeyboardButton("📊 Analyze file", callback_data="intent:analyze")],
             [InlineKeyboardButton("🧪 Filter data", callback_data="intent:filter")],
             [InlineKeyboardButton("📤 Export result", callback_data="intent:export")],
             [InlineKeyboardButton("📁 Use previous analysis", callback_data="intent:reuse")],
         ]
-        if suggest_export:
-            rows.insert(0, [InlineKeyboardButton("💡 پیشنهاد: Export", callback_data="intent:export")])
+        action = "export" if suggest_export else suggested_action
+        if action in SUGGESTION_LABELS:
+            rows.insert(0, [InlineKeyboardButton(f"💡 پیشنهاد: {SUGGESTION_LABELS[action]}", callback_data=f"intent:{action}")])
         rows.extend(
             [
                 [InlineKeyboardButton("⬅️ Back", callback_data="intent:back")],
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class WorkerPoolBusy(RuntimeError):
+    pass
+
+
+class ExcelWorkerPool:
+    """اجرای کارهای سنگین openpyxl بیرون از event loop.
+
+    به‌طور پیش‌فرض از ProcessPoolExecutor استفاده می‌شود؛ اگر سیستم از آن پشتیبانی
+    نکند (مثلاً Termux بدون sem_open) به ThreadPoolExecutor برمی‌گردد. تعداد کارهای
+    در صف به `max_pending` محدود است و کارهای اضافه با WorkerPoolBusy رد می‌شوند؛
+    کاری که انتظارش timeout خورده تا پایان واقعی اجرا در همین شمارش می‌ماند.
+
+    در حالت process هر worker کش workbook خودش را دارد (حافظه تا N برابر
+    WORKBOOK_CACHE_BYTES و نرخ hit پایین)؛ ربات به‌طور پیش‌فرض حالت thread را می‌گیرد.
+    """
+
+    def __init__(self, max_workers: int | None = None, use_processes: bool = True, max_pending: int = 32, timeout: float | None = 120.0):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.use_processes = use_processes
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.mode: str | None = None
+        self._executor: Executor | None = None
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.use_processes:
+                try:
+                    self._executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+                    self.mode = "process"
+                except (ImportError, NotImplementedError, OSError):
+                    self._executor = None
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="excel-worker")
+                self.mode = "thread"
+        return self._executor
+
+    def _release(self, _future=None):
+        with self._pending_lock:
+            self._pending -= 1
+
+    async def run(self, fn, *args, timeout: float | None = None, **kwargs):
+        with self._pending_lock:
+            if self._pending >= self.max_pending:
+                raise WorkerPoolBusy("صف پردازش پر است؛ کمی بعد دوباره تلاش کنید")
+            self._pending += 1
+        try:
+            job = self._get_executor().submit(functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            self._release()
+            raise
+        # جای کار در صف فقط وقتی آزاد می‌شود که خود کار تمام (یا پیش از شروع لغو) شود
+        job.add_done_callback(self._release)
+        try:
+            # با timeout فقط انتظار لغو می‌شود؛ کار در حال اجرای worker تا پایان ادامه دارد
+            return await asyncio.wait_for(asyncio.wrap_future(job), timeout if timeout is not None else self.timeout)
+        except BrokenExecutor:
+            # worker از کار افتاده؛ درخواست بعدی pool تازه می‌سازد
+            self._executor = None
+            raise
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
@@ -1,6 +1,9 @@
 from __future__ import annotations
 
-from dataclasses import dataclass, field
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
 from enum import Enum
 from io import BytesIO
 from pathlib import Path
@@ -8,6 +11,14 @@ from tempfile import NamedTemporaryFile
 
 from openpyxl import load_workbook
 
+from bot.state_store import KeyValueStore
+from core.blob_store import MappedFile, atomic_write
+from core.excel_reader import scan_workbook
+from core.operation_plan import OperationPlan
+from core.undo_log import UndoLog
+from core.workbook_cache import DEFAULT_EXPANSION, analysis_cost, digest_bytes, workbook_cache
+from core.working_model import SheetModel, WorkbookModel
+
 
 class BotState(str, Enum):
     WAIT_FILE = "WAIT_FILE"
@@ -35,68 +46,323 @@ class SessionData:
     ui_mode: str = "inline"
     original_file_name: str | None = None
     original_bytes: bytes | None = None
-    working_bytes: bytes | None = None
+    # در حالت دیسکی فایل اصلی فقط روی دیسک است و با mmap خوانده می‌شود
+    original_path: str | None = None
+    model: WorkbookModel | None = None
     selected_sheet: str | None = None
     op_stack: list[PendingOperation] = field(default_factory=list)
-    undo_stack: list[bytes] = field(default_factory=list)
+    undo_stack: UndoLog = field(default_factory=UndoLog)
     pending: PendingOperation | None = None
+    # حالت تأخیری: برنامه عملیات هر شیت و ترتیب شیت‌ها برای Undo
+    plans: dict[str, OperationPlan] = field(default_factory=dict)
+    plan_order: list[str] = field(default_factory=list)
+    base_analysis: dict | None = None
 
 
 class SessionManager:
-    def __init__(self):
-        self._store: dict[int, SessionData] = {}
+    """سشن‌های ویرایش هر چت.
+
+    با `session_dir` فایل اصلی هر چت روی دیسک نگه داشته و با mmap خوانده می‌شود،
+    عملیات‌ها به صورت برنامه تأخیری اجرا می‌شوند و فقط متادیتا و ژورنال عملیات در
+    `meta.json` ذخیره می‌شود؛ پس سشن بعد از ری‌استارت با replay ژورنال برمی‌گردد و
+    حداکثر `max_resident` سشن در حافظه می‌ماند.
+
+    با `store` (مثلاً ShardedSQLiteStore یا HttpStore) همان سند JSON متادیتا و
+    ژورنال با کنترل نسخه در store نوشته می‌شود و `get` فقط وقتی پروسه دیگری سشن را
+    تغییر داده باشد آن را دوباره replay می‌کند. خود workbook هرگز در store نمی‌رود،
+    پس `session_dir` باید روی دیسک مشترک همه پروسه‌ها باشد.
+    """
+
+    def __init__(
+        self,
+        undo_budget_bytes: int = 8 * 1024 * 1024,
+        undo_spill_dir: str | None = None,
+        lazy: bool = False,
+        store: KeyValueStore | None = None,
+        session_dir: str | None = None,
+        max_resident: int = 256,
+    ):
+        if store is not None and session_dir is None:
+            raise ValueError("برای store مشترک، session_dir روی دیسک مشترک لازم است")
+        self._store: OrderedDict[int, SessionData] = OrderedDict()
+        self._versions: dict[int, int] = {}
+        self.undo_budget_bytes = undo_budget_bytes
+        self.undo_spill_dir = undo_spill_dir
+        self.session_dir = Path(session_dir) if session_dir else None
+        # حالت دیسکی همیشه برنامه تأخیری است تا مدل کامل workbook در حافظه نماند
+        self.lazy = lazy or self.session_dir is not None
+        self.store = store
+        self.max_resident = max_resident
+
+    @staticmethod
+    def _key(chat_id: int) -> str:
+        return f"session:{chat_id}"
 
     def get(self, chat_id: int) -> SessionData:
-        return self._store.setdefault(chat_id, SessionData())
+        session = self._store.get(chat_id)
+        if session is None and self.session_dir is not None:
+            session = self._restore(chat_id)
+        if self.store is not None:
+            version = self.store.version(self._key(chat_id))
+            if version and version != self._versions.get(chat_id):
+                found = self.store.get(self._key(chat_id))
+                if found is not None:
+                    self._versions[chat_id], blob = found
+                    session = self._from_meta(json.loads(blob))
+        if session is None:
+            session = SessionData(undo_stack=UndoLog(self.undo_budget_bytes, self.undo_spill_dir))
+        self._store[chat_id] = session
+        self._store.move_to_end(chat_id)
+        if self.session_dir is not None:
+            while len(self._store) > self.max_resident:
+                self._store.popitem(last=False)
+        return session
+
+    def save(self, chat_id: int):
+        """سشن را در store می‌نویسد؛ اگر پروسه دیگری زودتر نوشته باشد StaleStateError می‌دهد."""
+        if chat_id not in self._store:
+            return
+        payload = json.dumps(self._meta(self._store[chat_id]), ensure_ascii=False).encode("utf-8")
+        # اول store تا نسخه کهنه meta.json مشترک را هم بازنویسی نکند
+        if self.store is not None:
+            self._versions[chat_id] = self.store.put(self._key(chat_id), payload, self._versions.get(chat_id, 0))
+        if self.session_dir is not None:
+            folder = self._chat_dir(chat_id)
+            folder.mkdir(parents=True, exist_ok=True)
+            atomic_write(folder / "meta.json", lambda fh: fh.write(payload))
+
+    def _chat_dir(self, chat_id: int) -> Path:
+        return self.session_dir / str(chat_id)
+
+    @staticmethod
+    def _meta(session: SessionData) -> dict:
+        return {
+            "state": session.state.value,
+            "ui_mode": session.ui_mode,
+            "original_file_name": session.original_file_name,
+            "original_path": session.original_path,
+            "selected_sheet": session.selected_sheet,
+            "base_analysis": session.base_analysis,
+            "pending": _op_to_dict(session.pending) if session.pending else None,
+            "journal": [{"sheet": sheet, **_op_to_dict(op)} for sheet, op in zip(session.plan_order, session.op_stack)],
+        }
+
+    def _restore(self, chat_id: int) -> SessionData | None:
+        meta_path = self._chat_dir(chat_id) / "meta.json"
+        if not meta_path.exists():
+            return None
+        return self._from_meta(json.loads(meta_path.read_text(encoding="utf-8")))
+
+    def _from_meta(self, meta: dict) -> SessionData:
+        session = SessionData(
+            state=BotState(meta["state"]),
+            ui_mode=meta["ui_mode"],
+            original_file_name=meta["original_file_name"],
+            original_path=meta["original_path"],
+            selected_sheet=meta["selected_sheet"],
+            undo_stack=UndoLog(self.undo_budget_bytes, self.undo_spill_dir),
+            pending=_op_from_dict(meta["pending"]) if meta["pending"] else None,
+            base_analysis=meta["base_analysis"],
+        )
+        if session.base_analysis:
+            session.plans = {
+                sh["name"]: OperationPlan(base_rows=sh["rows"], base_cols=sh["cols"]) for sh in session.base_analysis["sheets"]
+            }
+        # ژورنال به همان ترتیب اجرا می‌شود تا برنامه هر شیت دقیقاً بازسازی شود
+        for entry in meta["journal"]:
+            op = _op_from_dict(entry)
+            session.plans[entry["sheet"]].append(op)
+            session.plan_order.append(entry["sheet"])
+            session.op_stack.append(op)
+        return session
+
+    def open_file(self, chat_id: int, file_name: str, data: bytes) -> dict:
+        session = self.get(chat_id)
+        session.original_file_name = file_name
+        if self.session_dir is not None:
+            folder = self._chat_dir(chat_id)
+            folder.mkdir(parents=True, exist_ok=True)
+            atomic_write(folder / "original.xlsx", lambda fh: fh.write(data))
+            session.original_path = str(folder / "original.xlsx")
+            session.original_bytes = None
+        else:
+            session.original_bytes = data
+        session.op_stack.clear()
+        session.undo_stack.clear()
+        session.plan_order.clear()
+        session.pending = None
+        if self.lazy:
+            session.model = None
+            analysis = analyze_workbook(data)
+            session.base_analysis = analysis
+            session.plans = {sh["name"]: OperationPlan(base_rows=sh["rows"], base_cols=sh["cols"]) for sh in analysis["sheets"]}
+        else:
+            session.model = _take_model(data)
+            session.plans = {}
+            analysis = session.model.analysis()
+        session.selected_sheet = analysis["sheets"][0]["name"] if analysis["sheets"] else None
+        session.state = BotState.ANALYZED
+        self.save(chat_id)
+        return analysis
+
+    def apply(self, chat_id: int, op: PendingOperation):
+        session = self.get(chat_id)
+        if not (session.model or session.plans) or not session.selected_sheet:
+            raise ValueError("ابتدا فایل اکسل را ارسال کنید")
+        dropped = 0
+        if session.plans:
+            session.plans[session.selected_sheet].append(op)
+            session.plan_order.append(session.selected_sheet)
+        else:
+            sheet = session.model[session.selected_sheet]
+            sheet.begin_delta()
+            try:
+                apply_to_model(sheet, op)
+            except Exception:
+                sheet.revert(sheet.end_delta())
+                raise
+            dropped = session.undo_stack.append(sheet.end_delta())
+        session.op_stack.append(op)
+        # عملیات‌هایی که دلتایشان از سقف حافظه بیرون افتاده دیگر قابل Undo نیستند
+        del session.op_stack[:dropped]
+        session.pending = None
+        session.state = BotState.READY_TO_SAVE
+        self.save(chat_id)
+
+    def undo(self, chat_id: int) -> bool:
+        session = self.get(chat_id)
+        if session.plans:
+            if not session.plan_order:
+                return False
+            session.plans[session.plan_order.pop()].pop()
+            session.op_stack.pop()
+            self.save(chat_id)
+            return True
+        delta = session.undo_stack.pop() if session.model else None
+        if delta is None:
+            return False
+        session.model[delta.sheet].revert(delta)
+        if session.op_stack:
+            session.op_stack.pop()
+        self.save(chat_id)
+        return True
+
+    def sheet_map(self, chat_id: int) -> tuple[list[str], list[int]]:
+        session = self.get(chat_id)
+        if session.plans:
+            plan = session.plans[session.selected_sheet]
+            base = next(sh for sh in session.base_analysis["sheets"] if sh["name"] == session.selected_sheet)
+            headers = [str(h or f"Column_{i}") for i, h in enumerate(plan.headers(base["headers"]), start=1)]
+            return headers, list(range(2, plan.max_row + 1))
+        if not session.model:
+            raise ValueError("ابتدا فایل اکسل را ارسال کنید")
+        return session.model[session.selected_sheet].sheet_map()
+
+    def preview(self, chat_id: int) -> dict:
+        """خلاصه تغییرات ثبت‌شده تا قبل از ذخیره نهایی."""
+        session = self.get(chat_id)
+        if session.plans:
+            return session.plans[session.selected_sheet].preview()
+        sheet = session.model[session.selected_sheet]
+        return {"operations": len(session.op_stack), "rows": sheet.max_row, "cols": sheet.max_column}
+
+    def export_bytes(self, chat_id: int) -> bytes:
+        output = BytesIO()
+        self._write(self.get(chat_id), output)
+        return output.getvalue()
+
+    def export_file(self, chat_id: int) -> Path:
+        """خروجی نهایی را مستقیم در فایل موقت می‌نویسد تا از دیسک برای تلگرام ارسال شود."""
+        session = self.get(chat_id)
+        suffix = Path(session.original_file_name or "").suffix or ".xlsx"
+        with NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+            try:
+                self._write(session, tmp)
+            except BaseException:
+                tmp.close()
+                Path(tmp.name).unlink(missing_ok=True)
+                raise
+            return Path(tmp.name)
+
+    @staticmethod
+    def _write(session: SessionData, target):
+        if session.plans:
+            # یک parse و یک گذر برای کل برنامه؛ استایل‌های فایل اصلی حفظ می‌شود
+            with _open_original(session) as source:
+                wb = load_workbook(source)
+            for name, plan in session.plans.items():
+                if plan.ops:
+                    plan.execute(wb[name])
+            wb.save(target)
+            return
+        if not session.model:
+            raise ValueError("فایلی برای ذخیره وجود ندارد")
+        session.model.save(target)
 
     def clear_after_save(self, chat_id: int):
         session = self.get(chat_id)
         session.op_stack.clear()
         session.undo_stack.clear()
+        session.plans.clear()
+        session.plan_order.clear()
+        # بدون base_analysis، _from_meta هم برنامه‌ها را برای سشن پاک‌شده بازسازی نمی‌کند
+        session.base_analysis = None
         session.pending = None
         session.state = BotState.WAIT_FILE
+        self.save(chat_id)
+
+
+def _take_model(data: bytes) -> WorkbookModel:
+    model = workbook_cache.take(("model", None, digest_bytes(data)))
+    return model if model is not None else WorkbookModel.from_bytes(data)
 
 
-def _wb_from_bytes(data: bytes):
-    return load_workbook(BytesIO(data))
+def _op_to_dict(op: PendingOperation) -> dict:
+    data = asdict(op)
+    data["selected"] = sorted(op.selected)
+    return data
 
 
-def _bytes_from_wb(wb) -> bytes:
-    output = BytesIO()
-    wb.save(output)
-    return output.getvalue()
+def _op_from_dict(data: dict) -> PendingOperation:
+    return PendingOperation(
+        op_kind=data["op_kind"],
+        target_kind=data["target_kind"],
+        mode=data["mode"],
+        selected=set(data["selected"]),
+        payload_lines=list(data["payload_lines"]),
+    )
+
+
+@contextmanager
+def _open_original(session: SessionData):
+    if session.original_path:
+        with MappedFile(session.original_path) as source:
+            yield source
+    else:
+        yield BytesIO(session.original_bytes)
 
 
 def analyze_workbook(file_bytes: bytes) -> dict:
-    wb = _wb_from_bytes(file_bytes)
-    result = {"sheets": []}
-    for sheet in wb.worksheets:
-        row_count = sheet.max_row
-        col_count = sheet.max_column
-        headers = [sheet.cell(row=1, column=i).value for i in range(1, col_count + 1)]
-        result["sheets"].append(
-            {
-                "name": sheet.title,
-                "rows": row_count,
-                "cols": col_count,
-                "headers": headers,
-            }
-        )
-    return result
+    key = ("analysis", None, digest_bytes(file_bytes))
+    return workbook_cache.get_or_load(key, lambda: scan_workbook(BytesIO(file_bytes)), analysis_cost)
 
 
 def get_sheet_map(file_bytes: bytes, sheet_name: str) -> tuple[list[str], list[int]]:
-    wb = _wb_from_bytes(file_bytes)
-    sheet = wb[sheet_name]
-    headers = [str(sheet.cell(row=1, column=i).value or f"Column_{i}") for i in range(1, sheet.max_column + 1)]
-    rows = list(range(2, sheet.max_row + 1))
+    sheet = next(sh for sh in analyze_workbook(file_bytes)["sheets"] if sh["name"] == sheet_name)
+    headers = [str(h or f"Column_{i}") for i, h in enumerate(sheet["headers"], start=1)]
+    rows = list(range(2, sheet["rows"] + 1))
     return headers, rows
 
 
 def apply_operation(working_bytes: bytes, sheet_name: str, op: PendingOperation) -> bytes:
-    wb = _wb_from_bytes(working_bytes)
-    sheet = wb[sheet_name]
+    model = _take_model(working_bytes)
+    apply_to_model(model[sheet_name], op)
+    output = model.to_bytes()
+    workbook_cache.put(("model", None, digest_bytes(output)), model, len(output) * DEFAULT_EXPANSION)
+    return output
+
 
+def apply_to_model(sheet: SheetModel, op: PendingOperation):
     if not op.selected:
         raise ValueError("هیچ آیتمی انتخاب نشده است")
 
@@ -111,12 +377,10 @@ def apply_operation(working_bytes: bytes, sheet_name: str, op: PendingOperation)
 
     if op.op_kind == "delete":
         if op.target_kind == "column":
-            for idx in sorted(selected, reverse=True):
-                sheet.delete_cols(idx, 1)
+            sheet.delete_cols(selected)
         else:
-            for idx in sorted(selected, reverse=True):
-                sheet.delete_rows(idx, 1)
-        return _bytes_from_wb(wb)
+            sheet.delete_rows(selected)
+        return
 
     if op.op_kind in {"add", "edit"}:
         if not op.payload_lines:
@@ -127,42 +391,39 @@ def apply_operation(working_bytes: bytes, sheet_name: str, op: PendingOperation)
             if op.target_kind == "column":
                 for col in selected:
                     for row in range(2, sheet.max_row + 1):
-                        sheet.cell(row=row, column=col).value = text
+                        sheet.set(row, col, text)
             else:
                 for row_idx in selected:
                     for col in range(1, sheet.max_column + 1):
-                        sheet.cell(row=row_idx, column=col).value = text
-            return _bytes_from_wb(wb)
+                        sheet.set(row_idx, col, text)
+            return
 
         # add
         if op.target_kind == "column":
             if op.mode == "single":
                 text = "\n".join(op.payload_lines).strip()
                 for col in selected:
-                    target_row = sheet.max_row + 1
-                    sheet.cell(row=target_row, column=col).value = text
+                    sheet.set(sheet.max_row + 1, col, text)
             else:
                 lines = [line for line in op.payload_lines if line.strip()]
                 for col in selected:
                     for line in lines:
-                        target_row = sheet.max_row + 1
-                        sheet.cell(row=target_row, column=col).value = line
-            return _bytes_from_wb(wb)
+                        sheet.set(sheet.max_row + 1, col, line)
+            return
 
         # row target
         if op.mode == "single":
             text = "\n".join(op.payload_lines).strip()
             for row_idx in selected:
-                target_col = sheet.max_column + 1
-                sheet.cell(row=row_idx, column=target_col).value = text
+                sheet.set(row_idx, sheet.max_column + 1, text)
         else:
             lines = [line for line in op.payload_lines if line.strip()]
             for row_idx in selected:
                 col = sheet.max_column + 1
                 for line in lines:
-                    sheet.cell(row=row_idx, column=col).value = line
+                    sheet.set(row_idx, col, line)
                     col += 1
-        return _bytes_from_wb(wb)
+        return
 
     raise ValueError("نوع عملیات پشتیبانی نمی‌شود")
 
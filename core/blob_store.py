@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - ویندوز
+    fcntl = None
+
+# ioctl لینوکس برای reflink (btrfs/xfs)
+_FICLONE = 0x40049409
+
+
+def clone_file(src: str | Path, dst: str | Path) -> str:
+    """کپی ارزان: hardlink، در صورت عدم امکان reflink و در نهایت کپی کامل.
+
+    نسخه‌ها فایل مشترک دارند، پس هر نوشتنی باید با `atomic_write` انجام شود تا
+    لینک شکسته شود (copy-on-write).
+    """
+    dst = Path(dst)
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+        return "link"
+    except OSError:
+        pass
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            return "reflink"
+        except OSError:
+            dst.unlink(missing_ok=True)
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def atomic_write(path: str | Path, writer) -> None:
+    """`writer(fileobj)` را در فایل موقت همان پوشه می‌نویسد و بعد جایگزین می‌کند."""
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp_", suffix=path.suffix, dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            writer(fh)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+class MappedFile(io.RawIOBase):
+    """فایل فقط‌خواندنی از روی mmap؛ داده تا زمان خواندن در page cache می‌ماند نه در heap.
+
+    mmap خودش `seekable()` ندارد و zipfile/openpyxl آن را لازم دارند.
+    """
+
+    def __init__(self, path: str | Path):
+        self.name = str(path)
+        with open(path, "rb") as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        chunk = self._map[self._pos : self._pos + len(buffer)]
+        buffer[: len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._map)}[whence]
+        self._pos = max(base + offset, 0)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._map.close()
+        super().close()
+
+
+def _touch(path: Path):
+    # blob تازه استفاده‌شده نباید قبل از checkout توسط GC حذف شود
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _copy_into(source: str | Path, fh):
+    with open(source, "rb") as src:
+        shutil.copyfileobj(src, fh)
+
+
+class BlobStore:
+    """ذخیره‌ساز محتوامحور: هر محتوا یک‌بار با کلید SHA-256 ذخیره می‌شود.
+
+    نسخه‌های کاری/تاریخچه hardlink به blob هستند و شمار ارجاع همان `st_nlink - 1` است.
+    """
+
+    def __init__(self, base_dir: str = "storage/blobs"):
+        self.base_dir = Path(base_dir)
+        self.base_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, digest: str) -> Path:
+        return self.base_dir / digest[:2] / f"{digest}.xlsx"
+
+    def put_bytes(self, data: bytes, *dests: str | Path, digest: str | None = None) -> str:
+        """محتوا را ذخیره و در `dests` checkout می‌کند؛ `digest` اگر از قبل حساب شده باشد."""
+        digest = digest or hashlib.sha256(data).hexdigest()
+        self._put(digest, lambda fh: fh.write(data), dests)
+        return digest
+
+    def put_file(self, source: str | Path, *dests: str | Path) -> str:
+        sha = hashlib.sha256()
+        with open(source, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        # فایل بیرونی ممکن است درجا بازنویسی شود، پس کپی می‌کنیم نه لینک
+        self._put(digest, lambda fh: _copy_into(source, fh), dests)
+        return digest
+
+    def _put(self, digest: str, writer, dests) -> None:
+        target = self.path(digest)
+        if target.exists():
+            _touch(target)
+        else:
+            self._write(target, writer)
+        for dest in dests:
+            try:
+                clone_file(target, dest)
+            except FileNotFoundError:
+                # GC پس‌زمینه blob بی‌ارجاع را بین exists و checkout حذف کرده است
+                self._write(target, writer)
+                clone_file(target, dest)
+
+    @staticmethod
+    def _write(target: Path, writer) -> None:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(target, writer)
+
+    def checkout(self, digest: str, dest: str | Path) -> str:
+        clone_file(self.path(digest), dest)
+        return str(dest)
+
+    def refcount(self, digest: str) -> int:
+        try:
+            return self.path(digest).stat().st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    def collect_garbage(self, min_age_seconds: float = 0) -> tuple[int, int]:
+        removed = reclaimed = 0
+        cutoff = time.time() - min_age_seconds
+        for blob in self.base_dir.glob("*/*.xlsx"):
+            try:
+                stat = blob.stat()
+            except FileNotFoundError:
+                continue
+            if stat.st_nlink <= 1 and max(stat.st_mtime, stat.st_ctime) <= cutoff:
+                blob.unlink(missing_ok=True)
+                removed += 1
+                reclaimed += stat.st_size
+        return removed, reclaimed
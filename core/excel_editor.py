@@ -1,5 +1,71 @@
 from __future__ import annotations
 
+from openpyxl.utils import column_index_from_string, get_column_letter
+
+
+def _shift_table(drop: set[int], limit: int) -> list[int]:
+    table = [0] * (limit + 1)
+    removed = 0
+    for idx in range(1, limit + 1):
+        if idx in drop:
+            removed += 1
+        table[idx] = idx - removed
+    return table
+
+
+def delete_rows_bulk(sheet, rows):
+    """حذف چند سطر در یک گذر؛ سلول‌های باقی‌مانده با استایلشان جابه‌جا می‌شوند."""
+    limit = sheet.max_row
+    drop = {r for r in rows if 1 <= r <= limit}
+    if not drop:
+        return
+    shift = _shift_table(drop, limit)
+    cells = {}
+    for (r, c), cell in sheet._cells.items():
+        if r in drop:
+            continue
+        cell.row = shift[r]
+        cells[(cell.row, c)] = cell
+    sheet._cells = cells
+
+    dims = [dim for idx, dim in sheet.row_dimensions.items() if idx not in drop]
+    sheet.row_dimensions.clear()
+    for dim in dims:
+        dim.index = shift[dim.index] if dim.index <= limit else dim.index - len(drop)
+        sheet.row_dimensions[dim.index] = dim
+
+
+def delete_cols_bulk(sheet, cols):
+    """حذف چند ستون در یک گذر؛ عرض ستون‌های باقی‌مانده هم جابه‌جا می‌شود."""
+    limit = sheet.max_column
+    drop = {c for c in cols if 1 <= c <= limit}
+    if not drop:
+        return
+    shift = _shift_table(drop, limit)
+    cells = {}
+    for (r, c), cell in sheet._cells.items():
+        if c in drop:
+            continue
+        cell.column = shift[c]
+        cells[(r, cell.column)] = cell
+    sheet._cells = cells
+
+    dims = list(sheet.column_dimensions.values())
+    sheet.column_dimensions.clear()
+    for dim in dims:
+        start = dim.min or column_index_from_string(dim.index)
+        end = dim.max or start
+        if start > limit:
+            start, end = start - len(drop), end - len(drop)
+        else:
+            kept = [c for c in range(start, min(end, limit) + 1) if c not in drop]
+            if not kept:
+                continue
+            start, end = shift[kept[0]], shift[kept[-1]] + max(end - limit, 0)
+        dim.index = get_column_letter(start)
+        dim.min, dim.max = start, end
+        sheet.column_dimensions[dim.index] = dim
+
 
 class ExcelEditor:
     def __init__(self, sheet):
@@ -13,7 +79,7 @@ class ExcelEditor:
                 cell.value = round(cell.value * factor, 4)
 
     def delete_column(self, col_index: int):
-        self.sheet.delete_cols(col_index, amount=1)
+        delete_cols_bulk(self.sheet, [col_index])
 
     def execute_blueprint(self, blueprint: dict, column_map: dict):
         action = blueprint["action"]
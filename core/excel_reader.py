@@ -2,16 +2,68 @@ from __future__ import annotations
 
 from openpyxl import load_workbook
 
+from core.blob_store import atomic_write
+from core.workbook_cache import WorkbookCache, analysis_cost, workbook_cache
+
+
+def scan_workbook(source) -> dict:
+    """Sheet names, dimensions and header row without materializing the workbook.
+
+    `source` is a path or a binary file object. Only the `<dimension>` tag and the
+    first row of every worksheet are parsed; sheets without a dimension tag fall back
+    to a single streaming pass over their rows.
+    """
+    wb = load_workbook(source, read_only=True)
+    try:
+        sheets = []
+        for ws in wb.worksheets:
+            max_row, max_col = ws.max_row, ws.max_column
+            if not max_row or not max_col:
+                max_row, max_col = _scan_dimensions(ws)
+            header_row = next(ws.iter_rows(min_row=1, max_row=1, max_col=max_col, values_only=True), ())
+            headers = list(header_row) + [None] * (max_col - len(header_row))
+            sheets.append(
+                {
+                    "name": ws.title,
+                    "rows": max_row,
+                    "cols": max_col,
+                    "headers": headers[:max_col],
+                }
+            )
+        return {"sheets": sheets}
+    finally:
+        wb.close()
+
+
+def _scan_dimensions(ws) -> tuple[int, int]:
+    ws.reset_dimensions()
+    max_row = max_col = 0
+    for idx, row in enumerate(ws.iter_rows(values_only=True), start=1):
+        if row:
+            max_row = idx
+            max_col = max(max_col, len(row))
+    # openpyxl گزارش شیت خالی را 1×1 می‌دهد
+    return max(max_row, 1), max(max_col, 1)
+
 
 class ExcelReader:
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, file_id: str | None = None, cache: WorkbookCache | None = None):
         self.file_path = file_path
+        self.file_id = file_id
+        self.cache = cache or workbook_cache
         self.workbook = None
 
     def load(self):
-        self.workbook = load_workbook(filename=self.file_path, data_only=False)
+        key = ("workbook", self.file_id, self.cache.digest_path(self.file_path))
+        self.workbook = self.cache.take(key)
+        if self.workbook is None:
+            self.workbook = load_workbook(filename=self.file_path, data_only=False)
         return self.workbook
 
+    def scan(self) -> dict:
+        key = ("analysis", self.file_id, self.cache.digest_path(self.file_path))
+        return self.cache.get_or_load(key, lambda: scan_workbook(self.file_path), analysis_cost)
+
     def get_sheets(self):
         if not self.workbook:
             raise RuntimeError("Workbook not loaded")
@@ -28,5 +80,5 @@ class ExcelReader:
         if not self.workbook:
             raise RuntimeError("Workbook not loaded")
         target = destination or self.file_path
-        self.workbook.save(target)
+        atomic_write(target, self.workbook.save)
         return target
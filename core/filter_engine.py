@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+# pandas/numpy فقط هنگام اجرای فیلتر import می‌شوند تا parse شرط و راه‌اندازی ربات سبک بماند
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+_EMPTY_RE = re.compile(r"^(?P<col>.+?)\s+(?P<op>is empty|not empty)\s*$", re.IGNORECASE)
+_RANGE_RE = re.compile(r"^(?P<col>.+?)\s+in\s+(?P<low>[-\d.]+)\s*\.\.\s*(?P<high>[-\d.]+)\s*$", re.IGNORECASE)
+_CMP_RE = re.compile(r"^(?P<col>.+?)\s*(?P<op>!=|>=|<=|=|>|<|~)\s*(?P<val>.*)$")
+
+
+@dataclass
+class Predicate:
+    column: str
+    op: str  # eq / ne / gt / ge / lt / le / regex / contains / empty / not_empty / range
+    value: object = None
+
+
+@dataclass
+class FilterQuery:
+    """شرط‌های فیلتر به شکل OR از گروه‌های AND.
+
+    نمونه: ``city = Tehran & price in 10..20 | name ~ "^A|^B" | note is empty``
+    """
+
+    groups: list[list[Predicate]] = field(default_factory=list)
+
+    @classmethod
+    def contains(cls, column: str, keyword: str) -> "FilterQuery":
+        return cls(groups=[[Predicate(column=column, op="contains", value=keyword)]])
+
+    @classmethod
+    def parse(cls, text: str) -> "FilterQuery":
+        groups = []
+        for group_text in _split_top_level(text, "|"):
+            group = [_parse_clause(clause) for clause in _split_top_level(group_text, "&")]
+            groups.append(group)
+        if not groups or not all(groups):
+            raise ValueError("شرط فیلتر خالی است")
+        return cls(groups=groups)
+
+    def columns(self) -> list[str]:
+        seen = []
+        for group in self.groups:
+            for pred in group:
+                if pred.column not in seen:
+                    seen.append(pred.column)
+        return seen
+
+    def mask(self, frame: pd.DataFrame) -> np.ndarray:
+        import numpy as np
+
+        result = np.zeros(len(frame), dtype=bool)
+        for group in self.groups:
+            group_mask = np.ones(len(frame), dtype=bool)
+            for pred in group:
+                group_mask &= _predicate_mask(frame[pred.column], pred)
+            result |= group_mask
+        return result
+
+
+def _split_top_level(text: str, sep: str) -> list[str]:
+    parts, buf, quoted = [], [], False
+    for ch in text:
+        if ch == '"':
+            quoted = not quoted
+        if ch == sep and not quoted:
+            parts.append("".join(buf).strip())
+            buf = []
+        else:
+            buf.append(ch)
+    parts.append("".join(buf).strip())
+    return [p for p in parts if p]
+
+
+def _unquote(value: str) -> str:
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1]
+    return value
+
+
+def _parse_clause(clause: str) -> Predicate:
+    match = _EMPTY_RE.match(clause)
+    if match:
+        op = "empty" if match.group("op").lower() == "is empty" else "not_empty"
+        return Predicate(column=_unquote(match.group("col")), op=op)
+
+    match = _RANGE_RE.match(clause)
+    if match:
+        low, high = float(match.group("low")), float(match.group("high"))
+        return Predicate(column=_unquote(match.group("col")), op="range", value=(low, high))
+
+    match = _CMP_RE.match(clause)
+    if not match:
+        raise ValueError(f"شرط نامعتبر: {clause}")
+    column, symbol, raw = _unquote(match.group("col")), match.group("op"), _unquote(match.group("val"))
+    if symbol == "~":
+        try:
+            re.compile(raw)
+        except re.error as exc:
+            raise ValueError(f"الگوی regex نامعتبر است: {raw}") from exc
+        return Predicate(column=column, op="regex", value=raw)
+    if symbol in {"=", "!="}:
+        return Predicate(column=column, op="eq" if symbol == "=" else "ne", value=raw)
+    try:
+        number = float(raw)
+    except ValueError as exc:
+        raise ValueError(f"مقدار عددی نامعتبر است: {raw}") from exc
+    op = {">": "gt", ">=": "ge", "<": "lt", "<=": "le"}[symbol]
+    return Predicate(column=column, op=op, value=number)
+
+
+def _as_text(series: pd.Series) -> pd.Series:
+    return series.astype(object).where(series.notna(), "").astype(str)
+
+
+def _predicate_mask(series: pd.Series, pred: Predicate) -> np.ndarray:
+    import pandas as pd
+
+    if pred.op in {"empty", "not_empty"}:
+        empty = (series.isna() | (_as_text(series).str.strip() == "")).to_numpy()
+        return empty if pred.op == "empty" else ~empty
+
+    if pred.op in {"eq", "ne"}:
+        equal = (_as_text(series) == pred.value).to_numpy()
+        try:
+            number = float(pred.value)
+        except (TypeError, ValueError):
+            number = None
+        if number is not None:
+            equal |= (pd.to_numeric(series, errors="coerce") == number).to_numpy()
+        return equal if pred.op == "eq" else ~equal
+
+    if pred.op == "contains":
+        return _as_text(series).str.contains(str(pred.value), regex=False).to_numpy()
+
+    if pred.op == "regex":
+        return _as_text(series).str.contains(pred.value, regex=True).to_numpy()
+
+    numbers = pd.to_numeric(series, errors="coerce")
+    if pred.op == "range":
+        low, high = pred.value
+        return numbers.between(low, high).to_numpy()
+    compare = {"gt": numbers.gt, "ge": numbers.ge, "lt": numbers.lt, "le": numbers.le}[pred.op]
+    return compare(pred.value).to_numpy()
+
+
+def load_columns(sheet, headers: list[str], columns: list[str]) -> pd.DataFrame:
+    import pandas as pd
+
+    data = {}
+    for name in columns:
+        if name not in headers:
+            raise ValueError(f"ستون {name} یافت نشد")
+        col_idx = headers.index(name) + 1
+        values = next(sheet.iter_cols(min_col=col_idx, max_col=col_idx, min_row=2, values_only=True), ())
+        data[name] = pd.Series(values, dtype=object)
+    return pd.DataFrame(data)
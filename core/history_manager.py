@@ -1,13 +1,16 @@
 # core/history_manager.py
 
 import os
-import shutil
 from datetime import datetime
 
+from core.blob_store import BlobStore
+
 class HistoryManager:
-    def __init__(self, base_dir="storage/versions"):
+    def __init__(self, base_dir="storage/versions", blob_store=None):
         self.base_dir = base_dir
         os.makedirs(self.base_dir, exist_ok=True)
+        parent = os.path.dirname(os.path.abspath(self.base_dir))
+        self.blobs = blob_store or BlobStore(os.path.join(parent, "blobs"))
 
     def save_version(self, file_id, source_file, tag):
         file_dir = os.path.join(self.base_dir, file_id)
@@ -17,7 +20,8 @@ class HistoryManager:
         version_name = f"{timestamp}_{tag}.xlsx"
         dest_path = os.path.join(file_dir, version_name)
 
-        shutil.copy2(source_file, dest_path)
+        # نسخه‌های با محتوای یکسان فقط یک blob مشترک دارند
+        self.blobs.put_file(source_file, dest_path)
         return dest_path
 
     def list_versions(self, file_id):
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+from copy import copy
+from dataclasses import dataclass, field
+from typing import Any
+
+from openpyxl.cell.cell import MergedCell
+from openpyxl.formatting.formatting import ConditionalFormattingList
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.worksheet.cell_range import CellRange, MultiCellRange
+from openpyxl.worksheet.merge import MergedCellRange
+
+
+@dataclass
+class OperationPlan:
+    """اجرای تأخیری عملیات‌ها روی یک شیت.
+
+    سطرها و ستون‌ها با شناسه ثابت دنبال می‌شوند (اصلی‌ها مثبت، جدیدها منفی)، پس
+    جابه‌جایی اندیس‌ها بعد از حذف‌ها فقط روی لیست شناسه‌ها اعمال می‌شود و کل برنامه
+    در زمان ذخیره در یک گذر روی شیت اجرا می‌شود.
+    """
+
+    base_rows: int
+    base_cols: int
+    ops: list[Any] = field(default_factory=list)
+    rows: list[int] = field(init=False)
+    cols: list[int] = field(init=False)
+    values: dict[tuple[int, int], Any] = field(init=False)
+    _next_id: int = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.rows = list(range(1, self.base_rows + 1))
+        self.cols = list(range(1, self.base_cols + 1))
+        self.values = {}
+        self._next_id = -1
+
+    @property
+    def max_row(self) -> int:
+        return max(len(self.rows), 1)
+
+    @property
+    def max_column(self) -> int:
+        return max(len(self.cols), 1)
+
+    def _new_id(self) -> int:
+        new_id = self._next_id
+        self._next_id -= 1
+        return new_id
+
+    def _set(self, row: int, col: int, value: Any):
+        while len(self.rows) < row:
+            self.rows.append(self._new_id())
+        while len(self.cols) < col:
+            self.cols.append(self._new_id())
+        self.values[(self.rows[row - 1], self.cols[col - 1])] = value
+
+    def append(self, op):
+        self._apply(op)
+        self.ops.append(op)
+
+    def pop(self):
+        if not self.ops:
+            return None
+        op = self.ops.pop()
+        self._reset()
+        for earlier in self.ops:
+            self._apply(earlier)
+        return op
+
+    def _apply(self, op):
+        if not op.selected:
+            raise ValueError("هیچ آیتمی انتخاب نشده است")
+        selected = sorted(op.selected)
+        if op.target_kind == "column":
+            if any(i < 1 or i > self.max_column for i in selected):
+                raise ValueError("ستون انتخاب‌شده معتبر نیست (احتمالاً قبلاً حذف شده)")
+        elif any(i < 2 or i > self.max_row for i in selected):
+            raise ValueError("سطر انتخاب‌شده معتبر نیست (احتمالاً قبلاً حذف شده)")
+
+        if op.op_kind == "delete":
+            drop = {i - 1 for i in selected}
+            if op.target_kind == "column":
+                self.cols = [c for i, c in enumerate(self.cols) if i not in drop]
+            else:
+                self.rows = [r for i, r in enumerate(self.rows) if i not in drop]
+            return
+
+        if op.op_kind not in {"add", "edit"}:
+            raise ValueError("نوع عملیات پشتیبانی نمی‌شود")
+        if not op.payload_lines:
+            raise ValueError("متنی برای عملیات ثبت نشده است")
+
+        text = "\n".join(op.payload_lines).strip()
+        lines = [line for line in op.payload_lines if line.strip()]
+        if op.op_kind == "edit":
+            if op.target_kind == "column":
+                for col in selected:
+                    for row in range(2, self.max_row + 1):
+                        self._set(row, col, text)
+            else:
+                for row in selected:
+                    for col in range(1, self.max_column + 1):
+                        self._set(row, col, text)
+            return
+
+        if op.target_kind == "column":
+            for col in selected:
+                for line in ([text] if op.mode == "single" else lines):
+                    self._set(self.max_row + 1, col, line)
+            return
+
+        for row in selected:
+            col = self.max_column + 1
+            for line in ([text] if op.mode == "single" else lines):
+                self._set(row, col, line)
+                col += 1
+
+    def preview(self, sample: int = 20) -> dict:
+        kept_rows = set(self.rows)
+        kept_cols = set(self.cols)
+        touched_ids = {rid for rid, _ in self.values}
+        touched_rows = [i for i, rid in enumerate(self.rows, start=1) if rid in touched_ids]
+        return {
+            "operations": len(self.ops),
+            "rows": len(self.rows),
+            "cols": len(self.cols),
+            "deleted_rows": sum(1 for r in range(1, self.base_rows + 1) if r not in kept_rows),
+            "deleted_cols": sum(1 for c in range(1, self.base_cols + 1) if c not in kept_cols),
+            "new_rows": sum(1 for r in self.rows if r < 0),
+            "new_cols": sum(1 for c in self.cols if c < 0),
+            "changed_cells": len(self.values),
+            "touched_rows": len(touched_rows),
+            "touched_rows_sample": touched_rows[:sample],
+        }
+
+    def headers(self, base_headers: list[Any]) -> list[Any]:
+        first = self.rows[0] if self.rows else None
+        result = []
+        for cid in self.cols:
+            if first is not None and (first, cid) in self.values:
+                result.append(self.values[(first, cid)])
+            elif first == 1 and 0 < cid <= len(base_headers):
+                result.append(base_headers[cid - 1])
+            else:
+                result.append(None)
+        return result
+
+    def execute(self, sheet):
+        """کل برنامه را در یک گذر روی worksheet اجرا می‌کند؛ استایل سلول‌ها حفظ می‌شود."""
+        row_pos, col_pos = remap_sheet(sheet, self.rows, self.cols)
+        for (rid, cid), value in self.values.items():
+            nr, nc = row_pos.get(rid), col_pos.get(cid)
+            if nr is not None and nc is not None:
+                sheet.cell(row=nr, column=nc).value = value
+
+
+def remap_sheet(sheet, rows: list[int], cols: list[int]) -> tuple[dict[int, int], dict[int, int]]:
+    """سلول‌ها و ابعاد worksheet را به ترتیب شناسه‌های `rows`/`cols` جابه‌جا می‌کند.
+
+    شناسه‌های مثبت سطر/ستون فایل اصلی‌اند؛ سلول‌هایی که شناسه‌شان نمانده حذف
+    می‌شوند. نگاشت شناسه به موقعیت جدید برگردانده می‌شود.
+    """
+    row_pos = {rid: i for i, rid in enumerate(rows, start=1)}
+    col_pos = {cid: i for i, cid in enumerate(cols, start=1)}
+    cells = {}
+    for (r, c), cell in sheet._cells.items():
+        nr, nc = row_pos.get(r), col_pos.get(c)
+        if nr is None or nc is None:
+            continue
+        cell.row, cell.column = nr, nc
+        cells[(nr, nc)] = cell
+    sheet._cells = cells
+    for cell in cells.values():
+        if cell.hyperlink is not None:
+            cell.hyperlink.ref = cell.coordinate
+    _remap_ranges(sheet, row_pos, col_pos)
+
+    row_dims = [(row_pos[idx], dim) for idx, dim in sheet.row_dimensions.items() if idx in row_pos]
+    sheet.row_dimensions.clear()
+    for idx, dim in row_dims:
+        dim.index = idx
+        sheet.row_dimensions[idx] = dim
+
+    col_dims = []
+    for dim in sheet.column_dimensions.values():
+        start = dim.min or column_index_from_string(dim.index)
+        for c in range(start, (dim.max or start) + 1):
+            if c in col_pos:
+                col_dims.append((col_pos[c], copy(dim)))
+    sheet.column_dimensions.clear()
+    for idx, dim in col_dims:
+        dim.index = get_column_letter(idx)
+        dim.min = dim.max = idx
+        sheet.column_dimensions[dim.index] = dim
+    return row_pos, col_pos
+
+
+def _move_range(rng: CellRange, row_pos: dict[int, int], col_pos: dict[int, int], anchored: bool = False) -> str | None:
+    """محدوده جدید یک range؛ None اگر چیزی از آن نمانده (یا در حالت anchored سطر/ستون اول حذف شده)."""
+    rows = [row_pos[r] for r in range(rng.min_row, rng.max_row + 1) if r in row_pos]
+    cols = [col_pos[c] for c in range(rng.min_col, rng.max_col + 1) if c in col_pos]
+    if not rows or not cols:
+        return None
+    if anchored and (rng.min_row not in row_pos or rng.min_col not in col_pos):
+        return None
+    return CellRange(min_row=min(rows), min_col=min(cols), max_row=max(rows), max_col=max(cols)).coord
+
+
+def _move_multi(sqref, row_pos: dict[int, int], col_pos: dict[int, int]) -> str | None:
+    moved = [_move_range(rng, row_pos, col_pos) for rng in MultiCellRange(str(sqref)).ranges]
+    moved = [coord for coord in moved if coord]
+    return " ".join(moved) or None
+
+
+def _remap_ranges(sheet, row_pos: dict[int, int], col_pos: dict[int, int]):
+    # merge، قالب‌بندی شرطی، اعتبارسنجی داده و فیلتر با مختصات ذخیره می‌شوند و باید همراه سلول‌ها جابه‌جا شوند
+    merged = []
+    for rng in sheet.merged_cells.ranges:
+        coord = _move_range(rng, row_pos, col_pos, anchored=True)
+        if coord is not None and ":" in coord:
+            merged.append(coord)
+    sheet.merged_cells.ranges = set()
+    covered = set()
+    for coord in merged:
+        mcr = MergedCellRange(sheet, coord)
+        sheet.merged_cells.add(mcr)
+        covered.update(mcr.cells)
+        mcr.format()
+    # MergedCellهای range حذف‌شده یا کوچک‌شده سلول خالی بی‌صاحب می‌شوند
+    for key in [key for key, cell in sheet._cells.items() if isinstance(cell, MergedCell) and key not in covered]:
+        del sheet._cells[key]
+
+    formatting = sheet.conditional_formatting
+    sheet.conditional_formatting = ConditionalFormattingList()
+    for cf in formatting:
+        coord = _move_multi(cf.sqref, row_pos, col_pos)
+        if coord is not None:
+            for rule in cf.rules:
+                sheet.conditional_formatting.add(coord, rule)
+
+    validations = []
+    for dv in sheet.data_validations.dataValidation:
+        coord = _move_multi(dv.sqref, row_pos, col_pos)
+        if coord is not None:
+            dv.sqref = MultiCellRange(coord)
+            validations.append(dv)
+    sheet.data_validations.dataValidation = validations
+
+    if sheet.auto_filter.ref:
+        sheet.auto_filter.ref = _move_range(CellRange(sheet.auto_filter.ref), row_pos, col_pos, anchored=True)
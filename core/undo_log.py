@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import pickle
+import shutil
+import tempfile
+from collections import deque
+from pathlib import Path
+
+from core.working_model import SheetDelta
+
+
+class UndoLog:
+    """پشته Undo بر پایه دلتاهای معکوس با سقف حافظه برای هر سشن.
+
+    وقتی حجم دلتاهای داخل حافظه از `budget_bytes` بیشتر شود، قدیمی‌ترین‌ها به
+    `spill_dir` منتقل می‌شوند؛ اگر `spill_dir` تنظیم نشده باشد دور ریخته می‌شوند.
+    """
+
+    def __init__(self, budget_bytes: int = 8 * 1024 * 1024, spill_dir: str | None = None):
+        self.budget_bytes = budget_bytes
+        self.spill_dir = spill_dir
+        self._spilled: list[Path] = []
+        self._memory: deque[SheetDelta] = deque()
+        self._memory_bytes = 0
+        self._dir: Path | None = None
+
+    def __len__(self) -> int:
+        return len(self._spilled) + len(self._memory)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    def append(self, delta: SheetDelta) -> int:
+        """تعداد دلتاهای قدیمی که دور ریخته شدند (و دیگر Undo ندارند) را برمی‌گرداند."""
+        self._memory.append(delta)
+        self._memory_bytes += delta.size_hint()
+        dropped = 0
+        while self._memory_bytes > self.budget_bytes and len(self._memory) > 1:
+            oldest = self._memory.popleft()
+            self._memory_bytes -= oldest.size_hint()
+            if self.spill_dir is not None:
+                self._spill(oldest)
+            else:
+                dropped += 1
+        return dropped
+
+    def pop(self) -> SheetDelta | None:
+        if self._memory:
+            delta = self._memory.pop()
+            self._memory_bytes -= delta.size_hint()
+            return delta
+        if self._spilled:
+            path = self._spilled.pop()
+            delta = pickle.loads(path.read_bytes())
+            path.unlink(missing_ok=True)
+            return delta
+        return None
+
+    def clear(self):
+        self._memory.clear()
+        self._memory_bytes = 0
+        self._spilled.clear()
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+    def _spill(self, delta: SheetDelta):
+        if self._dir is None:
+            Path(self.spill_dir).mkdir(parents=True, exist_ok=True)
+            self._dir = Path(tempfile.mkdtemp(prefix="undo_", dir=self.spill_dir))
+        path = self._dir / f"{len(self._spilled):06d}.pkl"
+        path.write_bytes(pickle.dumps(delta, protocol=pickle.HIGHEST_PROTOCOL))
+        self._spilled.append(path)
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+# هزینه تقریبی یک workbook پارس‌شده نسبت به حجم فایل فشرده xlsx
+DEFAULT_EXPANSION = 10
+
+
+class WorkbookCache:
+    """کش LRU سراسری برای workbook/مدل/تحلیل‌های پارس‌شده با سقف حجمی.
+
+    کلیدها به شکل ``(kind, file_id, content_hash)`` هستند؛ چون hash محتوا جزء کلید
+    است، هر تغییری در فایل خودبه‌خود به miss منجر می‌شود.
+    """
+
+    def __init__(self, budget_bytes: int = 256 * 1024 * 1024):
+        self.budget_bytes = budget_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._size = 0
+        self._digests: dict[str, tuple[int, int, str]] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def size_bytes(self) -> int:
+        return self._size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "budget_bytes": self.budget_bytes,
+            }
+
+    def get(self, key: Hashable) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def take(self, key: Hashable) -> Any | None:
+        """مثل get، ولی مدخل را برمی‌دارد تا فراخوان بتواند شیء را تغییر دهد."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._size -= entry[1]
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, cost: int):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            if cost > self.budget_bytes:
+                return
+            self._entries[key] = (value, cost)
+            self._size += cost
+            while self._size > self.budget_bytes:
+                _, (_, evicted_cost) = self._entries.popitem(last=False)
+                self._size -= evicted_cost
+                self.evictions += 1
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any], cost: int | Callable[[Any], int]) -> Any:
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            self.put(key, value, cost(value) if callable(cost) else cost)
+        return value
+
+    def invalidate(self, file_id: str):
+        with self._lock:
+            for key in [k for k in self._entries if isinstance(k, tuple) and len(k) > 1 and k[1] == file_id]:
+                self._size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._digests.clear()
+            self._size = 0
+
+    def digest_path(self, path: str, refresh: bool = False) -> str:
+        stat = os.stat(path)
+        with self._lock:
+            known = self._digests.get(str(path))
+        if not refresh and known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+        sha = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with self._lock:
+            self._digests[str(path)] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+
+def digest_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def analysis_cost(analysis: dict) -> int:
+    return 1024 + sum(64 * (len(sh.get("headers", [])) + 4) for sh in analysis.get("sheets", []))
+
+
+workbook_cache = WorkbookCache(budget_bytes=int(os.getenv("WORKBOOK_CACHE_BYTES", 256 * 1024 * 1024)))
@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+from copy import copy
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Any, Iterator
+from xml.etree import ElementTree
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+
+from core.operation_plan import remap_sheet
+
+
+@dataclass
+class ColumnStyle:
+    width: float | None = None
+    # (font, fill, border, alignment, number_format) سلول هدر
+    header: tuple | None = field(default=None, repr=False)
+
+
+@dataclass
+class SheetDelta:
+    """تغییرات معکوس یک عملیات؛ فقط سلول‌ها/سطرها/ستون‌های تغییرکرده نگه داشته می‌شوند."""
+
+    sheet: str
+    max_row: int
+    n_cols: int
+    cells: dict[tuple[int, int], Any] = field(default_factory=dict)
+    # (موقعیت، مقادیر، شناسه سطر) و (موقعیت، مقادیر، استایل، شناسه ستون)
+    deleted_rows: list[tuple[int, list[Any], int]] = field(default_factory=list)
+    deleted_cols: list[tuple[int, list[Any], ColumnStyle | None, int]] = field(default_factory=list)
+
+    def size_hint(self) -> int:
+        values = len(self.cells) + sum(len(item[1]) for item in self.deleted_rows) + sum(len(item[1]) for item in self.deleted_cols)
+        return 128 + values * 64
+
+
+@dataclass
+class SheetModel:
+    """مقادیر یک شیت به‌صورت ستونی؛ `columns[c][r]` مقدار سطر r+1 و ستون c+1 است.
+
+    مثل OperationPlan هر سطر/ستون شناسه ثابت دارد (اصلی‌ها مثبت، جدیدها منفی) تا
+    خروجی روی workbook اصلی ساخته شود و استایل و فرمت سلول‌ها بماند.
+    """
+
+    name: str
+    columns: list[list[Any]] = field(default_factory=list)
+    max_row: int = 1
+    styles: list[ColumnStyle | None] = field(default_factory=list)
+    row_ids: list[int] = field(default_factory=list, repr=False)
+    col_ids: list[int] = field(default_factory=list, repr=False)
+    _next_id: int = field(default=-1, repr=False, compare=False)
+    _delta: SheetDelta | None = field(default=None, init=False, repr=False, compare=False)
+
+    def _new_id(self) -> int:
+        new_id = self._next_id
+        self._next_id -= 1
+        return new_id
+
+    def _grow_ids(self):
+        while len(self.row_ids) < self.max_row:
+            self.row_ids.append(self._new_id())
+        while len(self.col_ids) < len(self.columns):
+            self.col_ids.append(self._new_id())
+
+    def begin_delta(self):
+        self._grow_ids()
+        self._delta = SheetDelta(sheet=self.name, max_row=self.max_row, n_cols=len(self.columns))
+
+    def end_delta(self) -> SheetDelta:
+        delta, self._delta = self._delta, None
+        return delta
+
+    def revert(self, delta: SheetDelta):
+        self._align_styles()
+        for col, values, style, col_id in sorted(delta.deleted_cols, key=lambda item: item[0]):
+            self.columns.insert(col - 1, values)
+            self.styles.insert(col - 1, style)
+            self.col_ids.insert(col - 1, col_id)
+        for row, values, row_id in sorted(delta.deleted_rows, key=lambda item: item[0]):
+            self.row_ids.insert(row - 1, row_id)
+            for idx, value in enumerate(values):
+                column = self.columns[idx]
+                if len(column) < row - 1:
+                    column.extend([None] * (row - 1 - len(column)))
+                column.insert(row - 1, value)
+        del self.columns[delta.n_cols:]
+        del self.styles[delta.n_cols:]
+        del self.col_ids[delta.n_cols:]
+        del self.row_ids[delta.max_row:]
+        for column in self.columns:
+            del column[delta.max_row:]
+        for (row, col), value in delta.cells.items():
+            self.columns[col - 1][row - 1] = value
+        self.max_row = delta.max_row
+
+    def _align_styles(self):
+        if len(self.styles) < len(self.columns):
+            self.styles.extend([None] * (len(self.columns) - len(self.styles)))
+
+    @property
+    def max_column(self) -> int:
+        return max(len(self.columns), 1)
+
+    def get(self, row: int, col: int) -> Any:
+        if col > len(self.columns):
+            return None
+        column = self.columns[col - 1]
+        return column[row - 1] if row <= len(column) else None
+
+    def set(self, row: int, col: int, value: Any):
+        while len(self.columns) < col:
+            self.columns.append([])
+        column = self.columns[col - 1]
+        if len(column) < row:
+            column.extend([None] * (row - len(column)))
+        delta = self._delta
+        if delta is not None and col <= delta.n_cols and row <= delta.max_row and (row, col) not in delta.cells:
+            delta.cells[(row, col)] = column[row - 1]
+        column[row - 1] = value
+        self.max_row = max(self.max_row, row)
+        self._grow_ids()
+
+    def headers(self) -> list[Any]:
+        return [self.get(1, c) for c in range(1, self.max_column + 1)]
+
+    def sheet_map(self) -> tuple[list[str], list[int]]:
+        headers = [str(self.get(1, i) or f"Column_{i}") for i in range(1, self.max_column + 1)]
+        return headers, list(range(2, self.max_row + 1))
+
+    def delete_rows(self, rows: set[int] | list[int]):
+        drop = {r - 1 for r in rows if 1 <= r <= self.max_row}
+        if not drop:
+            return
+        self._grow_ids()
+        if self._delta is not None:
+            for r in sorted(drop):
+                values = [self.get(r + 1, c) for c in range(1, len(self.columns) + 1)]
+                self._delta.deleted_rows.append((r + 1, values, self.row_ids[r]))
+        for idx, column in enumerate(self.columns):
+            self.columns[idx] = [v for i, v in enumerate(column) if i not in drop]
+        self.row_ids = [rid for i, rid in enumerate(self.row_ids) if i not in drop]
+        self.max_row = max(self.max_row - len(drop), 1)
+
+    def delete_cols(self, cols: set[int] | list[int]):
+        drop = {c - 1 for c in cols}
+        self._align_styles()
+        self._grow_ids()
+        if self._delta is not None:
+            for c in sorted(drop):
+                if c < len(self.columns):
+                    self._delta.deleted_cols.append((c + 1, self.columns[c], self.styles[c], self.col_ids[c]))
+        self.columns = [column for i, column in enumerate(self.columns) if i not in drop]
+        self.styles = [style for i, style in enumerate(self.styles) if i not in drop]
+        self.col_ids = [cid for i, cid in enumerate(self.col_ids) if i not in drop]
+
+    def iter_rows(self) -> Iterator[list[Any]]:
+        columns = self.columns or [[]]
+        for r in range(self.max_row):
+            yield [column[r] if r < len(column) else None for column in columns]
+
+
+@dataclass
+class WorkbookModel:
+    sheets: dict[str, SheetModel] = field(default_factory=dict)
+    # فایل اصلی؛ خروجی روی همین workbook ساخته می‌شود تا فرمت، merge و freeze بماند
+    source: bytes | None = field(default=None, repr=False, compare=False)
+
+    def __getitem__(self, name: str) -> SheetModel:
+        return self.sheets[name]
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "WorkbookModel":
+        wb = load_workbook(BytesIO(data), read_only=True)
+        try:
+            model = cls(source=data)
+            for ws in wb.worksheets:
+                widths = _column_widths(ws)
+                header_cells = next(ws.iter_rows(min_row=1, max_row=1), ())
+                rows = [[getattr(c, "value", None) for c in header_cells]] if header_cells else []
+                rows.extend(list(row) for row in ws.iter_rows(min_row=2, values_only=True))
+                width = max((len(row) for row in rows), default=0)
+                for row in rows:
+                    row.extend([None] * (width - len(row)))
+                columns = [list(col) for col in zip(*rows)] if rows else []
+                styles = []
+                for idx in range(1, width + 1):
+                    cell = header_cells[idx - 1] if idx <= len(header_cells) else None
+                    header = _header_style(cell)
+                    styles.append(ColumnStyle(width=widths.get(idx), header=header) if header or idx in widths else None)
+                max_row = max(len(rows), 1)
+                model.sheets[ws.title] = SheetModel(
+                    name=ws.title,
+                    columns=columns,
+                    max_row=max_row,
+                    styles=styles,
+                    row_ids=list(range(1, max_row + 1)),
+                    col_ids=list(range(1, width + 1)),
+                )
+            return model
+        finally:
+            wb.close()
+
+    def analysis(self) -> dict:
+        return {
+            "sheets": [
+                {"name": sh.name, "rows": sh.max_row, "cols": sh.max_column, "headers": sh.headers()}
+                for sh in self.sheets.values()
+            ]
+        }
+
+    def save(self, target) -> None:
+        """خروجی روی workbook اصلی: سلول‌ها با شناسه سطر/ستون جابه‌جا و فقط مقادیر تغییرکرده نوشته می‌شوند."""
+        if self.source is None:
+            self._save_streaming(target)
+            return
+        wb = load_workbook(BytesIO(self.source))
+        for sheet in self.sheets.values():
+            ws = wb[sheet.name]
+            sheet._grow_ids()
+            remap_sheet(ws, sheet.row_ids, sheet.col_ids)
+            cells = ws._cells
+            for c, column in enumerate(sheet.columns, start=1):
+                for r in range(1, sheet.max_row + 1):
+                    value = column[r - 1] if r <= len(column) else None
+                    current = cells.get((r, c))
+                    if (current.value if current is not None else None) != value:
+                        ws.cell(row=r, column=c).value = value
+        wb.save(target)
+
+    def _save_streaming(self, target) -> None:
+        """مدل بدون فایل اصلی: خروجی جریانی write-only با استایل هدر و عرض ستون‌ها."""
+        wb = Workbook(write_only=True)
+        for sheet in self.sheets.values():
+            ws = wb.create_sheet(sheet.name)
+            sheet._align_styles()
+            for idx, style in enumerate(sheet.styles, start=1):
+                if style and style.width:
+                    ws.column_dimensions[get_column_letter(idx)].width = style.width
+            for r, row in enumerate(sheet.iter_rows()):
+                if r == 0:
+                    row = [_styled_cell(ws, value, style) for value, style in zip(row, sheet.styles + [None] * len(row))]
+                ws.append(row)
+        wb.save(target)
+
+    def to_bytes(self) -> bytes:
+        output = BytesIO()
+        self.save(output)
+        return output.getvalue()
+
+
+def _column_widths(ws) -> dict[int, float]:
+    # read-only بخش <cols> را نمی‌خواند؛ فقط تا شروع sheetData پارس می‌کنیم
+    widths: dict[int, float] = {}
+    with ws._get_source() as src:
+        for _, el in ElementTree.iterparse(src, events=("start",)):
+            tag = el.tag.rsplit("}", 1)[-1]
+            if tag == "col" and el.get("width"):
+                for idx in range(int(el.get("min")), int(el.get("max", el.get("min"))) + 1):
+                    widths[idx] = float(el.get("width"))
+            elif tag == "sheetData":
+                break
+    return widths
+
+
+def _header_style(cell) -> tuple | None:
+    if cell is None or not getattr(cell, "has_style", False):
+        return None
+    return (copy(cell.font), copy(cell.fill), copy(cell.border), copy(cell.alignment), cell.number_format)
+
+
+def _styled_cell(ws, value: Any, style: ColumnStyle | None):
+    if not style or not style.header:
+        return value
+    cell = WriteOnlyCell(ws, value=value)
+    cell.font, cell.fill, cell.border, cell.alignment, cell.number_format = style.header
+    return cell
@@ -1,23 +1,144 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import re
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+from logic.column_index import ColumnIndex, column_index
+
+
+@dataclass
+class AIRequest:
+    """دستور کاربر و schema فایل بدون سریال‌سازی به متن prompt."""
+
+    text: str
+    context: dict = field(default_factory=dict)
+
+    @property
+    def columns(self) -> list[str]:
+        columns = self.context.get("columns", {})
+        return list(columns.keys()) if isinstance(columns, dict) else list(columns)
+
+    @property
+    def column_index(self) -> ColumnIndex:
+        return column_index(self.columns)
 
 
 @dataclass
 class AIClient:
+    # کلاینت‌های محلی AIRequest را مستقیم مصرف می‌کنند؛ backendهای راه‌دور فقط prompt متنی می‌گیرند
+    structured = False
+    # با تغییر رفتار کلاینت بالا برود تا Blueprintهای کش‌شده قبلی استفاده نشوند
+    version = 1
+
     def complete(self, prompt: str) -> str:  # pragma: no cover - interface
         raise NotImplementedError
 
+    def complete_request(self, request: AIRequest) -> dict:  # pragma: no cover - interface
+        raise NotImplementedError
+
+
+class AsyncAIClient:
+    """رابط async برای backendهای راه‌دور؛ `IntentParser.aparse` آن را await می‌کند."""
+
+    version = 1
+
+    async def complete(self, prompt: str) -> str:  # pragma: no cover - interface
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+
+class HttpAIClient(AsyncAIClient):
+    """کلاینت LLM سازگار با chat/completions روی یک pool اتصال httpx.
+
+    تعداد درخواست‌های هم‌زمان به backend با یک semaphore سراسری محدود می‌شود، هر
+    تلاش timeout خودش را دارد و خطاهای شبکه، 429 و 5xx با backoff نمایی تکرار
+    می‌شوند. promptهای یکسانی که هم‌زمان در جریان‌اند فقط یک درخواست می‌سازند و
+    همه منتظرها همان پاسخ را می‌گیرند.
+    """
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        url: str,
+        model: str = "",
+        api_key: str | None = None,
+        max_concurrency: int = 8,
+        timeout: float = 30.0,
+        retries: int = 2,
+        backoff: float = 0.5,
+        client=None,
+    ):
+        import httpx
+
+        if max_concurrency < 1:
+            raise ValueError("حداقل یک درخواست هم‌زمان لازم است")
+        self.url = url
+        self.model = model
+        self.version = f"{model}@{url}"
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self._client = client or httpx.AsyncClient(
+            headers=headers,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.requests_sent = 0
+
+    async def complete(self, prompt: str) -> str:
+        future = self._inflight.get(prompt)
+        if future is None:
+            future = asyncio.ensure_future(self._complete(prompt))
+            self._inflight[prompt] = future
+            future.add_done_callback(lambda _: self._inflight.pop(prompt, None))
+        # shield: لغو شدن یک منتظر درخواست مشترک بقیه را لغو نمی‌کند
+        return await asyncio.shield(future)
+
+    async def _complete(self, prompt: str) -> str:
+        import httpx
+
+        payload = {"model": self.model, "messages": [{"role": "user", "content": prompt}]}
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                self.requests_sent += 1
+                try:
+                    resp = await self._client.post(self.url, json=payload, timeout=self.timeout)
+                    if resp.status_code not in self.RETRY_STATUS or attempt == self.retries:
+                        resp.raise_for_status()
+                        return resp.json()["choices"][0]["message"]["content"]
+                except httpx.TransportError:
+                    if attempt == self.retries:
+                        raise
+                await asyncio.sleep(self.backoff * 2**attempt)
+        raise AssertionError("unreachable")  # pragma: no cover
+
+    async def aclose(self):
+        await self._client.aclose()
+
 
 class RuleBasedAIClient(AIClient):
     """یک موتور ساده محلی برای تبدیل متن فارسی به Blueprint."""
 
+    structured = True
+
     def complete(self, prompt: str) -> str:
-        user_text = self._extract_user_text(prompt).strip()
+        user_text = self._extract_user_text(prompt)
         columns = self._extract_columns(prompt)
+        return json.dumps(self._blueprint(user_text, column_index(columns)), ensure_ascii=False)
+
+    def complete_request(self, request: AIRequest) -> dict:
+        return self._blueprint(request.text, request.column_index)
 
+    def _blueprint(self, user_text: str, index: ColumnIndex) -> dict:
+        user_text = user_text.strip()
         blueprint = {
             "sheet": "Sheet",
             "action": "update",
@@ -26,9 +147,12 @@ class RuleBasedAIClient(AIClient):
             "operation": {},
         }
 
-        col = self._detect_column(user_text, columns)
-        if not col:
-            return json.dumps({"error": "column_not_found"}, ensure_ascii=False)
+        mentions = index.find_all(user_text)
+        if not mentions:
+            return {"error": "column_not_found", "candidates": index.candidates(user_text)}
+        if mentions[0].column is None:
+            return {"error": "ambiguous_column", "candidates": list(mentions[0].options)}
+        col = mentions[0].column
         blueprint["target"]["column"] = col
 
         if "حذف" in user_text:
@@ -36,12 +160,12 @@ class RuleBasedAIClient(AIClient):
         else:
             percent = self._detect_percent(user_text)
             if percent is None:
-                return json.dumps({"error": "operation_not_found"}, ensure_ascii=False)
+                return {"error": "operation_not_found"}
             if any(token in user_text for token in ["کاهش", "کم", "منفی"]):
                 percent *= -1
             blueprint["operation"] = {"type": "percentage_increase", "value": percent}
 
-        return json.dumps(blueprint, ensure_ascii=False)
+        return blueprint
 
     @staticmethod
     def _extract_user_text(prompt: str) -> str:
@@ -77,10 +201,3 @@ class RuleBasedAIClient(AIClient):
     def _normalize_number_chars(text: str) -> str:
         translation = str.maketrans("۰۱۲۳۴۵۶۷۸۹٫", "0123456789.")
         return text.translate(translation)
-
-    @staticmethod
-    def _detect_column(text: str, columns: list[str]) -> str | None:
-        for col in columns:
-            if col in text:
-                return col
-        return columns[0] if columns else None
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+_DIGITS = str.maketrans(
+    {
+        **{a: str(i) for i, a in enumerate("۰۱۲۳۴۵۶۷۸۹")},
+        **{a: str(i) for i, a in enumerate("٠١٢٣٤٥٦٧٨٩")},
+        "٫": ".",
+    }
+)
+
+
+def normalize_command(text: str) -> str:
+    """فقط تغییرهای بی‌اثر بر معنا: فاصله‌ها، بزرگی/کوچکی و ارقام فارسی/عربی (علامت‌ها می‌مانند)."""
+    return " ".join(str(text).translate(_DIGITS).casefold().split())
+
+
+def schema_fingerprint(excel_context: dict) -> str:
+    """اثر انگشت شیت‌ها و نام/نوع ستون‌ها؛ نمونه مقادیر در آن نیست."""
+    columns = excel_context.get("columns", {})
+    if isinstance(columns, dict):
+        parts = [f"{name!r}\x1e{info.get('type') if isinstance(info, dict) else None}" for name, info in columns.items()]
+    else:
+        parts = [repr(name) for name in columns]
+    parts.append(repr(excel_context.get("sheets")))
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class BlueprintCache:
+    """کش پایدار Blueprintهای معتبرشده با حذف LRU.
+
+    کلید از فرمان نرمال‌شده، اثر انگشت schema و نسخه کلاینت AI و validator ساخته
+    می‌شود؛ با عوض شدن هر نسخه ورودی‌های قبلی دیگر استفاده نمی‌شوند و به مرور با LRU
+    حذف می‌شوند.
+    """
+
+    def __init__(self, db_path: str = "storage/blueprints.db", max_entries: int = 10_000):
+        if max_entries < 1:
+            raise ValueError("ظرفیت کش باید حداقل ۱ باشد")
+        if db_path != ":memory:":
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS blueprint_cache ("
+            "key TEXT PRIMARY KEY, blueprint_json TEXT NOT NULL, last_used_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_blueprint_lru ON blueprint_cache (last_used_at)")
+        self._lock = threading.Lock()
+        self._size = self.conn.execute("SELECT COUNT(*) FROM blueprint_cache").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(user_text: str, excel_context: dict, client_version, validator_version) -> str:
+        parts = [normalize_command(user_text), schema_fingerprint(excel_context), str(client_version), str(validator_version)]
+        return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            row = self.conn.execute("SELECT blueprint_json FROM blueprint_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE blueprint_cache SET last_used_at = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, blueprint: dict):
+        data = json.dumps(blueprint, ensure_ascii=False)
+        with self._lock:
+            cur = self.conn.execute(
+                "INSERT OR IGNORE INTO blueprint_cache (key, blueprint_json, last_used_at) VALUES (?, ?, ?)",
+                (key, data, time.time()),
+            )
+            if cur.rowcount == 0:
+                self.conn.execute(
+                    "UPDATE blueprint_cache SET blueprint_json = ?, last_used_at = ? WHERE key = ?",
+                    (data, time.time(), key),
+                )
+                return
+            self._size += 1
+            if self._size > self.max_entries:
+                excess = self._size - self.max_entries
+                self.conn.execute(
+                    "DELETE FROM blueprint_cache WHERE key IN "
+                    "(SELECT key FROM blueprint_cache ORDER BY last_used_at LIMIT ?)",
+                    (excess,),
+                )
+                self._size -= excess
+
+    def __len__(self) -> int:
+        return self._size
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -1,9 +1,14 @@
 from __future__ import annotations
 
+from logic.column_index import column_index
+
 
 class BlueprintValidator:
+    VERSION = 1
+
     def __init__(self, excel_analysis):
         self.analysis = excel_analysis
+        self.columns = column_index(excel_analysis)
 
     def validate(self, blueprint):
         required = ["sheet", "action", "target", "operation"]
@@ -12,8 +17,12 @@ class BlueprintValidator:
                 raise ValueError(f"کلید {key} در blueprint وجود ندارد")
 
         col = blueprint["target"].get("column")
-        if col not in self.analysis:
-            raise ValueError(f"ستون {col} وجود ندارد")
+        found = self.columns.lookup(col)
+        if found is None:
+            candidates = self.columns.matches(col) or self.columns.candidates(str(col))
+            hint = f"؛ شاید منظورتان: {'، '.join(map(str, candidates))}" if candidates else ""
+            raise ValueError(f"ستون {col} وجود ندارد{hint}")
+        col = blueprint["target"]["column"] = found
 
         col_type = self.analysis[col]["type"]
         op_type = blueprint["operation"].get("type")
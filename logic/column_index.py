@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import difflib
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Iterable
+
+# حروف عربی هم‌شکل، ارقام فارسی/عربی و اعراب به یک شکل واحد
+_CHAR_MAP = str.maketrans(
+    {
+        **{ch: "ی" for ch in "يىئ"},
+        "ك": "ک",
+        **{ch: "ه" for ch in "ةۀ"},
+        **{ch: "ا" for ch in "أإٱ"},
+        "ؤ": "و",
+        **{a: str(i) for i, a in enumerate("۰۱۲۳۴۵۶۷۸۹")},
+        **{a: str(i) for i, a in enumerate("٠١٢٣٤٥٦٧٨٩")},
+        "٫": ".",
+        "‌": " ",
+        "_": " ",
+        "-": " ",
+        "ـ": None,
+        **{chr(c): None for c in [*range(0x064B, 0x0653), 0x0670]},
+    }
+)
+
+
+def normalize_name(text: Any) -> str:
+    """شکل قابل مقایسه نام ستون یا متن کاربر."""
+    return " ".join(str(text).translate(_CHAR_MAP).casefold().split())
+
+
+@dataclass(frozen=True)
+class ColumnMention:
+    # column=None یعنی چند ستون با همین نام نرمال‌شده هستند و options آن‌ها را نگه می‌دارد
+    column: Any
+    start: int
+    end: int
+    options: tuple = ()
+
+
+class ColumnIndex:
+    """نمایه نام ستون‌های یک شیت برای پیدا کردن ستون‌های ذکرشده در فرمان.
+
+    نام‌ها نرمال‌شده در یک trie نگه داشته می‌شوند؛ `find_all` متن را یک‌بار پیمایش
+    می‌کند و در هر موقعیت طولانی‌ترین نام کامل را برمی‌دارد (price_usd بر price
+    مقدم است). نام باید در مرز کلمه شروع و تمام شود. اگر چند ستون نام نرمال‌شده
+    یکسان داشته باشند، ستونی که عیناً در متن آمده انتخاب می‌شود و در غیر این صورت
+    mention مبهم است.
+    """
+
+    def __init__(self, columns: Iterable[Any]):
+        self.columns = list(columns)
+        self._originals = set(self.columns)
+        self._names: dict[str, list[Any]] = {}
+        self._trie: dict = {}
+        for col in self.columns:
+            name = normalize_name(col)
+            if not name:
+                continue
+            if name in self._names:
+                self._names[name].append(col)
+                continue
+            self._names[name] = [col]
+            node = self._trie
+            for ch in name:
+                node = node.setdefault(ch, {})
+            node[""] = name
+        self._max_words = max((name.count(" ") + 1 for name in self._names), default=1)
+
+    def __contains__(self, column: Any) -> bool:
+        return self.lookup(column) is not None
+
+    def __len__(self) -> int:
+        return len(self._originals)
+
+    def matches(self, name: Any) -> list[Any]:
+        """همه ستون‌هایی که نام نرمال‌شده‌شان با `name` یکی است."""
+        return list(self._names.get(normalize_name(name), []))
+
+    def lookup(self, name: Any) -> Any | None:
+        """ستون اصلی برای نامی که فقط در حروف/ارقام/بزرگی‌کوچکی فرق دارد؛ None اگر مبهم باشد."""
+        if name in self._originals:
+            return name
+        found = self.matches(name)
+        return found[0] if len(found) == 1 else None
+
+    def _mention(self, name: str, raw: str, start: int, end: int) -> ColumnMention:
+        options = self._names[name]
+        if len(options) > 1:
+            exact = [col for col in options if str(col) in raw]
+            if len(exact) != 1:
+                return ColumnMention(None, start, end, tuple(options))
+            options = exact
+        return ColumnMention(options[0], start, end)
+
+    def find_all(self, text: str) -> list[ColumnMention]:
+        raw, text = text, normalize_name(text)
+        mentions: list[ColumnMention] = []
+        i, size = 0, len(text)
+        while i < size:
+            if i and text[i - 1].isalnum():
+                i += 1
+                continue
+            node, found = self._trie, None
+            j = i
+            while j < size and text[j] in node:
+                node = node[text[j]]
+                j += 1
+                if "" in node and (j == size or not text[j].isalnum()):
+                    found = (node[""], j)
+            if found:
+                mentions.append(self._mention(found[0], raw, i, found[1]))
+                i = found[1]
+            else:
+                i += 1
+        return mentions
+
+    def resolve(self, text: str) -> Any | None:
+        """اولین ستونی که در متن آمده؛ None اگر ستونی ذکر نشده یا مبهم باشد."""
+        mentions = self.find_all(text)
+        return mentions[0].column if mentions else None
+
+    def candidates(self, text: str, limit: int = 3, cutoff: float = 0.75) -> list[Any]:
+        """ستون‌های نزدیک به کلمات متن (برای غلط تایپی) به ترتیب شباهت."""
+        words = normalize_name(text).split()
+        names = list(self._names)
+        scores: dict[str, float] = {}
+        for size in range(1, self._max_words + 1):
+            for start in range(len(words) - size + 1):
+                window = " ".join(words[start : start + size])
+                for name in difflib.get_close_matches(window, names, n=limit, cutoff=cutoff):
+                    ratio = difflib.SequenceMatcher(None, window, name).ratio()
+                    scores[name] = max(scores.get(name, 0.0), ratio)
+        ranked = sorted(scores, key=lambda name: -scores[name])
+        return [col for name in ranked for col in self._names[name]][:limit]
+
+
+@lru_cache(maxsize=64)
+def _cached_index(columns: tuple) -> ColumnIndex:
+    return ColumnIndex(columns)
+
+
+def column_index(columns: Iterable[Any]) -> ColumnIndex:
+    """نمایه مشترک برای یک مجموعه ستون؛ برای هر شیت تحلیل‌شده فقط یک‌بار ساخته می‌شود."""
+    return _cached_index(tuple(columns))
@@ -1,12 +1,20 @@
 from __future__ import annotations
 
+import asyncio
+import inspect
 import json
 import re
 
+from logic.ai_client import AIRequest
+from logic.blueprint_cache import BlueprintCache
+from logic.blueprint_validator import BlueprintValidator
+from logic.column_index import column_index
+
 
 class IntentParser:
-    def __init__(self, ai_client):
+    def __init__(self, ai_client, cache: BlueprintCache | None = None):
         self.ai = ai_client
+        self.cache = cache
 
     def build_prompt(self, user_text, excel_context):
         return f"""
@@ -37,14 +45,82 @@ class IntentParser:
 """
 
     def parse(self, user_text, excel_context):
-        response = self.ai.complete(self.build_prompt(user_text, excel_context)).strip()
+        if getattr(self.ai, "structured", False):
+            # مسیر سریع محلی: بدون json.dumps کل تحلیل و parse دوباره پاسخ
+            blueprint = self.ai.complete_request(AIRequest(text=user_text, context=excel_context))
+        else:
+            if inspect.iscoroutinefunction(self.ai.complete):
+                raise TypeError("کلاینت AI async است؛ از aparse/acompile استفاده کنید")
+            blueprint = self._parse_response(self.ai.complete(self.build_prompt(user_text, excel_context)))
+            self._canonical_column(blueprint, excel_context)
+        return self._check(blueprint)
+
+    async def aparse(self, user_text, excel_context):
+        """مثل `parse` ولی رفت‌وبرگشت backend راه‌دور event loop را مسدود نمی‌کند."""
+        if getattr(self.ai, "structured", False):
+            return self.parse(user_text, excel_context)
+        prompt = self.build_prompt(user_text, excel_context)
+        if inspect.iscoroutinefunction(self.ai.complete):
+            response = await self.ai.complete(prompt)
+        else:
+            response = await asyncio.to_thread(self.ai.complete, prompt)
+        blueprint = self._parse_response(response)
+        self._canonical_column(blueprint, excel_context)
+        return self._check(blueprint)
+
+    def compile(self, user_text, excel_context):
+        """Blueprint معتبرشده؛ فرمان تکراری روی همان schema از کش می‌آید و AI صدا زده نمی‌شود."""
+        key = self._cache_key(user_text, excel_context)
+        cached = self.cache.get(key) if key else None
+        if cached is not None:
+            return cached
+        return self._store(key, self.parse(user_text, excel_context), excel_context)
+
+    async def acompile(self, user_text, excel_context):
+        key = self._cache_key(user_text, excel_context)
+        cached = self.cache.get(key) if key else None
+        if cached is not None:
+            return cached
+        return self._store(key, await self.aparse(user_text, excel_context), excel_context)
+
+    def _cache_key(self, user_text, excel_context) -> str | None:
+        # موتور محلی ساخت‌یافته از خواندن کش هم سریع‌تر است؛ کش فقط برای backendهای کند
+        if self.cache is None or getattr(self.ai, "structured", False):
+            return None
+        client_version = f"{type(self.ai).__qualname__}:{getattr(self.ai, 'version', None)}"
+        return self.cache.make_key(user_text, excel_context, client_version, BlueprintValidator.VERSION)
+
+    def _store(self, key: str | None, blueprint: dict, excel_context: dict) -> dict:
+        BlueprintValidator(excel_context.get("columns", {})).validate(blueprint)
+        if key:
+            self.cache.put(key, blueprint)
+        return blueprint
+
+    @staticmethod
+    def _check(blueprint: dict) -> dict:
+        if "error" in blueprint:
+            candidates = blueprint.get("candidates")
+            hint = f" (شاید منظورتان: {'، '.join(map(str, candidates))})" if candidates else ""
+            raise ValueError(f"AI error: {blueprint['error']}{hint}")
+        return blueprint
+
+    @staticmethod
+    def _canonical_column(blueprint: dict, excel_context: dict):
+        # مدل‌های راه‌دور گاهی نام ستون را با حروف/ارقام دیگری برمی‌گردانند
+        target = blueprint.get("target")
+        columns = excel_context.get("columns", {})
+        if isinstance(target, dict) and target.get("column") is not None and columns:
+            found = column_index(columns).lookup(target["column"])
+            if found is not None:
+                target["column"] = found
+
+    @staticmethod
+    def _parse_response(response: str) -> dict:
+        response = response.strip()
 
         # بعضی مدل‌ها JSON را داخل ```json``` برمی‌گردانند
         fenced = re.search(r"```(?:json)?\s*(\{.*\})\s*```", response, re.DOTALL)
         if fenced:
             response = fenced.group(1)
 
-        blueprint = json.loads(response)
-        if "error" in blueprint:
-            raise ValueError(f"AI error: {blueprint['error']}")
-        return blueprint
+        return json.loads(response)
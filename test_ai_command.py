@@ -67,3 +67,196 @@ def test_ai_command_with_persian_digits_and_decrease(tmp_path):
     wb2 = ExcelReader(str(test_file)).load()
     ws2 = wb2["Sheet"]
     assert ws2.cell(row=2, column=2).value == 95
+
+
+def test_structured_request_skips_prompt():
+    class NoPromptAI(FakeAI):
+        def complete(self, prompt):
+            raise AssertionError("prompt path should not be used")
+
+    class PromptOnlyAI(FakeAI):
+        structured = False
+
+    context = {"sheets": ["Sheet"], "columns": {"name": {"type": "text"}, "price": {"type": "numeric"}}}
+    text = "ستون price رو ۵ درصد کاهش بده"
+
+    blueprint = IntentParser(NoPromptAI()).parse(text, context)
+    assert blueprint == IntentParser(PromptOnlyAI()).parse(text, context)
+    assert blueprint["operation"] == {"type": "percentage_increase", "value": -5.0}
+
+
+def test_column_index_longest_match_and_normalization():
+    from logic.column_index import column_index
+
+    index = column_index(["price", "price_usd", "قيمت كل", "Qty-2"])
+    assert index.resolve("ستون price_usd رو ۱۰ درصد افزایش بده") == "price_usd"
+    assert index.resolve("ستون PRICE usd") == "price_usd"
+    assert index.resolve("قیمت کل رو حذف کن") == "قيمت كل"
+    assert [m.column for m in index.find_all("qty ۲ و price")] == ["Qty-2", "price"]
+    assert index.resolve("prices") is None
+    assert index.candidates("ستون pricee") == ["price"]
+
+
+def test_column_index_keeps_colliding_names():
+    from logic.column_index import column_index
+
+    index = column_index(["price usd", "price_usd", "name"])
+    assert index.resolve("ستون price_usd رو حذف کن") == "price_usd"
+    assert index.resolve("ستون price usd رو حذف کن") == "price usd"
+    ambiguous = index.find_all("ستون PRICE-USD رو حذف کن")[0]
+    assert ambiguous.column is None and set(ambiguous.options) == {"price usd", "price_usd"}
+    assert index.lookup("price_usd") == "price_usd" and index.lookup("Price_USD") is None
+
+    context = {"sheets": ["Sheet"], "columns": {"price usd": {"type": "numeric"}, "price_usd": {"type": "numeric"}}}
+    assert IntentParser(FakeAI()).parse("ستون price_usd رو حذف کن", context)["target"]["column"] == "price_usd"
+    try:
+        IntentParser(FakeAI()).parse("ستون PRICE-USD رو حذف کن", context)
+    except ValueError as exc:
+        assert "ambiguous_column" in str(exc)
+    else:
+        raise AssertionError("expected ValueError")
+
+
+def test_unknown_column_is_reported_not_guessed():
+    context = {"sheets": ["Sheet"], "columns": {"name": {"type": "text"}, "price": {"type": "numeric"}}}
+    try:
+        IntentParser(FakeAI()).parse("ستون pricee رو ۵ درصد کاهش بده", context)
+    except ValueError as exc:
+        assert "column_not_found" in str(exc) and "price" in str(exc)
+    else:
+        raise AssertionError("expected ValueError")
+
+    blueprint = {"sheet": "Sheet", "action": "update", "target": {"column": "PRICE"}, "operation": {"type": "delete_column"}}
+    BlueprintValidator(context["columns"]).validate(blueprint)
+    assert blueprint["target"]["column"] == "price"
+
+
+def test_http_ai_client_pooling_coalescing_and_retries():
+    import asyncio
+    import json
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    from logic.ai_client import HttpAIClient
+
+    state = {"requests": 0, "active": 0, "peak": 0, "fail_next": 1}
+    lock = threading.Lock()
+    blueprint = {"sheet": "Sheet", "action": "update", "target": {"column": "PRICE"}, "condition": None,
+                 "operation": {"type": "percentage_increase", "value": 10}}
+
+    class StubLLM(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            with lock:
+                state["requests"] += 1
+                state["active"] += 1
+                state["peak"] = max(state["peak"], state["active"])
+                fail = "retry" in body["messages"][0]["content"] and state["fail_next"] > 0
+                if fail:
+                    state["fail_next"] -= 1
+            time.sleep(0.05)
+            with lock:
+                state["active"] -= 1
+            if fail:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            content = json.dumps({"choices": [{"message": {"content": "```json\n" + json.dumps(blueprint) + "\n```"}}]})
+            data = content.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubLLM)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    context = {"sheets": ["Sheet"], "columns": {"price": {"type": "numeric"}}}
+
+    async def scenario():
+        client = HttpAIClient(f"http://127.0.0.1:{server.server_port}/v1/chat/completions", max_concurrency=2, backoff=0.01)
+        parser = IntentParser(client)
+        try:
+            same = await asyncio.gather(*(parser.aparse("ستون price رو ۱۰ درصد افزایش بده", context) for _ in range(5)))
+            assert state["requests"] == 1
+            assert all(b["target"]["column"] == "price" for b in same)
+
+            await asyncio.gather(*(client.complete(f"prompt {i}") for i in range(6)))
+            assert state["peak"] <= 2
+
+            before = state["requests"]
+            await client.complete("please retry")
+            assert state["requests"] - before == 2
+        finally:
+            await client.aclose()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        server.shutdown()
+
+    sync_parser = IntentParser(HttpAIClient("http://127.0.0.1:9/unused"))
+    for call in (sync_parser.parse, sync_parser.compile):
+        try:
+            call("ستون price رو ۱۰ درصد افزایش بده", context)
+        except TypeError as exc:
+            assert "aparse" in str(exc)
+        else:
+            raise AssertionError("expected TypeError")
+
+
+def test_blueprint_cache_skips_ai_for_repeat_commands(tmp_path):
+    from logic.blueprint_cache import BlueprintCache
+
+    class CountingAI(FakeAI):
+        # مثل یک backend راه‌دور؛ کلاینت‌های structured از کش رد می‌شوند
+        structured = False
+        calls = 0
+
+        def complete(self, prompt):
+            CountingAI.calls += 1
+            return super().complete(prompt)
+
+    context = {"sheets": ["Sheet"], "columns": {"name": {"type": "text"}, "price": {"type": "numeric", "sample": [1]}}}
+    db = str(tmp_path / "blueprints.db")
+    parser = IntentParser(CountingAI(), cache=BlueprintCache(db))
+    first = parser.compile("ستون price رو ۱۰ درصد افزایش بده", context)
+    assert parser.compile("ستون  PRICE رو 10 درصد افزایش بده", context) == first
+    assert CountingAI.calls == 1
+
+    # پایدار بین اجراها؛ نمونه مقادیر در اثر انگشت schema نیست ولی نوع ستون هست
+    restarted = IntentParser(CountingAI(), cache=BlueprintCache(db, max_entries=2))
+    other_file = {"sheets": ["Sheet"], "columns": {"name": {"type": "text"}, "price": {"type": "numeric", "sample": [9]}}}
+    assert restarted.compile("ستون price رو ۱۰ درصد افزایش بده", other_file) == first
+    assert CountingAI.calls == 1
+    retyped = {"sheets": ["Sheet"], "columns": {"name": {"type": "text"}, "price": {"type": "text"}}}
+    try:
+        restarted.compile("ستون price رو ۱۰ درصد افزایش بده", retyped)
+    except ValueError:
+        pass
+    assert CountingAI.calls == 2
+
+    restarted.compile("ستون price رو ۵ درصد کاهش بده", context)
+    restarted.compile("ستون price رو حذف کن", context)
+    assert len(restarted.cache) == 2
+    restarted.compile("ستون price رو ۱۰ درصد افزایش بده", context)
+    assert CountingAI.calls == 5
+
+    # علامت منفی بخشی از معنای فرمان است و نباید با نسخه مثبت یک کلید بگیرد
+    negative = restarted.compile("ستون price رو -10 درصد افزایش بده", context)
+    assert negative["operation"]["value"] == -10.0
+    assert restarted.compile("ستون price رو 10 درصد افزایش بده", context)["operation"]["value"] == 10.0
+
+
+def test_blueprint_cache_is_bypassed_for_structured_clients(tmp_path):
+    from logic.blueprint_cache import BlueprintCache
+
+    parser = IntentParser(FakeAI(), cache=BlueprintCache(str(tmp_path / "blueprints.db")))
+    context = {"sheets": ["Sheet"], "columns": {"price": {"type": "numeric"}}}
+    assert parser.compile("ستون price رو ۵ درصد کاهش بده", context)["operation"]["value"] == -5.0
+    assert len(parser.cache) == 0
@@ -1,6 +1,14 @@
-from bot.context_manager import ContextManager, FSMState, UserContext
+import asyncio
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from bot.context_manager import MIGRATIONS, ContextManager, FSMState, UserContext
 from bot.decision_engine import DecisionEngine
 from bot.intent_detection import IntentDetectionEngine
+from bot.worker_pool import ExcelWorkerPool, WorkerPoolBusy
 
 
 def test_intent_detection_regex_and_target():
@@ -11,6 +19,83 @@ def test_intent_detection_regex_and_target():
     assert intent.mode == "group"
 
 
+def test_combined_matcher_keeps_priority_and_overlaps():
+    eng = IntentDetectionEngine()
+    eng.nlp = None
+    assert eng._scan("دریافت فایل") == ("export", "file", "single")
+    # filter outranks export regardless of position in the text
+    assert eng._scan("خروجی بعد از فیلتر") == ("filter", None, "single")
+    assert eng._scan("حذف چند ستون و سطر") == ("delete", "column", "group")
+    assert eng._scan("ANALYSE rows") == ("analyze", "row", "single")
+    assert eng._scan("analyſe ROWS") == ("analyze", "row", "single")
+    assert eng._target_detection("analyſe rows") == "row"
+    assert eng.detect("سطر سوم").name == "operation"
+    assert eng.detect("سلام").name == "unknown"
+
+
+def test_handlers_import_is_lightweight(tmp_path):
+    import json
+    import os
+    import subprocess
+    import sys
+    from pathlib import Path
+
+    probe = (
+        "import json, sys, bot.handlers as h; "
+        "h.intent_engine.detect('analyze column'); "
+        "print(json.dumps([m for m in ('spacy', 'pandas', 'openpyxl') if m in sys.modules]))"
+    )
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).resolve().parent), INTENT_NLP="lazy")
+    out = subprocess.run([sys.executable, "-c", probe], cwd=tmp_path, env=env, capture_output=True, text=True, check=True)
+    assert json.loads(out.stdout) == []
+    assert not (tmp_path / "storage").exists()
+
+
+def test_spacy_fallback_loads_on_first_use_only():
+    eng = IntentDetectionEngine(nlp_mode="off")
+    assert eng.nlp is None and eng.detect("column").target == "column"
+    lazy = IntentDetectionEngine()
+    assert lazy._nlp_state == "pending"
+    lazy.nlp = None
+    assert lazy.detect("analyze").name == "analyze"
+
+
+class _FakeNlp:
+    def __init__(self):
+        self.calls = self.piped = 0
+
+    @staticmethod
+    def _doc(text):
+        return [type("Tok", (), {"text": word})() for word in text.split()]
+
+    def __call__(self, text):
+        self.calls += 1
+        return self._doc(text)
+
+    def pipe(self, texts):
+        self.piped += 1
+        return [self._doc(t) for t in texts]
+
+
+def test_intent_memo_and_batch_detection():
+    eng = IntentDetectionEngine(memo_size=2)
+    eng.nlp = nlp = _FakeNlp()
+    first = eng.detect("  Analyze   EXPORT ")
+    first.name = "mutated"
+    again = eng.detect("analyze export")
+    assert (again.name, again.target, again.raw_text) == ("analyze", "export", "analyze export")
+    assert nlp.calls == 1
+    assert eng.memo_stats()["hits"] == 1
+
+    texts = ["hello", "فیلتر ستون", "", "hello", "tell me about export", "analyze export"]
+    batch = eng.detect_many(texts)
+    assert nlp.piped == 1 and nlp.calls == 1
+    single = IntentDetectionEngine()
+    single.nlp = _FakeNlp()
+    assert [(i.name, i.target, i.mode) for i in batch] == [(i.name, i.target, i.mode) for i in map(single.detect, texts)]
+    assert eng.memo_stats()["entries"] == 2
+
+
 def test_context_pattern_suggest_export(tmp_path):
     cm = ContextManager(str(tmp_path / "ctx.db"))
     uid = 11
@@ -19,6 +104,29 @@ def test_context_pattern_suggest_export(tmp_path):
     cm.log_operation(uid, "f1", "analyze", "exit")
     cm.log_operation(uid, "f1", "filter", "exit")
     assert cm.should_suggest_export(uid)
+    # the hint follows recent behaviour instead of sticking forever
+    for _ in range(20):
+        cm.log_operation(uid, "f1", "analyze", "exit")
+        cm.log_operation(uid, "f1", "export", "exit")
+    assert not cm.should_suggest_export(uid)
+    assert cm.predict_next_action(uid) == "analyze"
+
+
+def test_export_hint_uses_incremental_score(tmp_path):
+    cm = ContextManager(str(tmp_path / "ctx.db"))
+    for op in ["analyze", "filter", "export", "analyze"]:
+        cm.log_operation(4, "f1", op, "exit")
+    assert cm.next_action_hints(4) == (False, None)
+    cm.log_operation(4, "f1", "filter", "exit")
+
+    statements = []
+    cm.conn.set_trace_callback(statements.append)
+    assert cm.next_action_hints(4) == (True, None)
+    cm.conn.set_trace_callback(None)
+    # فقط یک کوئری روی op_last/op_transitions؛ تاریخچه دوباره اسکن نمی‌شود
+    assert len(statements) == 1 and "operation_history" not in statements[0]
+    assert cm.next_action_hints(99) == (False, None)
+    cm.close()
 
 
 def test_decision_requires_file_for_analyze(tmp_path):
@@ -29,3 +137,316 @@ def test_decision_requires_file_for_analyze(tmp_path):
     assert decision.action == "request_file"
     ctx = cm.get_user_context(5)
     assert ctx.state == FSMState.WAIT_FILE
+
+
+def test_context_group_commit_and_flush(tmp_path):
+    db = tmp_path / "ctx3.db"
+    cm = ContextManager(str(db), flush_interval_ms=60_000, batch_size=1000)
+    assert cm.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    for i in range(20):
+        cm.log_operation(1, "f1", "analyze", "exit")
+    # writes are visible on the writer connection before commit...
+    assert len(cm.last_operations(1, 50)) == 20
+    other = sqlite3.connect(db)
+    assert other.execute("SELECT COUNT(*) FROM operation_history").fetchone()[0] == 0
+    # ...and reach other readers once the group is flushed
+    cm.flush()
+    assert other.execute("SELECT COUNT(*) FROM operation_history").fetchone()[0] == 20
+    cm.log_operation(1, "f1", "filter", "exit")
+    cm.close()
+    assert other.execute("SELECT COUNT(*) FROM operation_history").fetchone()[0] == 21
+
+    full = ContextManager(str(tmp_path / "ctx4.db"), durability="full")
+    full.log_operation(2, None, "analyze", "exit")
+    reader = sqlite3.connect(tmp_path / "ctx4.db")
+    assert reader.execute("SELECT COUNT(*) FROM operation_history").fetchone()[0] == 1
+
+
+def test_user_context_cache_skips_redundant_queries(tmp_path):
+    cm = ContextManager(str(tmp_path / "ctx5.db"), context_ttl=60)
+    statements = []
+    cm.conn.set_trace_callback(statements.append)
+    ctx = cm.get_user_context(7)
+    cm.upsert_user_context(ctx)
+    assert cm.get_user_context(7) == ctx
+    assert sum(s.startswith("SELECT") for s in statements) == 1
+    assert not any("INSERT" in s for s in statements)
+
+    ctx.state = FSMState.WAIT_FILE
+    cm.upsert_user_context(ctx)
+    cm.upsert_user_context(cm.get_user_context(7))
+    assert sum("INSERT INTO kv" in s for s in statements) == 1
+
+    # returned contexts are copies; mutating one must not leak into the cache
+    leaked = cm.get_user_context(7)
+    leaked.state = FSMState.DONE
+    assert cm.get_user_context(7).state == FSMState.WAIT_FILE
+
+    cm.context_ttl = 0
+    cm.get_user_context(7)
+    assert sum(s.startswith("SELECT") for s in statements) == 2
+    cm.close()
+
+
+def test_history_migrations_index_and_compaction(tmp_path):
+    db = tmp_path / "legacy.db"
+    legacy = sqlite3.connect(db)
+    legacy.execute(
+        "CREATE TABLE operation_history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+        "file_id TEXT, operation TEXT NOT NULL, phase TEXT NOT NULL, created_at TEXT DEFAULT CURRENT_TIMESTAMP)"
+    )
+    legacy.execute("INSERT INTO operation_history (user_id, operation, phase) VALUES (1, 'analyze', 'exit')")
+    legacy.commit()
+    legacy.close()
+
+    cm = ContextManager(str(db), history_keep=3, compact_every=0)
+    assert cm.schema_version == MIGRATIONS[-1][0]
+    plan = " ".join(
+        row[-1]
+        for row in cm.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT operation FROM operation_history "
+            "WHERE user_id = 1 AND phase = 'exit' ORDER BY id DESC LIMIT 10"
+        )
+    )
+    assert "idx_history_user_phase" in plan and "TEMP B-TREE" not in plan
+
+    for op in ["filter", "analyze", "filter", "export", "analyze"]:
+        cm.log_operation(1, "f1", op, "exit")
+    cm.log_operation(2, "f2", "analyze", "exit")
+    assert cm.compact_history() == 3
+    assert cm.last_operations(1) == ["analyze", "export", "filter"]
+    assert cm.last_operations(2) == ["analyze"]
+    assert cm.operation_counts(1) == {"analyze": 3, "filter": 2, "export": 1}
+    cm.close()
+    # reopening must not re-run migrations
+    assert ContextManager(str(db)).schema_version == MIGRATIONS[-1][0]
+
+
+def test_history_compaction_runs_off_the_write_path(tmp_path):
+    cm = ContextManager(str(tmp_path / "ctx_compact.db"), history_keep=2, compact_every=6)
+    for op in ["analyze", "filter", "export"] * 2:
+        cm.log_operation(1, "f1", op, "exit")
+    thread = cm._compact_thread
+    assert thread is not None and thread is not threading.current_thread()
+    thread.join(timeout=5)
+    assert cm.last_operations(1) == ["export", "filter"]
+    assert cm.operation_counts(1) == {"analyze": 2, "filter": 2, "export": 2}
+    cm.close()
+
+
+def test_history_compaction_deletes_in_bounded_batches(tmp_path):
+    cm = ContextManager(str(tmp_path / "ctx_batches.db"), history_keep=2, compact_every=0)
+    for uid, count in ((1, 9), (2, 3), (3, 1)):
+        for i in range(count):
+            cm.log_operation(uid, "f", "filter" if i % 2 else "analyze", "exit")
+    statements = []
+    cm.conn.set_trace_callback(statements.append)
+    assert cm.compact_history(batch_size=2) == 8
+    cm.conn.set_trace_callback(None)
+
+    deletes = [sql for sql in statements if sql.lstrip().startswith("DELETE")]
+    # ۷ ردیف کاربر ۱ در دسته‌های ۲تایی و ۱ ردیف کاربر ۲
+    assert len(deletes) == 5 and all("LIMIT 2" in sql for sql in deletes)
+    assert [len(cm.last_operations(uid)) for uid in (1, 2, 3)] == [2, 2, 1]
+    assert cm.operation_counts(1) == {"analyze": 5, "filter": 4}
+    cm.close()
+
+
+def test_next_action_model_survives_restart(tmp_path):
+    from bot.ui_renderer import UIRenderer
+
+    db = str(tmp_path / "ctx6.db")
+    cm = ContextManager(db)
+    for op in ["analyze", "filter", "export", "analyze", "filter", "export", "analyze"]:
+        cm.log_operation(3, "f1", op, "enter")
+        cm.log_operation(3, "f1", op, "exit")
+    assert cm.predict_next_action(3) == "filter"
+    cm.close()
+
+    cm = ContextManager(db)
+    assert cm.transition_count(3, "filter", "export") == 2
+    assert cm.predict_next_action(3) == "filter"
+    assert cm.predict_next_action(99) is None
+    cm.log_operation(3, "f1", "filter", "exit")
+    assert cm.predict_next_action(3) == "export"
+
+    menu = UIRenderer().inline_menu(cm.get_user_context(3), suggested_action=cm.predict_next_action(3))
+    assert menu.inline_keyboard[0][0].callback_data == "intent:export"
+
+
+def test_context_managers_share_state_through_store(tmp_path):
+    from bot.state_store import HttpStore, KeyValueStore, ShardedSQLiteStore, serve_store, shard_index
+
+    with pytest.raises(TypeError):
+        KeyValueStore()
+    backend = ShardedSQLiteStore(str(tmp_path / "state"), shards=4)
+    server = serve_store(backend)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    # دو پروسه ربات: هر کدام تاریخچه محلی خودش را دارد و state از سرویس مشترک می‌آید
+    first = ContextManager(str(tmp_path / "a.db"), store=HttpStore(url))
+    second = ContextManager(str(tmp_path / "b.db"), store=HttpStore(url))
+    try:
+        for uid in range(8):
+            ctx = first.get_user_context(uid)
+            ctx.state = FSMState.WAIT_FILE
+            first.upsert_user_context(ctx)
+            first.register_file(uid, f"u{uid}_abc", "a.xlsx", "o", "w")
+        assert second.get_user_context(5).state == FSMState.WAIT_FILE
+        assert second.get_file_record("u5_abc")["user_id"] == 5
+        assert {r["file_id"] for r in second.list_files()} == {f"u{uid}_abc" for uid in range(8)}
+
+        # کش محلی context با نسخه store اعتبارسنجی می‌شود
+        ctx = second.get_user_context(5)
+        ctx.active_file_id, ctx.state = "u5_abc", FSMState.ANALYZED
+        second.upsert_user_context(ctx)
+        assert first.get_user_context(5) == ctx
+        assert first.active_file_ids() == {"u5_abc"}
+
+        first.set_pending_filter(5, {"column": "city", "keyword": "Tehran", "query": None})
+        assert second.get_pending_filter(5)["keyword"] == "Tehran"
+        second.clear_pending_filter(5)
+        assert first.get_pending_filter(5) is None
+
+        for op in ["analyze", "filter", "analyze"]:
+            (first if op == "filter" else second).log_operation(5, "u5_abc", op, "exit")
+        assert first.next_action_hints(5) == second.next_action_hints(5) == (False, None)
+        assert first.transition_count(5, "filter", "analyze") == 1
+        assert second.last_operations(5) == ["analyze", "analyze"]
+
+        second.delete_files(["u5_abc"])
+        assert first.get_file_record("u5_abc") is None
+        assert first.get_user_context(5).state == FSMState.IDLE
+
+        keys = backend._conns[shard_index("5", 4)].execute("SELECT key FROM kv").fetchall()
+        assert "context:5" in {r[0] for r in keys} and len(keys) < 16
+    finally:
+        first.close()
+        second.close()
+        server.shutdown()
+        backend.close()
+
+
+def test_legacy_context_tables_move_into_kv(tmp_path):
+    db = tmp_path / "legacy6.db"
+    cm = ContextManager(str(db))
+    cm.close()
+    legacy = sqlite3.connect(db)
+    legacy.execute("PRAGMA user_version = 6")
+    legacy.execute("DROP TABLE kv")
+    legacy.executescript(
+        """
+        CREATE TABLE user_context (user_id INTEGER PRIMARY KEY, state TEXT NOT NULL, active_file_id TEXT, active_operation TEXT);
+        CREATE TABLE file_registry (file_id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, original_name TEXT NOT NULL,
+            original_path TEXT NOT NULL, working_path TEXT NOT NULL, analyzed INTEGER NOT NULL DEFAULT 0,
+            analysis_json TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP, last_used_at REAL);
+        CREATE TABLE analysis_cache (content_hash TEXT NOT NULL, analyzer_version INTEGER NOT NULL,
+            analysis_json TEXT NOT NULL, created_at TEXT, PRIMARY KEY (content_hash, analyzer_version));
+        CREATE TABLE op_transitions (user_id INTEGER NOT NULL, from_op TEXT NOT NULL, to_op TEXT NOT NULL,
+            count INTEGER NOT NULL, PRIMARY KEY (user_id, from_op, to_op));
+        CREATE TABLE op_last (user_id INTEGER PRIMARY KEY, operation TEXT NOT NULL, export_score REAL NOT NULL DEFAULT 0);
+        INSERT INTO user_context VALUES (3, 'ANALYZED', 'u3_f', 'analyze');
+        INSERT INTO file_registry VALUES ('u3_f', 3, 'r.xlsx', 'o', 'w', 1, '{"sheets": []}', NULL, 12.5);
+        INSERT INTO analysis_cache VALUES ('abc', 1, '{"sheets": [1]}', NULL);
+        INSERT INTO op_transitions VALUES (3, 'filter', 'export', 2), (3, 'analyze', 'filter', 1);
+        INSERT INTO op_last VALUES (3, 'filter', 1.6);
+        """
+    )
+    legacy.commit()
+    legacy.close()
+
+    cm = ContextManager(str(db))
+    assert cm.schema_version == 7
+    assert cm.get_user_context(3) == UserContext(3, FSMState.ANALYZED, "u3_f", "analyze")
+    assert cm.get_file_record("u3_f")["last_used_at"] == 12.5
+    assert cm.get_cached_analysis("abc", 1) == {"sheets": [1]}
+    assert cm.next_action_hints(3) == (True, "export")
+    assert cm.transition_count(3, "analyze", "filter") == 1
+    tables = {r[0] for r in cm.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert not tables & {"user_context", "file_registry", "analysis_cache", "op_transitions", "op_last"}
+    cm.close()
+
+
+def test_analysis_cache_is_shared_by_content_hash(tmp_path):
+    from openpyxl import Workbook
+
+    from bot.excel_engine import ExcelEngine
+    from core.workbook_cache import WorkbookCache
+
+    src = tmp_path / "report.xlsx"
+    wb = Workbook()
+    for row in [["name", "city"], ["Ali", "Tehran"], ["Bahar", "Shiraz"], ["Amir", "Tehran"], ["Sara", "Tabriz"]]:
+        wb.active.append(row)
+    wb.save(src)
+    engine = ExcelEngine(str(tmp_path / "uploads"), cache=WorkbookCache())
+    cm = ContextManager(str(tmp_path / "ctx.db"))
+    data = src.read_bytes()
+    first = engine.store_original_and_working(1, "report.xlsx", data)
+    second = engine.store_original_and_working(2, "report.xlsx", data)
+    assert first[0] != second[0]
+
+    digest = engine.content_hash(first[2])
+    assert engine.content_hash(second[2]) == digest
+    assert cm.get_cached_analysis(digest, ExcelEngine.ANALYZER_VERSION) is None
+    cm.store_analysis(digest, ExcelEngine.ANALYZER_VERSION, engine.analyze(first[2], first[0]))
+    assert cm.get_cached_analysis(digest, ExcelEngine.ANALYZER_VERSION)["sheets"][0]["rows"] == 5
+    assert cm.get_cached_analysis(digest, ExcelEngine.ANALYZER_VERSION + 1) is None
+
+    # filtering changes the working copy, so its hash and registry analysis move on
+    cm.register_file(1, first[0], "report.xlsx", first[1], first[2])
+    cm.mark_analyzed(first[0], {"sheets": []})
+    engine.filter_rows(first[2], "Sheet", "city = Tehran", first[0])
+    cm.invalidate_analysis(first[0])
+    assert engine.content_hash(first[2]) != digest
+    assert cm.get_file_record(first[0])["analyzed"] == 0
+    cm.close()
+
+
+def _slow_square(value, delay=0.0):
+    time.sleep(delay)
+    return value * value
+
+
+def test_worker_pool_runs_jobs_off_the_event_loop():
+    async def scenario(pool):
+        results = await asyncio.gather(*(pool.run(_slow_square, i) for i in range(4)))
+        assert results == [0, 1, 4, 9]
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run(_slow_square, 2, delay=0.5, timeout=0.05)
+
+    for use_processes in (False, True):
+        pool = ExcelWorkerPool(max_workers=2, use_processes=use_processes)
+        try:
+            asyncio.run(scenario(pool))
+        finally:
+            pool.shutdown()
+
+
+def test_worker_pool_rejects_when_queue_is_full():
+    async def scenario():
+        pool = ExcelWorkerPool(max_workers=1, use_processes=False, max_pending=1)
+        first = asyncio.ensure_future(pool.run(_slow_square, 3, delay=0.2))
+        await asyncio.sleep(0)
+        with pytest.raises(WorkerPoolBusy):
+            await pool.run(_slow_square, 1)
+        assert await first == 9
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_worker_pool_counts_timed_out_jobs_until_they_finish():
+    async def scenario():
+        pool = ExcelWorkerPool(max_workers=1, use_processes=False, max_pending=1)
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run(_slow_square, 2, delay=0.3, timeout=0.05)
+        # the job is still running in the worker, so it still occupies the queue slot
+        assert pool.pending == 1
+        with pytest.raises(WorkerPoolBusy):
+            await pool.run(_slow_square, 1)
+        await asyncio.sleep(0.4)
+        assert pool.pending == 0
+        assert await pool.run(_slow_square, 4) == 16
+        pool.shutdown()
+
+    asyncio.run(scenario())
@@ -0,0 +1,82 @@
+import pytest
+from openpyxl import Workbook, load_workbook
+
+from bot.excel_engine import ExcelEngine
+from core.filter_engine import FilterQuery
+from core.workbook_cache import WorkbookCache
+
+
+def _build_test_file(path):
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["name", "city", "price", "note"])
+    ws.append(["Ali", "Tehran", 15, "x"])
+    ws.append(["Bahar", "Shiraz", 25, None])
+    ws.append(["Amir", "Tehran", 5, ""])
+    ws.append(["Sara", "Tabriz", "12", "y"])
+    wb.save(path)
+
+
+def _names(path):
+    ws = load_workbook(path).active
+    return [ws.cell(row=r, column=1).value for r in range(2, ws.max_row + 1)]
+
+
+def test_compound_query_with_and_or(tmp_path):
+    path = tmp_path / "data.xlsx"
+    _build_test_file(path)
+    kept = ExcelEngine(str(tmp_path)).filter_rows(str(path), "Sheet", 'city = Tehran & price in 10..20 | name ~ "^S|^B" & note is empty')
+    assert kept == 2
+    assert _names(path) == ["Ali", "Bahar"]
+
+
+def test_numeric_and_not_equal_predicates(tmp_path):
+    path = tmp_path / "data.xlsx"
+    _build_test_file(path)
+    ExcelEngine(str(tmp_path)).filter_rows(str(path), "Sheet", "price >= 12 & city != Shiraz")
+    assert _names(path) == ["Ali", "Sara"]
+
+
+def test_legacy_contains_filter(tmp_path):
+    path = tmp_path / "data.xlsx"
+    _build_test_file(path)
+    ExcelEngine(str(tmp_path)).filter_contains(str(path), "Sheet", "name", "A")
+    assert _names(path) == ["Ali", "Amir"]
+
+
+def test_invalid_queries_raise_value_error():
+    with pytest.raises(ValueError):
+        FilterQuery.parse("export")
+    with pytest.raises(ValueError):
+        FilterQuery.parse("price > abc")
+
+
+def test_engine_reuses_cached_workbook_and_analysis(tmp_path):
+    path = tmp_path / "data.xlsx"
+    _build_test_file(path)
+    cache = WorkbookCache(budget_bytes=64 * 1024 * 1024)
+    engine = ExcelEngine(str(tmp_path), cache=cache)
+
+    engine.analyze(str(path), "f1")
+    engine.analyze(str(path), "f1")
+    assert cache.hits == 1
+
+    engine.filter_rows(str(path), "Sheet", "city = Tehran", "f1")
+    hits = cache.hits
+    engine.filter_rows(str(path), "Sheet", "price > 10", "f1")
+    assert cache.hits == hits + 1
+    assert _names(path) == ["Ali"]
+
+    cache.invalidate("f1")
+    assert cache.stats()["entries"] == 0
+
+
+def test_cache_evicts_least_recently_used_by_budget():
+    cache = WorkbookCache(budget_bytes=100)
+    cache.put("a", 1, 40)
+    cache.put("b", 2, 40)
+    cache.get("a")
+    cache.put("c", 3, 40)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.evictions == 1
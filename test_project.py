@@ -1,9 +1,11 @@
 from pathlib import Path
 
 from openpyxl import Workbook
+from openpyxl.styles import Font
 
+from bot.excel_engine import ExcelEngine
 from core.excel_analyzer import ExcelAnalyzer
-from core.excel_editor import ExcelEditor
+from core.excel_editor import ExcelEditor, delete_cols_bulk, delete_rows_bulk
 from core.excel_reader import ExcelReader
 from core.history_manager import HistoryManager
 
@@ -39,3 +41,67 @@ def test_excel_core_flow(tmp_path):
     wb2 = ExcelReader(str(test_file)).load()
     ws2 = wb2["Sheet"]
     assert ws2.cell(row=2, column=2).value == 110
+
+
+def test_bulk_row_and_column_delete_keeps_styles():
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["name", "city", "price"])
+    for i in range(1, 7):
+        ws.append([f"item{i}", "x", i])
+    ws.cell(row=5, column=1).font = Font(bold=True)
+    ws.row_dimensions[5].height = 30
+    ws.column_dimensions["C"].width = 25
+
+    delete_rows_bulk(ws, [2, 4, 6])
+    assert [ws.cell(row=r, column=1).value for r in range(1, ws.max_row + 1)] == ["name", "item2", "item4", "item6"]
+    assert ws.cell(row=3, column=1).font.bold
+    assert ws.row_dimensions[3].height == 30
+
+    delete_cols_bulk(ws, [2])
+    assert [c.value for c in ws[1]] == ["name", "price"]
+    assert ws.column_dimensions["B"].width == 25
+
+
+def test_uploads_and_versions_share_content_addressed_blobs(tmp_path):
+    content = (tmp_path / "seed.xlsx")
+    _build_test_file(content)
+    data = content.read_bytes()
+    engine = ExcelEngine(str(tmp_path / "uploads"))
+
+    fid_a, original_a, working_a = engine.store_original_and_working(1, "a.xlsx", data)
+    fid_b, _, _ = engine.store_original_and_working(2, "a.xlsx", data)
+    assert fid_a != fid_b
+    blobs = list((tmp_path / "blobs").glob("*/*.xlsx"))
+    assert len(blobs) == 1
+    digest = blobs[0].stem
+    assert engine.blobs.refcount(digest) == 4
+
+    history = HistoryManager(base_dir=str(tmp_path / "versions"))
+    history.save_version(fid_a, working_a, "before_filter")
+    assert engine.blobs.refcount(digest) == 5
+
+    engine.filter_contains(working_a, "Sheet", "name", "item1")
+    assert Path(original_a).read_bytes() == data
+    assert engine.blobs.refcount(digest) == 4
+
+
+def test_blob_put_survives_gc_between_exists_and_checkout(tmp_path, monkeypatch):
+    import core.blob_store as blob_store
+
+    content = tmp_path / "seed.xlsx"
+    _build_test_file(content)
+    engine = ExcelEngine(str(tmp_path / "uploads"))
+    engine.store_original_and_working(1, "a.xlsx", content.read_bytes())
+    for path in (tmp_path / "uploads").iterdir():
+        path.unlink()
+
+    # GC پس‌زمینه blob بی‌ارجاع را درست بعد از exists() حذف می‌کند
+    monkeypatch.setattr(blob_store, "_touch", lambda path: engine.blobs.collect_garbage(0))
+    _, original, working = engine.store_original_and_working(2, "a.xlsx", content.read_bytes())
+    assert Path(original).read_bytes() == Path(working).read_bytes() == content.read_bytes()
+
+    history = HistoryManager(base_dir=str(tmp_path / "versions"), blob_store=engine.blobs)
+    for path in (tmp_path / "uploads").iterdir():
+        path.unlink()
+    assert Path(history.save_version("f", content, "v1")).read_bytes() == content.read_bytes()
@@ -0,0 +1,107 @@
+import asyncio
+import os
+import time
+from io import BytesIO
+from pathlib import Path
+
+from openpyxl import Workbook
+
+from bot.context_manager import ContextManager, FSMState
+from bot.excel_engine import ExcelEngine
+from bot.storage_manager import StorageManager
+from core.history_manager import HistoryManager
+
+
+def _upload(engine, ctx, user_id, payload: str):
+    wb = Workbook()
+    wb.active.append([payload * 2000])
+    buf = BytesIO()
+    wb.save(buf)
+    file_id, original, working = engine.store_original_and_working(user_id, "r.xlsx", buf.getvalue())
+    ctx.register_file(user_id, file_id, "r.xlsx", original, working)
+    return file_id, working
+
+
+def test_storage_manager_enforces_quota_age_and_cleans_registry(tmp_path):
+    ctx = ContextManager(str(tmp_path / "ctx.db"))
+    engine = ExcelEngine(str(tmp_path / "uploads"))
+    history = HistoryManager(str(tmp_path / "versions"), blob_store=engine.blobs)
+    old_id, old_working = _upload(engine, ctx, 1, "a")
+    history.save_version(old_id, old_working, "v1")
+    new_id, new_working = _upload(engine, ctx, 1, "b")
+    engine.export(new_working, "r.xlsx")
+    active_id, _ = _upload(engine, ctx, 2, "c")
+    state = ctx.get_user_context(2)
+    state.active_file_id, state.state = active_id, FSMState.ANALYZED
+    ctx.upsert_user_context(state)
+    stale_id, _ = _upload(engine, ctx, 3, "d")
+    ctx.touch_file(stale_id, now=time.time() - 3600)
+    ctx.touch_file(old_id, now=time.time() - 60)
+    orphan = tmp_path / "uploads" / "u9_0123456789abcdef_working_x.xlsx"
+    orphan.write_bytes(b"x" * 100)
+    os.utime(orphan, (time.time() - 7200, time.time() - 7200))
+
+    size = Path(new_working).stat().st_size
+    manager = StorageManager(
+        ctx,
+        uploads_dir=str(tmp_path / "uploads"),
+        versions_dir=str(tmp_path / "versions"),
+        blob_store=engine.blobs,
+        user_quota_bytes=size + 10,
+        global_quota_bytes=size * 2 + 10,
+        max_age_seconds=1800,
+        blob_grace_seconds=0,
+    )
+    result = manager.run_once()
+
+    # stale (age) + orphan (age) + oldest file of user 1 (quota)
+    assert result["evicted_files"] == 3
+    assert result["removed_records"] == 2
+    assert result["reclaimed_bytes"] >= 2 * size
+    assert {r["file_id"] for r in ctx.list_files()} == {new_id, active_id}
+    assert not (tmp_path / "versions" / old_id).exists() and not orphan.exists()
+    assert sorted(p.name.split("_", 2)[2] for p in (tmp_path / "uploads").glob(f"{new_id}_*")) == [
+        "export_r.xlsx",
+        "original_r.xlsx",
+        "working_r.xlsx",
+    ]
+    assert len(list((tmp_path / "blobs").glob("*/*.xlsx"))) == 2
+
+    # the active file survives quotas but not expiry, and its owner falls back to IDLE
+    assert manager.run_once(now=time.time() + 3600)["removed_records"] == 2
+    assert ctx.get_user_context(2).active_file_id is None
+    assert ctx.get_user_context(2).state == FSMState.IDLE
+    assert manager.stats.runs == 2 and manager.stats.reclaimed_bytes >= 4 * size
+
+    async def _background():
+        manager.interval_seconds = 0.01
+        manager.start()
+        await asyncio.sleep(0.05)
+        await manager.stop()
+
+    asyncio.run(_background())
+    assert manager.stats.runs > 2
+    ctx.close()
+
+
+def test_storage_manager_skips_files_that_vanish_during_a_pass(tmp_path):
+    ctx = ContextManager(str(tmp_path / "ctx.db"))
+    engine = ExcelEngine(str(tmp_path / "uploads"))
+    file_id, working = _upload(engine, ctx, 1, "a")
+    # لینک‌های شکسته مثل فایلی‌اند که بین iterdir/glob و stat حذف شده باشد
+    versions = tmp_path / "versions" / file_id
+    versions.mkdir(parents=True)
+    (versions / "v1.xlsx").symlink_to(tmp_path / "gone.xlsx")
+    (tmp_path / "blobs" / "ff").mkdir(parents=True, exist_ok=True)
+    (tmp_path / "blobs" / "ff" / f"{'f' * 64}.xlsx").symlink_to(tmp_path / "gone.xlsx")
+
+    manager = StorageManager(
+        ctx,
+        uploads_dir=str(tmp_path / "uploads"),
+        versions_dir=str(tmp_path / "versions"),
+        blob_store=engine.blobs,
+        blob_grace_seconds=0,
+    )
+    assert manager.run_once()["evicted_files"] == 0
+    assert Path(working).exists()
+    ctx.close()
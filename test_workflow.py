@@ -1,8 +1,13 @@
+import datetime
+import json
+import re
 from io import BytesIO
+from zipfile import ZipFile
 
 from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font
 
-from bot.workflow import PendingOperation, analyze_workbook, apply_operation
+from bot.workflow import BotState, PendingOperation, SessionManager, analyze_workbook, apply_operation
 
 
 def build_bytes():
@@ -42,3 +47,313 @@ def test_apply_delete_row():
     ws = wb["Sheet"]
     assert ws.max_row == 2
     assert ws.cell(row=2, column=1).value == "b"
+
+
+def _strip_dimension(data: bytes) -> bytes:
+    src = ZipFile(BytesIO(data))
+    out = BytesIO()
+    with ZipFile(out, "w") as dst:
+        for item in src.infolist():
+            payload = src.read(item.filename)
+            if item.filename.startswith("xl/worksheets/"):
+                payload = re.sub(rb"<dimension[^>]*/>", b"", payload)
+            dst.writestr(item, payload)
+    return out.getvalue()
+
+
+def test_analyze_workbook_without_dimension_tag():
+    data = _strip_dimension(build_bytes())
+    info = analyze_workbook(data)
+    sheet = info["sheets"][0]
+    assert sheet["rows"] == 3
+    assert sheet["cols"] == 2
+    assert sheet["headers"] == ["name", "price"]
+
+
+def test_session_model_apply_undo_and_export():
+    manager = SessionManager()
+    info = manager.open_file(1, "data.xlsx", build_bytes())
+    assert info["sheets"][0]["headers"] == ["name", "price"]
+
+    manager.apply(1, PendingOperation(op_kind="edit", target_kind="column", mode="single", selected={2}, payload_lines=["0"]))
+    manager.apply(1, PendingOperation(op_kind="delete", target_kind="row", mode="single", selected={2}))
+    assert manager.get(1).model["Sheet"].sheet_map() == (["name", "price"], [2])
+
+    assert manager.undo(1)
+    ws = load_workbook(BytesIO(manager.export_bytes(1)))["Sheet"]
+    assert ws.max_row == 3
+    assert [ws.cell(row=r, column=2).value for r in (2, 3)] == ["0", "0"]
+
+
+def test_undo_deltas_restore_every_operation_kind(tmp_path):
+    manager = SessionManager(undo_budget_bytes=1, undo_spill_dir=str(tmp_path))
+    manager.open_file(1, "data.xlsx", build_bytes())
+    before = [list(c) for c in manager.get(1).model["Sheet"].columns]
+    ops = [
+        PendingOperation(op_kind="add", target_kind="column", mode="group", selected={1, 2}, payload_lines=["x", "y"]),
+        PendingOperation(op_kind="add", target_kind="row", mode="group", selected={2}, payload_lines=["p", "q"]),
+        PendingOperation(op_kind="edit", target_kind="row", mode="single", selected={3}, payload_lines=["e"]),
+        PendingOperation(op_kind="delete", target_kind="row", mode="group", selected={2, 4}),
+        PendingOperation(op_kind="delete", target_kind="column", mode="single", selected={1}),
+    ]
+    for op in ops:
+        manager.apply(1, op)
+    session = manager.get(1)
+    assert len(session.undo_stack) == len(ops)
+    assert session.undo_stack.memory_bytes < 1024
+    while manager.undo(1):
+        pass
+    sheet = session.model["Sheet"]
+    assert sheet.max_row == 3
+    assert [c[:3] for c in sheet.columns] == before
+
+
+def test_undo_stops_with_op_stack_when_budget_drops_deltas():
+    manager = SessionManager(undo_budget_bytes=1)
+    manager.open_file(1, "data.xlsx", build_bytes())
+    for text in ("x", "y", "z"):
+        manager.apply(1, PendingOperation(op_kind="edit", target_kind="row", mode="single", selected={2}, payload_lines=[text]))
+    session = manager.get(1)
+    # بدون spill_dir فقط آخرین دلتا می‌ماند و op_stack هم با آن کوتاه می‌شود
+    assert len(session.undo_stack) == len(session.op_stack) == 1
+    assert manager.preview(1)["operations"] == 1
+    assert manager.undo(1)
+    assert session.model["Sheet"].get(2, 1) == "y"
+    assert not manager.undo(1) and not session.op_stack
+
+
+def _values(data: bytes):
+    ws = load_workbook(BytesIO(data))["Sheet"]
+    return [[c.value for c in row] for row in ws.iter_rows()]
+
+
+def test_lazy_plan_matches_eager_execution_and_keeps_styles():
+    wb = load_workbook(BytesIO(build_bytes()))
+    wb["Sheet"].cell(row=3, column=2).font = Font(bold=True)
+    buf = BytesIO()
+    wb.save(buf)
+    data = buf.getvalue()
+
+    ops = [
+        PendingOperation(op_kind="delete", target_kind="row", mode="single", selected={2}),
+        PendingOperation(op_kind="add", target_kind="column", mode="group", selected={1}, payload_lines=["c", "d"]),
+        PendingOperation(op_kind="add", target_kind="row", mode="single", selected={2}, payload_lines=["new"]),
+        PendingOperation(op_kind="edit", target_kind="column", mode="single", selected={3}, payload_lines=["z"]),
+        PendingOperation(op_kind="delete", target_kind="column", mode="single", selected={1}),
+    ]
+    eager, lazy = SessionManager(), SessionManager(lazy=True)
+    for manager in (eager, lazy):
+        manager.open_file(1, "data.xlsx", data)
+        for op in ops:
+            manager.apply(1, op)
+    assert lazy.sheet_map(1) == eager.sheet_map(1)
+    preview = lazy.preview(1)
+    assert preview["deleted_rows"] == 1 and preview["new_rows"] == 2
+
+    out = lazy.export_bytes(1)
+    assert _values(out) == _values(eager.export_bytes(1))
+    assert load_workbook(BytesIO(out))["Sheet"].cell(row=2, column=1).font.bold
+
+    assert lazy.undo(1) and lazy.undo(1)
+    assert lazy.sheet_map(1)[0] == ["name", "price", "Column_3"]
+
+
+def test_streaming_export_keeps_header_style_and_widths():
+    wb = load_workbook(BytesIO(build_bytes()))
+    ws = wb["Sheet"]
+    ws.cell(row=1, column=2).font = Font(bold=True)
+    ws.column_dimensions["B"].width = 28
+    buf = BytesIO()
+    wb.save(buf)
+
+    manager = SessionManager()
+    manager.open_file(1, "report.xlsx", buf.getvalue())
+    manager.apply(1, PendingOperation(op_kind="delete", target_kind="column", mode="single", selected={1}))
+    path = manager.export_file(1)
+    try:
+        assert path.suffix == ".xlsx"
+        out = load_workbook(path)["Sheet"]
+        assert out.cell(row=1, column=1).value == "price"
+        assert out.cell(row=1, column=1).font.bold
+        assert out.column_dimensions["A"].width == 28
+        assert out.max_row == 3
+    finally:
+        path.unlink()
+
+
+def test_model_export_keeps_formats_dates_merges_and_freeze():
+    wb = load_workbook(BytesIO(build_bytes()))
+    ws = wb["Sheet"]
+    ws["C1"] = "date"
+    ws["C2"] = datetime.date(2024, 3, 1)
+    ws["C3"] = datetime.date(2024, 3, 2)
+    for row in (2, 3):
+        ws.cell(row=row, column=2).number_format = "#,##0.00"
+        ws.cell(row=row, column=3).number_format = "yyyy-mm-dd"
+    ws["A3"].font = Font(bold=True)
+    ws["D4"] = "note"
+    ws.merge_cells("D4:E4")
+    ws.freeze_panes = "A2"
+    buf = BytesIO()
+    wb.save(buf)
+
+    manager = SessionManager()
+    manager.open_file(1, "report.xlsx", buf.getvalue())
+    manager.apply(1, PendingOperation(op_kind="delete", target_kind="row", mode="single", selected={2}))
+    manager.apply(1, PendingOperation(op_kind="edit", target_kind="column", mode="single", selected={2}, payload_lines=["99"]))
+    out = load_workbook(BytesIO(manager.export_bytes(1)))["Sheet"]
+
+    assert out["A2"].value == "b" and out["A2"].font.bold
+    assert out["B2"].value == "99" and out["B2"].number_format == "#,##0.00"
+    assert out["C2"].number_format == "yyyy-mm-dd"
+    assert out["C2"].value == datetime.datetime(2024, 3, 2)
+    assert out.freeze_panes == "A2"
+    assert {str(r) for r in out.merged_cells.ranges} == {"D3:E3"}
+
+    assert manager.undo(1) and manager.undo(1)
+    restored = load_workbook(BytesIO(manager.export_bytes(1)))["Sheet"]
+    assert restored["A2"].value == "a" and restored["B2"].value == 10
+    assert restored["A3"].font.bold and restored["C2"].number_format == "yyyy-mm-dd"
+    assert {str(r) for r in restored.merged_cells.ranges} == {"D4:E4"}
+
+
+def _merged_bytes() -> bytes:
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Sheet"
+    ws.append(["name", "price", "group", "tag", "note"])
+    for i in range(1, 6):
+        ws.append([f"r{i}", i, None, None, None])
+    ws["C2"] = "spans"
+    ws.merge_cells("C2:C4")
+    ws["D3"] = "anchor"
+    ws.merge_cells("D3:D4")
+    ws["E5"] = "below"
+    ws.merge_cells("E5:E6")
+    buf = BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def _merges(data: bytes) -> set[str]:
+    return {str(r) for r in load_workbook(BytesIO(data))["Sheet"].merged_cells.ranges}
+
+
+def test_model_export_shifts_merges_around_deleted_row():
+    manager = SessionManager()
+    manager.open_file(1, "merged.xlsx", _merged_bytes())
+    manager.apply(1, PendingOperation(op_kind="delete", target_kind="row", mode="single", selected={3}))
+    out = manager.export_bytes(1)
+
+    # C2:C4 شامل سطر حذف‌شده است و کوچک می‌شود؛ D3:D4 سطر اول خود را از دست داده است
+    assert _merges(out) == {"C2:C3", "E4:E5"}
+    ws = load_workbook(BytesIO(out))["Sheet"]
+    assert ws["C2"].value == "spans" and ws["E4"].value == "below"
+    assert ws["D3"].value is None and ws["A3"].value == "r3"
+
+
+def test_lazy_export_shifts_merges_and_coordinate_ranges():
+    from openpyxl.formatting.rule import CellIsRule
+    from openpyxl.worksheet.datavalidation import DataValidation
+
+    wb = load_workbook(BytesIO(_merged_bytes()))
+    ws = wb["Sheet"]
+    ws["A6"].hyperlink = "https://example.com/r5"
+    ws.conditional_formatting.add("B2:B6", CellIsRule(operator="greaterThan", formula=["2"], font=Font(bold=True)))
+    dv = DataValidation(type="whole")
+    dv.add("B2:B6")
+    ws.add_data_validation(dv)
+    ws.auto_filter.ref = "A1:E6"
+    buf = BytesIO()
+    wb.save(buf)
+
+    eager, lazy = SessionManager(), SessionManager(lazy=True)
+    for manager in (eager, lazy):
+        manager.open_file(1, "merged.xlsx", buf.getvalue())
+        manager.apply(1, PendingOperation(op_kind="delete", target_kind="row", mode="single", selected={3}))
+    out = lazy.export_bytes(1)
+    assert _merges(out) == _merges(eager.export_bytes(1)) == {"C2:C3", "E4:E5"}
+
+    ws = load_workbook(BytesIO(out))["Sheet"]
+    assert ws["A5"].value == "r5" and ws["A5"].hyperlink.target == "https://example.com/r5"
+    assert [str(cf.sqref) for cf in ws.conditional_formatting] == ["B2:B5"]
+    assert [str(dv.sqref) for dv in ws.data_validations.dataValidation] == ["B2:B5"]
+    assert ws.auto_filter.ref == "A1:E5"
+
+
+def test_sessions_shared_across_managers_through_store(tmp_path):
+    import threading
+
+    import pytest
+
+    from bot.state_store import HttpStore, ShardedSQLiteStore, StaleStateError, serve_store
+
+    backend = ShardedSQLiteStore(str(tmp_path / "state"), shards=3)
+    server = serve_store(backend)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        shared = str(tmp_path / "sessions")
+        first = SessionManager(store=HttpStore(url), session_dir=shared)
+        second = SessionManager(store=HttpStore(url), session_dir=shared)
+        first.open_file(1, "a.xlsx", build_bytes())
+        first.apply(1, PendingOperation(op_kind="delete", target_kind="row", mode="single", selected={2}))
+
+        # the store holds a small JSON journal; workbook bytes stay on the shared disk
+        meta = json.loads(backend.get("session:1")[1])
+        assert meta["journal"][0]["selected"] == [2] and "original_bytes" not in meta
+
+        assert second.sheet_map(1)[1] == [2]
+        assert second.undo(1)
+        assert first.sheet_map(1)[1] == [2, 3]
+
+        # a manager holding an outdated copy cannot overwrite newer state
+        first._versions[1] -= 1
+        with pytest.raises(StaleStateError):
+            first.save(1)
+        assert len({p.name for p in (tmp_path / "state").glob("kv.*.db")}) == 3
+        with pytest.raises(ValueError):
+            SessionManager(store=backend)
+    finally:
+        server.shutdown()
+        server.server_close()
+        backend.close()
+
+
+def test_disk_sessions_survive_restart_and_stay_off_heap(tmp_path):
+    data = build_bytes()
+    manager = SessionManager(session_dir=str(tmp_path / "sessions"), max_resident=1)
+    manager.open_file(1, "a.xlsx", data)
+    manager.apply(1, PendingOperation(op_kind="edit", target_kind="row", mode="single", selected={2}, payload_lines=["z"]))
+    manager.apply(1, PendingOperation(op_kind="delete", target_kind="column", mode="single", selected={1}))
+    assert manager.get(1).original_bytes is None
+    expected = _values(manager.export_bytes(1))
+
+    # a second chat pushes the first one out of memory; it is reloaded from disk
+    manager.open_file(2, "b.xlsx", data)
+    assert list(manager._store) == [2]
+    assert _values(manager.export_bytes(1)) == expected
+
+    restarted = SessionManager(session_dir=str(tmp_path / "sessions"))
+    assert restarted.sheet_map(1) == manager.sheet_map(1)
+    assert _values(restarted.export_bytes(1)) == expected
+    assert restarted.undo(1)
+    assert _values(SessionManager(session_dir=str(tmp_path / "sessions")).export_bytes(1)) == [["name", "price"], ["z", "z"], ["b", 20]]
+
+
+def test_cleared_disk_session_stays_cleared_after_restore(tmp_path):
+    import pytest
+
+    op = PendingOperation(op_kind="delete", target_kind="row", mode="single", selected={2})
+    manager = SessionManager(session_dir=str(tmp_path / "sessions"))
+    manager.open_file(1, "a.xlsx", build_bytes())
+    manager.apply(1, op)
+    manager.clear_after_save(1)
+    with pytest.raises(ValueError):
+        manager.apply(1, op)
+
+    restored = SessionManager(session_dir=str(tmp_path / "sessions"))
+    session = restored.get(1)
+    assert session.state == BotState.WAIT_FILE and not session.plans and not session.op_stack
+    with pytest.raises(ValueError):
+        restored.apply(1, op)